@@ -0,0 +1,418 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from concurrency import SharedPatients
+from main import (addPatientData, bulkAddPatientData, compactPatientsFile, deleteAllVisitsOfPatient, displayPatientData,
+                  displayStats, findPatientsWhoNeedFollowUp, findVisitsByDate, findVisitsInDateRange, loadPatients,
+                  readPatientsFromFile, readPatientsFromFileParallel)
+from visitstore import VisitStore
+
+# NumPy speeds up several of the functions measured, so whether it is installed is recorded with the results.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Numbers of visits in the patient files measured by runSuite, from a small clinic to a large hospital network.
+SUITE_VISIT_COUNTS = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+
+# Number of calls timed together for the functions which add or delete a single patient's data, since each call is
+# too quick to time on its own.
+SUITE_SINGLE_CALLS = 100
+
+# Number of calls timed together for the functions which rewrite the whole patient file after a single change, since
+# each call takes about as long as writing the file.
+SUITE_REWRITE_CALLS = 3
+
+# Kinds of malformed lines written by writePatientsFile, one of which is picked at random for each malformed line: a
+# missing value, a value of the wrong type, a date in the wrong format and a vital sign out of range.
+MALFORMED_KINDS = ('fields', 'type', 'date format', 'range')
+
+
+def generateVisits(count, patientCount=1000, seed=0):
+    """
+    Generates random visits whose values are all within the ranges accepted by addPatientData.
+
+    count: The number of visits to generate.
+    patientCount: The number of different patient IDs to spread the visits over.
+    seed: The seed of the random number generator, so the same visits are generated every time.
+    Yields each visit as a tuple (patient ID, date, temperature, heart rate, respiratory rate, systolic blood pressure,
+    diastolic blood pressure, oxygen saturation).
+    """
+    generator = random.Random(seed)
+    for _ in range(count):
+        yield (generator.randint(1, patientCount),
+               '%04d-%02d-%02d' % (generator.randint(2000, 2024), generator.randint(1, 12), generator.randint(1, 28)),
+               round(generator.uniform(35.0, 42.0), 1), generator.randint(30, 180), generator.randint(5, 40),
+               generator.randint(70, 200), generator.randint(40, 120), generator.randint(70, 100))
+
+
+def writePatientsFile(fileName, visitCount, patientCount=None, visitsPerPatient=20, malformedRatio=0.0, seed=0):
+    """
+    Writes a synthetic patient file in the same format as patients.txt, with random visits whose values are within the
+    ranges accepted by addPatientData, mixed with some malformed lines.
+
+    fileName: The name of the file to write.
+    visitCount: The number of lines to write, including the malformed ones.
+    patientCount: The number of different patient IDs to spread the visits over. If None, it is worked out from
+    visitsPerPatient.
+    visitsPerPatient: The average number of visits of each patient, used when patientCount is None.
+    malformedRatio: The fraction of the lines, from 0 to 1, which are malformed (see MALFORMED_KINDS).
+    seed: The seed of the random number generator, so the same file is written every time.
+    """
+    if patientCount is None:
+        patientCount = max(1, visitCount // visitsPerPatient)
+    generator = random.Random(seed)
+    # random() is used instead of randint, which takes several times longer, so that files of millions of visits are
+    # written quickly.
+    draw = generator.random
+    with open(fileName, 'w') as writeFile:
+        lines = []
+        for _ in range(visitCount):
+            values = [int(draw() * patientCount) + 1,
+                      '%04d-%02d-%02d' % (2000 + int(draw() * 25), 1 + int(draw() * 12), 1 + int(draw() * 28)),
+                      round(35.0 + draw() * 7.0, 1), 30 + int(draw() * 151), 5 + int(draw() * 36),
+                      70 + int(draw() * 131), 40 + int(draw() * 81), 70 + int(draw() * 31)]
+            if malformedRatio and draw() < malformedRatio:
+                kind = generator.choice(MALFORMED_KINDS)
+                if kind == 'fields':
+                    values.pop()
+                elif kind == 'type':
+                    values[3] = 'abc'
+                elif kind == 'date format':
+                    values[1] = values[1].replace('-', '/')
+                else:
+                    values[2] = 45.0
+            lines.append(','.join([str(value) for value in values]))
+            # Writes the lines in batches, so a large file is never held in memory all at once.
+            if len(lines) == 100000:
+                writeFile.write('\n'.join(lines) + '\n')
+                lines = []
+        if lines:
+            writeFile.write('\n'.join(lines) + '\n')
+
+
+def benchmarkBulkAdd(visitCount=100000, singleCount=1000):
+    """
+    Measures how many visits per second bulkAddPatientData adds, from a list of visits and from a CSV stream, compared
+    with adding visits one at a time with addPatientData. Each run starts from an empty patient file in a temporary
+    directory. The visits added one at a time are then added again with a single call to bulkAddPatientData, and the
+    two files are checked to be the same, so that both ways of adding visits are known to write the same lines.
+
+    visitCount: The number of visits added by bulkAddPatientData.
+    singleCount: The number of visits added one at a time by addPatientData.
+    Returns a dictionary mapping the name of each run to the number of visits added per second. Raises AssertionError
+    if the two files are not the same.
+    """
+    visits = list(generateVisits(visitCount))
+    csvText = ''.join(','.join(str(value) for value in visit) + '\n' for visit in visits)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, 'patients.txt')
+
+        # Adds every visit from a list, and then from a CSV stream, with a single call each.
+        for name, source in (('bulkAddPatientData (list)', visits),
+                             ('bulkAddPatientData (CSV stream)', io.StringIO(csvText))):
+            open(fileName, 'w').close()
+            start = time.perf_counter()
+            report = bulkAddPatientData(VisitStore(), source, fileName)
+            results[name] = report['added'] / (time.perf_counter() - start)
+
+        # Adds the first visits one at a time, hiding the message printed for each one.
+        open(fileName, 'w').close()
+        patients = VisitStore()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for visit in visits[:singleCount]:
+                addPatientData(patients, *visit, fileName)
+        results['addPatientData'] = singleCount / (time.perf_counter() - start)
+
+        # Adds the same visits with a single call to bulkAddPatientData, into a second file.
+        bulkFileName = os.path.join(directory, 'bulk.txt')
+        open(bulkFileName, 'w').close()
+        start = time.perf_counter()
+        report = bulkAddPatientData(VisitStore(), visits[:singleCount], bulkFileName)
+        results['bulkAddPatientData (same visits)'] = report['added'] / (time.perf_counter() - start)
+        with open(fileName) as singleFile, open(bulkFileName) as bulkFile:
+            assert singleFile.read() == bulkFile.read(), \
+                'bulkAddPatientData and addPatientData wrote different lines for the same visits'
+    return results
+
+
+def benchmarkThreads(visitCount=200000, threadCounts=(1, 2, 4, 8), seconds=2.0):
+    """
+    Stress tests SharedPatients by running query threads alongside a writer thread which keeps adding visits and
+    deleting patients, and measures how many queries per second are answered with each number of query threads. Each
+    query thread picks at random between the visits of a patient, the visits in a month, the full statistics of a
+    patient and the statistics of every patient. Any error raised by a query or a write is counted.
+
+    visitCount: The number of visits in the patients being queried.
+    threadCounts: The numbers of query threads to measure.
+    seconds: How long to run each measurement for.
+    Returns a dictionary mapping each number of query threads to a dictionary with the 'queries' answered per second,
+    the 'writes' made per second and the number of 'errors'.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        fileName = os.path.join(directory, 'patients.txt')
+        open(fileName, 'w').close()
+        patients = VisitStore()
+        bulkAddPatientData(patients, generateVisits(visitCount), fileName)
+        shared = SharedPatients(patients, fileName)
+
+        for threadCount in threadCounts:
+            stop = threading.Event()
+            counts = {'queries': 0, 'writes': 0, 'errors': 0}
+            countLock = threading.Lock()
+
+            def count(name, amount=1):
+                with countLock:
+                    counts[name] += amount
+
+            def runQueries(seed):
+                generator = random.Random(seed)
+                queries = 0
+                while not stop.is_set():
+                    choice = generator.randrange(4)
+                    try:
+                        if choice == 0:
+                            shared.visits(generator.randint(1, 1000))
+                        elif choice == 1:
+                            shared.visitsByDate(generator.randint(2000, 2024), generator.randint(1, 12))
+                        elif choice == 2:
+                            shared.stats(generator.randint(1, 1000), full=True)
+                        else:
+                            shared.stats()
+                    except KeyError:
+                        pass
+                    except Exception:
+                        count('errors')
+                    queries += 1
+                count('queries', queries)
+
+            def runWrites():
+                generator = random.Random(threadCount)
+                while not stop.is_set():
+                    patientId = generator.randint(1, 1000)
+                    try:
+                        if generator.random() < 0.1:
+                            shared.deletePatient(patientId)
+                        else:
+                            shared.addVisits(generateVisits(10, seed=generator.random()))
+                    except Exception:
+                        count('errors')
+                    count('writes')
+                    time.sleep(0.001)
+
+            threads = [threading.Thread(target=runQueries, args=(seed,)) for seed in range(threadCount)]
+            threads.append(threading.Thread(target=runWrites))
+            for thread in threads:
+                thread.start()
+            time.sleep(seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            results[threadCount] = {'queries': counts['queries'] / seconds, 'writes': counts['writes'] / seconds,
+                                    'errors': counts['errors']}
+    return results
+
+
+def runSuite(visitCounts=SUITE_VISIT_COUNTS[:4], patientCount=None, visitsPerPatient=20, malformedRatio=0.01,
+             repeats=3, memory=True, seed=0):
+    """
+    Times the public functions of main.py on synthetic patient files of each size (see writePatientsFile), and
+    records how much memory each one needs at its peak. Each file is written to a temporary directory, and everything
+    the functions print is hidden.
+
+    Most functions are called repeats times, and the quickest call is kept. addPatientData and
+    deleteAllVisitsOfPatient change the patients, so they are instead called SUITE_SINGLE_CALLS times in a row (for
+    different patients, in the case of deleteAllVisitsOfPatient) and the average call is kept. When they rewrite the
+    whole file instead of appending to it, they are called SUITE_REWRITE_CALLS times in a row.
+
+    visitCounts: The numbers of visits in the files measured.
+    patientCount, visitsPerPatient, malformedRatio, seed: How the files are generated (see writePatientsFile).
+    repeats: The number of times each function is called to find its quickest call.
+    memory: If True, each function is called once more while tracing memory allocations with tracemalloc, to find the
+    peak memory it allocates (in the main process only). This is slow for large files.
+    Returns a dictionary which can be saved as JSON with saveResults, with the following structure:
+    {
+        'version': the git commit of the code measured, or None (str),
+        'python': the Python version (str),
+        'numpy': the NumPy version, or None if it is not installed (str),
+        'cpus': the number of CPUs (int),
+        'parameters': the arguments of runSuite (dict),
+        'results': [
+            {'function': name of the function (str), 'case': what it was called for (str), 'visits': number of
+             visits in the file (int), 'seconds': time taken by one call (float), 'peakMemory': bytes allocated at
+             the peak, or None (int)},
+            ...
+        ]
+    }
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for visitCount in visitCounts:
+            fileName = os.path.join(directory, 'patients_%d.txt' % visitCount)
+            writePatientsFile(fileName, visitCount, patientCount, visitsPerPatient, malformedRatio, seed)
+            patients = readPatientsFromFile(fileName)
+            patientIds = sorted(patients)
+            somePatient = patientIds[len(patientIds) // 2]
+            newVisits = list(generateVisits(1000, len(patientIds), seed))
+
+            # Each case is a tuple (function name, case, function with no arguments, number of calls to average over).
+            # The cases which change the patients come last.
+            cases = [
+                ('readPatientsFromFile', 'whole file', lambda: readPatientsFromFile(fileName), 1),
+                ('readPatientsFromFileParallel', 'whole file', lambda: readPatientsFromFileParallel(fileName), 1),
+                ('loadPatients', 'snapshot', lambda: loadPatients(fileName), 1),
+                ('displayStats', 'every patient', lambda: displayStats(patients), 1),
+                ('displayStats', 'one patient', lambda: displayStats(patients, somePatient), 1),
+                ('displayPatientData', 'one patient', lambda: displayPatientData(patients, somePatient), 1),
+                ('findVisitsByDate', 'year', lambda: findVisitsByDate(patients, 2012), 1),
+                ('findVisitsByDate', 'month', lambda: findVisitsByDate(patients, 2012, 6), 1),
+                ('findVisitsInDateRange', 'one year', lambda: findVisitsInDateRange(patients, '2012-01-01',
+                                                                                   '2012-12-31'), 1),
+                ('findPatientsWhoNeedFollowUp', 'every patient', lambda: findPatientsWhoNeedFollowUp(patients), 1),
+                ('addPatientData', 'one visit',
+                 _callEach(lambda visit: addPatientData(patients, *visit, fileName), newVisits), SUITE_SINGLE_CALLS),
+                ('bulkAddPatientData', '1000 visits', lambda: bulkAddPatientData(patients, newVisits, fileName), 1),
+                ('addPatientData', 'rewrite',
+                 _callEach(lambda visit: addPatientData(patients, *visit, fileName, appendOnly=False), newVisits),
+                 SUITE_REWRITE_CALLS),
+                ('deleteAllVisitsOfPatient', 'one patient',
+                 _callEach(lambda patientId: deleteAllVisitsOfPatient(patients, patientId, fileName), patientIds),
+                 SUITE_SINGLE_CALLS),
+                ('deleteAllVisitsOfPatient', 'rewrite',
+                 _callEach(lambda patientId: deleteAllVisitsOfPatient(patients, patientId, fileName, useLog=False),
+                           patientIds[::-1]), SUITE_REWRITE_CALLS),
+                ('compactPatientsFile', 'whole file', lambda: compactPatientsFile(patients, fileName), 1),
+            ]
+            # loadPatients only opens the snapshot once one has been saved.
+            loadPatients(fileName)
+
+            for name, case, function, calls in cases:
+                # Functions called many times in a row are timed together, and everything else is called repeats
+                # times.
+                if calls > 1:
+                    start = time.perf_counter()
+                    for _ in range(calls):
+                        function()
+                    seconds = (time.perf_counter() - start) / calls
+                else:
+                    seconds = float('inf')
+                    for _ in range(repeats):
+                        start = time.perf_counter()
+                        function()
+                        seconds = min(seconds, time.perf_counter() - start)
+                peakMemory = _peakMemory(function) if memory else None
+                results.append({'function': name, 'case': case, 'visits': visitCount, 'seconds': seconds,
+                                'peakMemory': peakMemory})
+
+    return {'version': _codeVersion(), 'python': platform.python_version(),
+            'numpy': numpy.__version__ if numpy is not None else None, 'cpus': os.cpu_count(),
+            'parameters': {'visitCounts': list(visitCounts), 'patientCount': patientCount,
+                           'visitsPerPatient': visitsPerPatient, 'malformedRatio': malformedRatio,
+                           'repeats': repeats, 'memory': memory, 'seed': seed},
+            'results': results}
+
+
+def _callEach(function, arguments):
+    # Gives a function with no arguments which calls function with the next of arguments each time it is called,
+    # starting again from the first once they run out.
+    position = [0]
+
+    def callNext():
+        function(arguments[position[0] % len(arguments)])
+        position[0] += 1
+    return callNext
+
+
+def _peakMemory(function):
+    # Calls a function while tracing memory allocations, and returns the most memory it had allocated at any point.
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _codeVersion():
+    # Finds the git commit of the code being measured, or None if it is not in a git repository.
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def saveResults(suite, fileName):
+    """
+    Saves the results of runSuite to a JSON file.
+
+    suite: The dictionary returned by runSuite.
+    fileName: The name of the file to save to.
+    """
+    with open(fileName, 'w') as writeFile:
+        json.dump(suite, writeFile, indent=2)
+
+
+def compareResults(oldFileName, newFileName):
+    """
+    Compares two sets of results saved by saveResults, such as from before and after a change.
+
+    oldFileName: The name of the file holding the earlier results.
+    newFileName: The name of the file holding the later results.
+    Returns a list of tuples (function, case, visits, old seconds, new seconds, new seconds / old seconds), for each
+    measurement found in both files. A ratio above 1 means the function became slower.
+    """
+    with open(oldFileName) as oldFile, open(newFileName) as newFile:
+        oldResults = json.load(oldFile)['results']
+        newResults = json.load(newFile)['results']
+    oldSeconds = {(result['function'], result['case'], result['visits']): result['seconds'] for result in oldResults}
+    comparison = []
+    for result in newResults:
+        key = (result['function'], result['case'], result['visits'])
+        if key in oldSeconds:
+            comparison.append(key + (oldSeconds[key], result['seconds'], result['seconds'] / oldSeconds[key]))
+    return comparison
+
+
+if __name__ == '__main__':
+    # 'python benchmark.py threads' runs the thread stress test.
+    # 'python benchmark.py suite [results file] [largest number of visits]' runs runSuite and saves its results.
+    # 'python benchmark.py compare [old results file] [new results file]' compares two saved results.
+    # Otherwise, the number of visits to add in bulk can be given on the command line.
+    if sys.argv[1:2] == ['threads']:
+        for threadCount, result in benchmarkThreads().items():
+            print('%2d query threads: %8.0f queries/s %6.0f writes/s %d errors'
+                  % (threadCount, result['queries'], result['writes'], result['errors']))
+    elif sys.argv[1:2] == ['suite']:
+        resultsFile = sys.argv[2] if len(sys.argv) > 2 else 'benchmark_results.json'
+        largest = int(float(sys.argv[3])) if len(sys.argv) > 3 else SUITE_VISIT_COUNTS[3]
+        suite = runSuite([count for count in SUITE_VISIT_COUNTS if count <= largest])
+        saveResults(suite, resultsFile)
+        for result in suite['results']:
+            peakMemory = result['peakMemory'] / 1e6 if result['peakMemory'] is not None else float('nan')
+            print('%-28s %-14s %9d visits %12.6f s %10.1f MB'
+                  % (result['function'], result['case'], result['visits'], result['seconds'], peakMemory))
+    elif sys.argv[1:2] == ['compare']:
+        for function, case, visits, oldSeconds, newSeconds, ratio in compareResults(sys.argv[2], sys.argv[3]):
+            print('%-28s %-14s %9d visits %12.6f s -> %12.6f s (x%.2f)'
+                  % (function, case, visits, oldSeconds, newSeconds, ratio))
+    else:
+        visitCount = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+        for name, visitsPerSecond in benchmarkBulkAdd(visitCount).items():
+            print('%-32s %12.0f visits/s' % (name, visitsPerSecond))
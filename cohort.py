@@ -0,0 +1,410 @@
+import operator
+from array import array
+from functools import reduce
+
+from instrumentation import metrics
+from visitstore import VITAL_TYPECODES, VITALS, VisitStore, encodeDate
+
+# NumPy is used to check each batch of visits against a filter in a few array operations when it is installed. Without
+# it, the visits are checked one at a time with plain Python.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Number of visits checked against a filter at a time. Only one batch of visits is looked at before the matching visits
+# are handed back, so the first results come quickly and a query never needs much memory, however many visits match.
+COHORT_BATCH_SIZE = 65536
+
+# Rough costs, in microseconds, of the two ways of finding the visits a filter can match, used to choose the cheaper
+# one. Going patient by patient costs a binary search of each patient's visits plus the copying of each visit found.
+# The date index reads each visit in the months of the range with plain Python, and then sorts them into patient order.
+_PATIENT_COST = 3.0
+_ROW_COST = 0.05
+_DATE_INDEX_ROW_COST = 2.5
+
+# Comparison used by each key of a vital sign filter, by the key which holds its limit.
+_COMPARISONS = {'above': operator.gt, 'below': operator.lt, 'atLeast': operator.ge, 'atMost': operator.le}
+
+# Keys allowed in each form of filter which is not a combination of other filters.
+_PATIENT_KEYS = {'patients'}
+_VITAL_KEYS = {'vital'} | set(_COMPARISONS)
+_RANGE_KEYS = {'from', 'to'}
+_PERIOD_KEYS = {'year', 'quarter', 'month'}
+
+
+class CohortQuery:
+    """
+    Finds the visits which match a filter, such as every visit with an oxygen saturation below 92 in the first quarter
+    of 2024:
+
+        CohortQuery({'all': [{'vital': 'oxygen saturation', 'below': 92}, {'year': 2024, 'quarter': 1}]})
+
+    A filter is a dictionary in one of the following forms:
+    {'patients': [patient IDs]}: Matches the visits of the listed patients.
+    {'from': date, 'to': date}: Matches the visits from one 'yyyy-mm-dd' date to another, including both. Either date
+    can be left out to leave the range open at that end.
+    {'year': year}, {'year': year, 'quarter': 1 to 4} or {'year': year, 'month': 1 to 12}: Matches the visits in a year,
+    or in a quarter or month of a year.
+    {'vital': vital sign, 'above': limit, 'below': limit, 'atLeast': limit, 'atMost': limit}: Matches the visits whose
+    vital sign is above, below, at least or at most each limit given. At least one limit must be given.
+    {'all': [filters]}, {'any': [filters]} or {'not': filter}: Matches the visits which match all of the filters, any
+    of them, or not the filter.
+    Visits whose date is not in the 'yyyy-mm-dd' form are never in a range of dates, and a vital sign which is not a
+    number (NaN) is never above or below any limit.
+
+    The patients and dates a filter is limited to are used to decide where to look for matching visits: patient by
+    patient, skipping to each patient's visits in the range of dates by binary search, or through the date index of the
+    store when the range of dates holds fewer visits than that would look at. The visits found are then checked against
+    the whole filter in batches of COHORT_BATCH_SIZE visits, and handed back as they are found.
+    """
+
+    def __init__(self, where):
+        """
+        Compiles a filter, so that it is only parsed once however many times it is run. Raises ValueError if the filter
+        is not valid.
+
+        where: The filter.
+        """
+        self.where = where
+        self._filter = _compileFilter(where)
+
+    def plan(self, patients):
+        """
+        Returns how the visits matching the filter would be found: 'patient index' if they are looked up patient by
+        patient, 'date index' if they are looked up through the date index, or 'column scan' if every visit has to be
+        checked, because the filter is not limited to any patients or dates. A dictionary has no date index, so every
+        visit of a dictionary is checked unless the filter is limited to some patients.
+
+        patients: A VisitStore, or a dictionary of patient IDs where each patient has a list of visits.
+        """
+        if not isinstance(patients, VisitStore):
+            return 'column scan' if self._filter.patientIds is None else 'patient index'
+        return self._plan(patients)[0]
+
+    def visits(self, patients, batchSize=COHORT_BATCH_SIZE):
+        """
+        Yields the visits which match the filter, as tuples (patient ID, visit list), patient by patient and in date
+        order within each patient. The visits are only found as they are asked for, so the patients must not be
+        changed until the results have been used.
+
+        patients: A VisitStore, or a dictionary of patient IDs where each patient has a list of visits.
+        batchSize: The number of visits checked against the filter at a time.
+        """
+        if not isinstance(patients, VisitStore):
+            for visits in self._matchingVisits(patients, batchSize):
+                yield from visits
+            return
+        store = patients
+        columns = [store.patientIdColumn()] + [store.column(vital) for vital in VITALS]
+        for rows in self._matchingRows(store, batchSize):
+            # Builds the visit lists of the whole batch from the columns at once, which is much faster than building
+            # them one row at a time. Each date string is only built once.
+            values = [[column[row] for row in rows] for column in columns]
+            for patientId, date, temperature, hr, rr, sbp, dbp, spo2 in zip(values[0], store.dateStrings(rows),
+                                                                              *values[1:]):
+                yield patientId, [date, temperature, hr, rr, sbp, dbp, spo2]
+
+    def patientIds(self, patients, batchSize=COHORT_BATCH_SIZE):
+        """
+        Yields the ID of each patient who has at least one visit which matches the filter, in patient order. The
+        patients must not be changed until the results have been used.
+
+        patients: A VisitStore, or a dictionary of patient IDs where each patient has a list of visits.
+        batchSize: The number of visits checked against the filter at a time.
+        """
+        if not isinstance(patients, VisitStore):
+            previous = None
+            for visits in self._matchingVisits(patients, batchSize):
+                for patientId, visit in visits:
+                    if patientId != previous:
+                        yield patientId
+                        previous = patientId
+            return
+        store = patients
+        previous = None
+        for rows in self._matchingRows(store, batchSize):
+            for row in rows:
+                # The visits of each patient are found together, so each patient only needs to be compared with the
+                # patient of the visit before.
+                patientId = store.patientOf(row)
+                if patientId != previous:
+                    yield patientId
+                    previous = patientId
+
+    def count(self, patients, batchSize=COHORT_BATCH_SIZE):
+        """
+        Returns the number of visits which match the filter, without building any visit lists.
+
+        patients: A VisitStore, or a dictionary of patient IDs where each patient has a list of visits.
+        batchSize: The number of visits checked against the filter at a time.
+        """
+        if not isinstance(patients, VisitStore):
+            return sum(len(visits) for visits in self._matchingVisits(patients, batchSize))
+        return sum(len(rows) for rows in self._matchingRows(patients, batchSize))
+
+    def _plan(self, store):
+        # Chooses the cheaper way of finding the visits the filter can match. Returns a tuple (name of the plan, the
+        # patient IDs to look at in patient order, or None to use the date index).
+        patientIds = self._filter.patientIds
+        dateRange = self._filter.dateRange
+        if patientIds is None:
+            selected = list(store)
+            rowCount = store.visitCount()
+        else:
+            selected = [patientId for patientId in store if patientId in patientIds]
+            rowCount = sum(len(store.rowsOf(patientId)) for patientId in selected)
+        if dateRange is None:
+            return ('column scan' if patientIds is None else 'patient index'), selected
+
+        # Looking patient by patient only copies the visits in the range, which are no more than the date index holds
+        # for the months of the range.
+        monthRowCount = store.monthRowCount(*dateRange)
+        patientCost = len(selected) * _PATIENT_COST + min(rowCount, monthRowCount) * _ROW_COST
+        if monthRowCount * _DATE_INDEX_ROW_COST < patientCost:
+            return 'date index', None
+        return 'patient index', selected
+
+    def _candidateRows(self, store, batchSize):
+        # Yields the rows which may match the filter, in batches of about batchSize rows, as arrays of row numbers.
+        plan, patientIds = self._plan(store)
+        startDate, endDate = self._filter.dateRange or (None, None)
+        if patientIds is None:
+            rows = store.rowsBetween(startDate, endDate)
+            for start in range(0, len(rows), batchSize):
+                yield array('q', rows[start:start + batchSize])
+            return
+        batch = array('q')
+        for patientId in patientIds:
+            batch.extend(store.patientRowsBetween(patientId, startDate, endDate))
+            if len(batch) >= batchSize:
+                yield batch
+                batch = array('q')
+        if batch:
+            yield batch
+
+    def _matchingRows(self, store, batchSize):
+        # Yields the rows which match the filter, one batch of candidate rows at a time, as lists of row numbers.
+        columns = None if numpy is not None else _RowColumns(store.patientIdColumn(), store.dateColumn(),
+                                                             [store.column(vital) for vital in VITALS])
+        for rows in self._candidateRows(store, batchSize):
+            metrics.count('visits_scanned', len(rows), operation='cohort')
+            if numpy is not None:
+                selection = numpy.frombuffer(rows, dtype=numpy.int64)
+                yield selection[self._filter.masks(_Batch(store, selection))].tolist()
+            else:
+                test = self._filter.test
+                yield [row for row in rows if test(columns, row)]
+
+    def _matchingVisits(self, patients, batchSize):
+        # Yields the visits of a dictionary of patients which match the filter, one batch of candidate visits at a time,
+        # as lists of (patient ID, visit list) tuples. A dictionary is checked with plain Python, looking only at the
+        # patients the filter can match: copying it into a VisitStore would read every patient, and the typed columns
+        # of a store cannot hold every value a dictionary can. Each patient's visits are put in date order, as a store
+        # keeps them.
+        patientIds = self._filter.patientIds
+        batch = []
+        for patientId in patients:
+            if patientIds is None or patientId in patientIds:
+                batch.extend((patientId, visit) for visit in sorted(patients[patientId], key=_visitDate))
+                if len(batch) >= batchSize:
+                    yield self._checkVisits(batch)
+                    batch = []
+        if batch:
+            yield self._checkVisits(batch)
+
+    def _checkVisits(self, batch):
+        # Returns the (patient ID, visit list) tuples of a batch which match the filter, each with a copy of the visit.
+        metrics.count('visits_scanned', len(batch), operation='cohort')
+        # A date which is not in the 'yyyy-mm-dd' form is given as -1, as a VisitStore does, so it is never in a range.
+        dates = [encodeDate(visit[0]) for patientId, visit in batch]
+        columns = _RowColumns([patientId for patientId, visit in batch],
+                              [-1 if date is None else date for date in dates],
+                              [[visit[index] for patientId, visit in batch] for index in range(1, len(VITALS) + 1)])
+        test = self._filter.test
+        return [(patientId, list(visit)) for row, (patientId, visit) in enumerate(batch) if test(columns, row)]
+
+
+def _visitDate(visit):
+    # Returns the date of a visit list. Dates in the 'yyyy-mm-dd' form sort in the same order as the dates themselves.
+    return visit[0]
+
+
+def findCohort(patients, where, batchSize=COHORT_BATCH_SIZE):
+    """
+    Yields the visits which match a filter, as tuples (patient ID, visit list), patient by patient. See CohortQuery for
+    the form of the filter. Raises ValueError if the filter is not valid.
+
+    patients: A VisitStore, or a dictionary of patient IDs where each patient has a list of visits.
+    where: The filter.
+    batchSize: The number of visits checked against the filter at a time.
+    """
+    return CohortQuery(where).visits(patients, batchSize)
+
+
+class _Filter:
+    """
+    A filter turned into the functions which check it, along with the patients and dates it is limited to.
+    """
+
+    def __init__(self, masks, test, patientIds=None, dateRange=None):
+        # Function taking a _Batch and returning a NumPy boolean array which is True for each row the filter matches.
+        self.masks = masks
+        # Function taking a _RowColumns and a row, and returning True if the filter matches the row.
+        self.test = test
+        # A set of the only patient IDs the filter can match, or None if it can match any patient.
+        self.patientIds = patientIds
+        # A tuple (first date, last date), encoded by encodeDate, of the only dates the filter can match, or None if it
+        # can match any date.
+        self.dateRange = dateRange
+
+
+def _compileFilter(where):
+    if not isinstance(where, dict):
+        raise ValueError('Every filter must be a dictionary: %r' % (where,))
+
+    # Filters which combine other filters.
+    if 'all' in where or 'any' in where:
+        combineAll = 'all' in where
+        parts = where['all' if combineAll else 'any']
+        if len(where) != 1 or not isinstance(parts, list) or not parts:
+            raise ValueError('A filter must combine a list of at least one filter: %r' % (where,))
+        parts = [_compileFilter(part) for part in parts]
+        if combineAll:
+            # Every filter has to match, so only the patients and dates all of them can match can be matched.
+            patientIds = reduce(lambda found, part: part.patientIds if found is None else
+                                found if part.patientIds is None else found & part.patientIds, parts, None)
+            dateRanges = [part.dateRange for part in parts if part.dateRange is not None]
+            dateRange = ((max(start for start, end in dateRanges), min(end for start, end in dateRanges))
+                         if dateRanges else None)
+            return _Filter(lambda batch: reduce(numpy.logical_and, [part.masks(batch) for part in parts]),
+                           lambda columns, row: all(part.test(columns, row) for part in parts),
+                           patientIds, dateRange)
+        # Any filter can match, so the filter is only limited if each of them is.
+        patientIds = (None if any(part.patientIds is None for part in parts)
+                      else frozenset().union(*[part.patientIds for part in parts]))
+        dateRange = (None if any(part.dateRange is None for part in parts)
+                     else (min(part.dateRange[0] for part in parts), max(part.dateRange[1] for part in parts)))
+        return _Filter(lambda batch: reduce(numpy.logical_or, [part.masks(batch) for part in parts]),
+                       lambda columns, row: any(part.test(columns, row) for part in parts),
+                       patientIds, dateRange)
+    if 'not' in where:
+        if len(where) != 1:
+            raise ValueError("A 'not' filter must have nothing else in it: %r" % (where,))
+        part = _compileFilter(where['not'])
+        return _Filter(lambda batch: ~part.masks(batch), lambda columns, row: not part.test(columns, row))
+
+    # Filters on the patient.
+    if 'patients' in where:
+        patientIds = where['patients']
+        if set(where) - _PATIENT_KEYS or not isinstance(patientIds, list) or not all(
+                isinstance(patientId, int) and not isinstance(patientId, bool) for patientId in patientIds):
+            raise ValueError('A patient filter must have a list of patient IDs and nothing else: %r' % (where,))
+        patientIds = frozenset(patientIds)
+        idArray = numpy.array(sorted(patientIds), dtype=numpy.int64) if numpy is not None else None
+        return _Filter(lambda batch: numpy.isin(batch.patientIds(), idArray),
+                       lambda columns, row: columns.patientIds[row] in patientIds,
+                       patientIds=patientIds)
+
+    # Filters on a vital sign.
+    if 'vital' in where:
+        vital = where['vital']
+        if vital not in VITALS:
+            raise ValueError('A vital sign filter must name one of the vital signs: %s.' % ', '.join(VITALS))
+        limits = [(_COMPARISONS[key], where[key]) for key in _COMPARISONS if key in where]
+        if set(where) - _VITAL_KEYS or not limits or not all(
+                isinstance(limit, (int, float)) and not isinstance(limit, bool) for comparison, limit in limits):
+            raise ValueError('A vital sign filter must have at least one number from %s, and nothing else: %r'
+                             % (', '.join(_COMPARISONS), where))
+        index = VITALS.index(vital)
+        return _Filter(lambda batch: reduce(numpy.logical_and, [comparison(batch.values(vital), limit)
+                                                                for comparison, limit in limits]),
+                       lambda columns, row: all(comparison(columns.vitals[index][row], limit)
+                                                for comparison, limit in limits))
+
+    # Every other filter is on the date.
+    startDate, endDate = _dateRangeOfFilter(where)
+    return _Filter(lambda batch: (batch.dates() >= startDate) & (batch.dates() <= endDate),
+                   lambda columns, row: startDate <= columns.dates[row] <= endDate,
+                   dateRange=(startDate, endDate))
+
+
+def _dateRangeOfFilter(where):
+    """
+    Returns the first and last encoded dates (see encodeDate) matched by a date filter. Raises ValueError if the filter
+    is not a valid date filter.
+
+    where: The filter, in the form {'from': date, 'to': date} or {'year': year, 'quarter': quarter, 'month': month}.
+    """
+    keys = set(where)
+    # A range between two dates, either of which can be left out.
+    if keys and keys <= _RANGE_KEYS:
+        dates = [where.get('from', '0000-00-00'), where.get('to', '9999-99-99')]
+        encodedDates = [encodeDate(date) if isinstance(date, str) else None for date in dates]
+        if None in encodedDates:
+            raise ValueError("The dates of a filter must be in the 'yyyy-mm-dd' form: %r" % (where,))
+        return encodedDates[0], encodedDates[1]
+
+    # A year, or a quarter or month of a year.
+    if 'year' in keys and keys <= _PERIOD_KEYS and not keys >= {'quarter', 'month'}:
+        year = where['year']
+        if isinstance(year, bool) or not isinstance(year, int) or not 1900 <= year <= 9999:
+            raise ValueError('The year of a filter must be a whole number from 1900 to 9999: %r' % (where,))
+        firstMonth, lastMonth = 1, 12
+        if 'quarter' in where:
+            quarter = where['quarter']
+            if quarter not in (1, 2, 3, 4) or isinstance(quarter, bool):
+                raise ValueError('The quarter of a filter must be from 1 to 4: %r' % (where,))
+            firstMonth, lastMonth = 3 * quarter - 2, 3 * quarter
+        if 'month' in where:
+            month = where['month']
+            if month not in range(1, 13) or isinstance(month, bool):
+                raise ValueError('The month of a filter must be from 1 to 12: %r' % (where,))
+            firstMonth, lastMonth = month, month
+        return year * 10000 + firstMonth * 100, year * 10000 + lastMonth * 100 + 99
+    raise ValueError('A filter must be on patients, dates or a vital sign, or combine other filters: %r' % (where,))
+
+
+class _Batch:
+    """
+    The columns of a VisitStore as NumPy arrays, for a batch of rows. Each column is only gathered once, however many
+    parts of the filter look at it.
+    """
+
+    def __init__(self, store, selection):
+        self._store = store
+        self._selection = selection
+        self._cache = {}
+
+    def values(self, vital):
+        # Returns the vital sign of each row in the batch.
+        if vital not in self._cache:
+            typecode = VITAL_TYPECODES[VITALS.index(vital)]
+            self._cache[vital] = numpy.frombuffer(self._store.column(vital), dtype=typecode)[self._selection]
+        return self._cache[vital]
+
+    def dates(self):
+        # Returns the encoded date of each row in the batch.
+        if 'date' not in self._cache:
+            self._cache['date'] = numpy.frombuffer(self._store.dateColumn(), dtype='i')[self._selection]
+        return self._cache['date']
+
+    def patientIds(self):
+        # Returns the patient ID of each row in the batch.
+        if None not in self._cache:
+            self._cache[None] = numpy.frombuffer(self._store.patientIdColumn(), dtype=numpy.int64)[self._selection]
+        return self._cache[None]
+
+
+class _RowColumns:
+    """
+    The columns of a VisitStore, or of a batch of visits, looked up once so that checking each row does not need any
+    method calls.
+    """
+
+    def __init__(self, patientIds, dates, vitals):
+        # The patient ID and encoded date of each row, and one column per vital sign in the order of VITALS.
+        self.patientIds = patientIds
+        self.dates = dates
+        self.vitals = vitals
@@ -0,0 +1,175 @@
+import threading
+from contextlib import contextmanager
+
+from main import addPatientData, bulkAddPatientData, deleteAllVisitsOfPatient, iterPatientVisits, iterVisitsByDate
+from screening import FOLLOW_UP_RULES, screenPatients
+from visitstore import VisitStore
+from vitalstats import computeVitalStats, runningVitalStats
+
+
+class ReadWriteLock:
+    """
+    A lock which can be held by many readers at once, or by a single writer. A writer waiting for the lock stops new
+    readers from taking it, so a steady stream of readers cannot keep writers waiting forever. The lock is not
+    reentrant: a thread holding it must not try to take it again.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        # Number of threads holding the lock for reading.
+        self._readers = 0
+        # True while a thread holds the lock for writing.
+        self._writing = False
+        # Number of threads waiting to take the lock for writing.
+        self._waitingWriters = 0
+
+    def acquireRead(self):
+        """
+        Waits until no writer holds or is waiting for the lock, and then takes it for reading.
+        """
+        with self._condition:
+            while self._writing or self._waitingWriters:
+                self._condition.wait()
+            self._readers += 1
+
+    def releaseRead(self):
+        """
+        Releases the lock taken with acquireRead.
+        """
+        with self._condition:
+            self._readers -= 1
+            if self._readers == 0:
+                self._condition.notify_all()
+
+    def acquireWrite(self):
+        """
+        Waits until no thread holds the lock, and then takes it for writing.
+        """
+        with self._condition:
+            self._waitingWriters += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waitingWriters -= 1
+            self._writing = True
+
+    def releaseWrite(self):
+        """
+        Releases the lock taken with acquireWrite.
+        """
+        with self._condition:
+            self._writing = False
+            self._condition.notify_all()
+
+    @contextmanager
+    def reading(self):
+        """
+        Holds the lock for reading for the duration of a with statement.
+        """
+        self.acquireRead()
+        try:
+            yield
+        finally:
+            self.releaseRead()
+
+    @contextmanager
+    def writing(self):
+        """
+        Holds the lock for writing for the duration of a with statement.
+        """
+        self.acquireWrite()
+        try:
+            yield
+        finally:
+            self.releaseWrite()
+
+
+class SharedPatients:
+    """
+    Lets many threads use the same patients and patient file at once. Each query holds a ReadWriteLock for reading, so
+    queries run alongside each other, and each change holds it for writing, so no query ever sees a patient being
+    added or deleted halfway (which could otherwise fail with "dictionary changed size during iteration"). Queries
+    return lists rather than iterators, since an iterator would keep reading the patients after the lock is released.
+
+    Other code which needs to read or change the patients directly can hold the lock itself with reading and writing.
+    """
+
+    def __init__(self, patients, fileName):
+        # The patients, the file changes are saved to, and the lock guarding both.
+        self._patients = patients
+        self.fileName = fileName
+        self.lock = ReadWriteLock()
+
+    @contextmanager
+    def reading(self):
+        """
+        Gives the patients to a with statement while holding the lock for reading. The patients must not be changed.
+        """
+        with self.lock.reading():
+            yield self._patients
+
+    @contextmanager
+    def writing(self):
+        """
+        Gives the patients to a with statement while holding the lock for writing.
+        """
+        with self.lock.writing():
+            yield self._patients
+
+    # The methods below are queries, which only read the patients.
+
+    def visits(self, patientId=0, offset=0, limit=None):
+        """
+        Returns the visits listed by iterPatientVisits, as a list of (patient ID, visit) tuples.
+        """
+        with self.reading() as patients:
+            return [(patient, list(visit)) for patient, visit in iterPatientVisits(patients, patientId, offset, limit)]
+
+    def visitsByDate(self, year=None, month=None, offset=0, limit=None):
+        """
+        Returns the visits listed by iterVisitsByDate, as a list of (patient ID, visit) tuples.
+        """
+        with self.reading() as patients:
+            return [(patient, list(visit)) for patient, visit in iterVisitsByDate(patients, year, month, offset, limit)]
+
+    def stats(self, patientId=0, full=False):
+        """
+        Returns the statistics of the vital signs of a patient, or of every patient if patientId is 0. For a VisitStore,
+        only the mean and standard deviation are given, from the running totals (see runningVitalStats), unless full is
+        True. Otherwise every statistic is computed (see computeVitalStats). Raises KeyError if the patient is not found.
+        """
+        with self.reading() as patients:
+            if patientId != 0 and patientId not in patients:
+                raise KeyError(patientId)
+            if isinstance(patients, VisitStore) and not full:
+                return runningVitalStats(patients, None if patientId == 0 else patientId)
+            return computeVitalStats(patients, None if patientId == 0 else [patientId])
+
+    def followUps(self, rules=FOLLOW_UP_RULES):
+        """
+        Returns the patients who need a follow-up visit, as listed by screenPatients.
+        """
+        with self.reading() as patients:
+            return screenPatients(patients, rules)
+
+    # The methods below change the patients and the patient file.
+
+    def addVisit(self, patientId, date, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Adds a visit with addPatientData, which prints whether it was saved.
+        """
+        with self.writing() as patients:
+            addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, self.fileName)
+
+    def addVisits(self, visits):
+        """
+        Adds many visits with bulkAddPatientData, returning its report.
+        """
+        with self.writing() as patients:
+            return bulkAddPatientData(patients, visits, self.fileName)
+
+    def deletePatient(self, patientId):
+        """
+        Deletes all visits of a patient with deleteAllVisitsOfPatient, which prints whether the patient was found.
+        """
+        with self.writing() as patients:
+            deleteAllVisitsOfPatient(patients, patientId, self.fileName)
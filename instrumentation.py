@@ -0,0 +1,229 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+# Environment variable which switches the metrics on. Its value is the name of the file the metrics are written to (see
+# Metrics.write), such as a file read by the Prometheus node exporter's textfile collector.
+METRICS_ENV = 'PATIENTS_METRICS'
+
+# Environment variable which starts profiling as soon as the menu starts. Its value is the start of the names of the
+# files the profile is saved to (see Profiler.stop).
+PROFILE_ENV = 'PATIENTS_PROFILE'
+
+# Prefix of the name of every metric exported.
+METRIC_PREFIX = 'patients_'
+
+# Description of each metric, exported as its HELP line.
+_HELP = {
+    'lines_parsed': 'Lines of patient data checked, from a patient file or a bulk import.',
+    'lines_rejected': 'Lines of patient data rejected as invalid, by reason.',
+    'visits_scanned': 'Visits looked at by queries.',
+    'bytes_written': 'Bytes written to patient files, snapshots and delete logs.',
+    'operation_seconds': 'Time spent in each operation.',
+    'operation_max_seconds': 'Longest time spent in a single call of each operation.',
+    'request_seconds': 'Time spent answering server requests, by endpoint and status.',
+    'request_max_seconds': 'Longest time spent answering a single server request.',
+}
+
+# Number of lines of the profile report shown for the slowest functions and for the largest memory allocations.
+PROFILE_REPORT_LINES = 15
+
+
+class Metrics:
+    """
+    Counts what the program does (lines parsed and rejected, visits scanned, bytes written) and times its operations,
+    so that a slow menu or server can be looked into without a debugger. Nothing is recorded unless the metrics are
+    enabled, and the code being measured only records totals once per call rather than once per visit, so the metrics
+    cost almost nothing either way.
+
+    Every counter and timer has a name and optional labels, such as operation='findVisitsByDate'. The metrics can be
+    exported in the Prometheus text format with export.
+    """
+
+    def __init__(self, enabled=False, fileName=None):
+        # True while the metrics are being recorded.
+        self.enabled = enabled
+        # The file write saves the metrics to when no other file is given, or None.
+        self.fileName = fileName
+        # Dictionary mapping each (name, labels) pair of a counter to its value. labels is a sorted tuple of (label,
+        # value) pairs.
+        self._counters = {}
+        # Dictionary mapping each (name, labels) pair of a timer to a list [number of calls, total seconds, longest
+        # call in seconds].
+        self._timers = {}
+        # Guards the counters and timers, which may be updated by several threads (see SharedPatients).
+        self._lock = threading.Lock()
+
+    def enable(self, enabled=True):
+        """
+        Starts or stops recording. The values recorded so far are kept.
+        """
+        self.enabled = enabled
+
+    def reset(self):
+        """
+        Sets every counter and timer back to zero.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def count(self, name, amount=1, **labels):
+        """
+        Adds to a counter, if the metrics are enabled.
+
+        name: The name of the counter, such as 'lines_parsed'.
+        amount: The amount to add.
+        labels: The labels of the counter, such as source='file'.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records the time taken by one call of an operation, if the metrics are enabled.
+
+        name: The name of the timer, such as 'operation'.
+        seconds: The time taken.
+        labels: The labels of the timer, such as operation='displayStats'.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self._timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def timed(self, operation):
+        """
+        Decorator which records the time taken by every call of a function under the 'operation' timer.
+
+        operation: The name the function's calls are recorded under.
+        """
+        def decorate(function):
+            @functools.wraps(function)
+            def timedFunction(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe('operation', time.perf_counter() - start, operation=operation)
+            return timedFunction
+        return decorate
+
+    def snapshot(self):
+        """
+        Returns a dictionary with a copy of the 'counters', mapping each (name, labels) pair to its value, and of the
+        'timers', mapping each (name, labels) pair to a tuple (number of calls, total seconds, longest call).
+        """
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'timers': {key: tuple(timer) for key, timer in self._timers.items()}}
+
+    def export(self):
+        """
+        Returns the metrics in the Prometheus text format. Counters are exported with the suffix '_total', and each
+        timer as the '_seconds_count' and '_seconds_sum' of a summary along with a '_max_seconds' gauge.
+        """
+        values = self.snapshot()
+        # Groups the lines of each metric, so each has a single HELP and TYPE line.
+        metrics = {}
+        for (name, labels), value in sorted(values['counters'].items()):
+            metrics.setdefault((name, 'counter'), []).append((name + '_total', labels, value))
+        for (name, labels), (calls, total, longest) in sorted(values['timers'].items()):
+            metrics.setdefault((name + '_seconds', 'summary'), []).extend(
+                [(name + '_seconds_count', labels, calls), (name + '_seconds_sum', labels, total)])
+            metrics.setdefault((name + '_max_seconds', 'gauge'), []).append((name + '_max_seconds', labels, longest))
+
+        lines = []
+        for (name, kind), samples in metrics.items():
+            if name in _HELP:
+                lines.append('# HELP %s%s %s' % (METRIC_PREFIX, name, _HELP[name]))
+            lines.append('# TYPE %s%s %s' % (METRIC_PREFIX, name, kind))
+            for sampleName, labels, value in samples:
+                labelText = ','.join('%s="%s"' % (label, str(labelValue).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for label, labelValue in labels)
+                lines.append('%s%s%s %s' % (METRIC_PREFIX, sampleName, '{%s}' % labelText if labelText else '',
+                                            repr(float(value)) if isinstance(value, float) else value))
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, fileName=None):
+        """
+        Writes the metrics in the Prometheus text format to a file. The metrics are written to a temporary file which
+        then replaces the file, so a reader never sees them half written.
+
+        fileName: The name of the file to write, or None for the file given when the metrics were created.
+        """
+        fileName = fileName or self.fileName
+        tempName = fileName + '.tmp'
+        with open(tempName, 'w') as writeFile:
+            writeFile.write(self.export())
+        os.replace(tempName, fileName)
+
+
+# The metrics recorded by every module of the program. They are enabled if the PATIENTS_METRICS environment variable is
+# set when the program starts.
+metrics = Metrics(bool(os.environ.get(METRICS_ENV)), os.environ.get(METRICS_ENV) or None)
+
+
+class Profiler:
+    """
+    Captures a cProfile profile of where the time goes, and a tracemalloc record of where memory is allocated, between
+    a call to start and a call to stop. Both slow the program down, so they are only used while looking into a problem.
+    """
+
+    def __init__(self, fileName):
+        # The start of the names of the files the results are saved to.
+        self.fileName = fileName
+        self._profile = None
+
+    @property
+    def running(self):
+        """
+        True between a call to start and the call to stop.
+        """
+        return self._profile is not None
+
+    def start(self):
+        """
+        Starts profiling and tracing memory allocations.
+        """
+        tracemalloc.start()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        """
+        Stops profiling, and saves the results: the profile to fileName + '.prof', which can be opened with pstats or
+        tools such as snakeviz, and the lines of code which allocated the most memory to fileName + '.memory.txt'.
+        Returns a report of the slowest functions and the largest allocations, PROFILE_REPORT_LINES of each.
+        """
+        self._profile.disable()
+        self._profile.dump_stats(self.fileName + '.prof')
+        allocations = tracemalloc.take_snapshot().statistics('lineno')
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        report = io.StringIO()
+        pstats.Stats(self._profile, stream=report).sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+        self._profile = None
+        memoryReport = ['Peak traced memory: %d bytes' % peak] + [str(allocation) for allocation in allocations]
+        with open(self.fileName + '.memory.txt', 'w') as writeFile:
+            writeFile.write('\n'.join(memoryReport) + '\n')
+        report.write('Largest memory allocations still held:\n')
+        report.write('\n'.join(memoryReport[:PROFILE_REPORT_LINES + 1]) + '\n')
+        report.write("The profile was saved to '%s.prof' and '%s.memory.txt'.\n" % (self.fileName, self.fileName))
+        return report.getvalue()
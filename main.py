@@ -1,16 +1,88 @@
+import os
+from array import array
+from bisect import insort
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from typing import List, Dict, Optional
 
+from visitstore import VITAL_TYPECODES, VITALS, VisitStore, decodeDate, encodeDate
+from instrumentation import PROFILE_ENV, Profiler, metrics
+from offsetindex import OffsetIndex, tailChecksum
+from querycache import QueryCache
+from screening import FOLLOW_UP_RULES, FollowUpMonitor, loadRules, screenPatients
+from trends import TrendAnalyzer, computeTrends, formatTrends
+from validation import checkVisit, convertFields, failedChecks, parseLine, rejectMessage, visitRecords
+from vitalstats import computeVitalStats, runningVitalStats
 
-def readPatientsFromFile(fileName):
+
+# Number of visits that can be appended to a patient file before the file is forced onto the disk with os.fsync. A value
+# of 1 makes every saved visit durable as soon as addPatientData returns. Larger values group several visits into one
+# (slow) disk flush, at the cost of possibly losing up to that many recent visits if the machine loses power.
+FSYNC_BATCH_SIZE = 1
+
+# Dictionary which keeps track of how many appended visits have not yet been forced onto the disk for each file name.
+_unsyncedAppends = {}
+
+# Files smaller than this many bytes are read by readPatientsFromFileParallel in a single process, since starting the
+# worker processes would take longer than reading the file.
+PARALLEL_LOAD_MIN_BYTES = 8 * 1024 * 1024
+
+# Number of patients whose visits readPatientVisits keeps in memory. Once more patients have been read, the patient
+# read least recently is dropped.
+PATIENT_CACHE_SIZE = 256
+
+# Ordered dictionary mapping (file name, patient ID) to the visits of each patient kept by readPatientVisits, along
+# with the version of the file they were read from, from least to most recently read.
+_patientCache = OrderedDict()
+
+# Dictionary mapping each patient file name to its OffsetIndex, once readPatientVisits has opened it.
+_offsetIndexes = {}
+
+# Number of visits shown at a time when the menu lists visits by date, before asking whether to show more.
+VISITS_PER_PAGE = 20
+
+# Number of delete records that can build up in a patient file's delete log before deleteAllVisitsOfPatient compacts
+# the file automatically. Set to 0 to only compact when compactPatientsFile is called.
+COMPACTION_THRESHOLD = 1000
+
+# Dictionary which keeps track of how many delete records are in the delete log of each file name.
+_deleteLogRecords = {}
+
+# Number of visits formatted into one block of text, and written with one write call, when a whole patient file is
+# rewritten by writePatientsFile.
+REWRITE_BATCH_VISITS = 8192
+
+# Format of a line of a patient file: the patient ID and then each value of the visit, converted with str().
+_VISIT_LINE = '%s,%s,%s,%s,%s,%s,%s,%s\n'
+
+# Number of messages printed for the invalid lines of a file when it is read. The rest are only counted, so that a file
+# with many invalid lines is not slowed down by printing them all. Every invalid line can still be listed by passing a
+# list for the rejects to readPatientsFromFile.
+MAX_PRINTED_REJECTS = 20
+
+# JSON file of follow-up rules (see screening.FOLLOW_UP_RULES) used by the menu instead of the default rules, if it
+# exists.
+FOLLOW_UP_RULES_FILE = 'followup_rules.json'
+
+# Start of the names of the files the menu saves a profile to, unless the PATIENTS_PROFILE environment variable gives
+# another (see instrumentation.Profiler).
+PROFILE_FILE = 'patients_profile'
+
+
+@metrics.timed('readPatientsFromFile')
+def readPatientsFromFile(fileName, rejects=None):
     """
     Reads patient data from a plaintext file. Each line in the file stores a list of values separated by a comma.
     The first element on each line is the patient ID, and the rest of the elements contain information regarding the
-    visit. Returns a dictionary with the key being the patient ID and the corresponding value being a two-dimensional
-    list containing sub-lists that store data from each visit.
+    visit. Returns a VisitStore, which works like a dictionary with the key being the patient ID and the corresponding
+    value being a two-dimensional list containing sub-lists that store data from each visit. The visits are stored in
+    typed columns instead of lists, which takes up far less memory for large files. Each patient's visits are sorted
+    by date once they have all been read, whatever order they are in the file.
 
     fileName: The name of the file to read patient data from.
-    Returns a dictionary of patient IDs, where each patient has a list of visits.
-    The dictionary has the following structure:
+    Returns a VisitStore of patient IDs, where each patient has a list of visits.
+    The VisitStore can be used as a dictionary with the following structure:
     {
         patientId (int): [
             [date (str), temperature (float), heart rate (int), respiratory rate (int), systolic blood pressure (int), diastolic blood pressure (int), oxygen saturation (int)],
@@ -23,169 +95,25 @@ def readPatientsFromFile(fileName):
         ],
         ...
     }
+
+    If the file has a delete log (written by deleteAllVisitsOfPatient), the log is replayed while the file is read, so
+    the visits of deleted patients are left out.
+
+    Every line is checked with validation.parseLine. Invalid lines are skipped, and once the file has been read, the
+    messages for the first MAX_PRINTED_REJECTS of them are printed along with how many there were in all.
+    rejects: A list to add a dictionary to for each invalid line, or None. Each dictionary has the byte 'offset' of the
+    line in the file, the 'patientId' (or None if it could not be read), the 'reason' (see validation.rejectMessage)
+    and the 'message'.
     """
-    # Defines a dictionary variable that will store each patient ID and the data associated with their corresponding
-    # visits.
-    patients = {}
+    # Reads the delete log of the file. deletedBefore maps each deleted patient ID to the size of the file when the
+    # patient was deleted, so any of their visits written before that point are skipped.
+    deletedBefore = _readDeleteLog(fileName)
 
     # try-except statement which attempts to open a text file, and catches any IOError that occurs when trying to open
     # the file.
     try:
-        # Uses with to open a given text file, read from it, and eventually close it when finished. Names the file
-        # object as readFile.
-        with open(fileName, 'r') as readFile:
-            # Try statement meant to catch any unprecedented errors that occur when reading from the file.
-            try:
-                # Reads the first line from the file and stores it in a string variable, currentLine.
-                currentLine = readFile.readline()
-
-                # While loop which repeats as long as the current line in the file is not an empty string (the end of
-                # the file has not been reached).
-                while currentLine != '':
-
-                    # Strips the whitespace character \n from the end of the current line.
-                    currentLine = currentLine.strip()
-                    # Stores the original line as a string in a new variable, originalLineString
-                    originalLineString = currentLine
-                    # Splits each element of the current line string into a list using the comma as a delimiter. The
-                    # variable currentLine, which was previously a string, is now a list variable.
-                    currentLine = currentLine.split(',')
-
-                    # Checks if the correct number of elements exist within the list. After the split, there should be
-                    # 8 different elements. Otherwise, there is an invalid number of fields in the line and something
-                    # is therefore incorrect in the data file.
-                    if len(currentLine) != 8:
-                        # Prints a message to the user saying there is an incorrect number of fields in the current line
-                        print('Invalid number of fields (%d) in line: %s' % (len(currentLine), originalLineString))
-                        # Reads the next line in the file.
-                        currentLine = readFile.readline()
-                        # Proceeds to the start of the while loop.
-                        continue
-
-                    # Additional try statement which attempts to convert each element within the currentLine list into
-                    # its correct data type. If any ValueError occurs when trying to do this, this means that the
-                    # corresponding element within the list was not of the correct data type, and this exception will
-                    # be handled.
-                    try:
-                        # Converts each element within the list (which are currently all string variables) into their
-                        # corresponding data type.
-                        currentLine[0] = int(currentLine[0])
-                        currentLine[2] = float(currentLine[2])
-                        currentLine[3] = int(currentLine[3])
-                        currentLine[4] = int(currentLine[4])
-                        currentLine[5] = int(currentLine[5])
-                        currentLine[6] = int(currentLine[6])
-                        currentLine[7] = int(currentLine[7])
-
-                        # Creates a list variable that is used to check if the date was given in the correct format by
-                        # splitting the date string using '-' as a delimiter.
-                        checkDate = currentLine[1].split('-')
-
-                        # If statement which checks to see if the date was given in the wrong format. The first element
-                        # of the date should be the year, and should be 4 characters long. The second element should
-                        # be the month, so it should be 2 characters long. The third element should be the day, so it
-                        # should also be 2 characters. Also, all elements should contain only numeric characters. If
-                        # any of these conditions are false, this branch will execute.
-                        if len(checkDate[0]) != 4 or checkDate[0].isdigit() == False or len(checkDate[1]) != 2 or checkDate[1].isdigit() == False or len(checkDate[2]) != 2 or checkDate[2].isdigit() == False:
-                            # Reads the next line in the file.
-                            currentLine = readFile.readline()
-                            # Moves to the start of the while loop.
-                            continue
-
-                        # If the month is greater than 12 or the day is greater than 31, moves on to the next line
-                        # and starts at the top of the while loop.
-                        if int(checkDate[1]) > 12 or int(checkDate[2]) > 31:
-                            currentLine = readFile.readline()
-                            continue
-
-                    # Catches any ValueErrors that occur when trying to convert each element of the currentLine list
-                    # into their corresponding data types.
-                    except:
-                        # Tells the user that invalid data was found on the current line
-                        print("Invalid data type in line: %s" % originalLineString)
-                        # Reads the next line
-                        currentLine = readFile.readline()
-                        # Moves to the start of the while loop.
-                        continue
-
-                    # If statement which executes if the given temperature is not between the range of 35 to 42.
-                    if currentLine[2] < 35 or currentLine[2] > 42:
-                        # Tells the user that the temperature on the given line is invalid.
-                        print(f"Invalid temperature value (%.2f) in line: %s" % (currentLine[2], originalLineString))
-                        # Reads the next line of the file and moves to the start of the while loop.
-                        currentLine = readFile.readline()
-                        continue
-                    # If statement which executes if the given heart rate is not between the range of 30 to 180.
-                    if currentLine[3] < 30 or currentLine[3] > 180:
-                        # Tells the user that the heart rate on the given line is invalid.
-                        print(f"Invalid heart rate value ({currentLine[3]}) in line: {originalLineString}")
-                        # Reads the next line of the file and moves to the start of the while loop.
-                        currentLine = readFile.readline()
-                        continue
-                    # If statement which executes if the given respirator rate is not between the range of 5 to 40.
-                    if currentLine[4] < 5 or currentLine[4] > 40:
-                        # Tells the user that the respiratory rate on the given line is invalid.
-                        print("Invalid respiratory rate value (%d) in line: %s" % (currentLine[4], originalLineString))
-                        # Reads the next line of the file and moves to the start of the while loop.
-                        currentLine = readFile.readline()
-                        continue
-                    # If statement which executes if the given systolic blood pressure is not between the range of 70
-                    # to 200.
-                    if currentLine[5] < 70 or currentLine[5] > 200:
-                        # Tells the user that the systolic blood pressure on the given line is invalid.
-                        print("Invalid systolic blood pressure value (%d) in line: %s" % (currentLine[5], originalLineString))
-                        # Reads the next line of the file and moves to the start of the while loop.
-                        currentLine = readFile.readline()
-                        continue
-                    # If statement which executes if the given diastolic blood pressure is not between the range of 40
-                    # to 120.
-                    if currentLine[6] < 40 or currentLine[6] > 120:
-                        # Tells the user that the diastolic blood pressure on the given line is invalid.
-                        print("Invalid diastolic blood pressure value (%d) in line: %s" % (currentLine[6], originalLineString))
-                        # Reads the next line of the file and moves to the start of the while loop.
-                        currentLine = readFile.readline()
-                        continue
-                    # If statement which executes if the given oxygen saturation is not between the range of 70 to 100.
-                    if currentLine[7] < 70 or currentLine[7] > 100:
-                        # Tells the user that the oxygen saturation on the given line is invalid.
-                        print("Invalid oxygen saturation value (%d) in line: %s" % (currentLine[7], originalLineString))
-                        # Reads the next line of the file and moves to the start of the while loop.
-                        currentLine = readFile.readline()
-                        continue
-
-                    # Creates a list variable to store the data from each visit. This list will be added to the
-                    # dictionary storing patient information under the key which corresponds to the patient.
-                    listToAdd = []
-
-                    # For loop which iterates 7 times. Adds the patients data relating to their visit to the list
-                    # variable. Does not add the element in index position 0, as this corresponds to the patient ID,
-                    # and it will instead be used as a key within the dictionary.
-                    for i in range(1, len(currentLine)):
-                        # Appends the ith element of the data to the list variable.
-                        listToAdd.append(currentLine[i])
-
-                    # If a key corresponding to the patient ID of the current line does not exist in the patients
-                    # dictionary, then a key will be created.
-                    if int(currentLine[0]) not in patients:
-                        # Creates a key corresponding to the patient ID on the current line and makes its associated
-                        # value an empty list.
-                        patients[int(currentLine[0])] = []
-                        # Appends the list of data from the visit on the current line to the list associated with the
-                        # patient ID key.
-                        patients[int(currentLine[0])].append(listToAdd)
-                    # This branch executes if a key already does exist for the patient ID of the current line.
-                    else:
-                        # Appends the list of data from the visit to the list associated with the patient ID key.
-                        patients[int(currentLine[0])].append(listToAdd)
-
-                    # Reads the next line of the file.
-                    currentLine = readFile.readline()
-
-            # Except statement which tells the user that an unexpected error occurs
-            except:
-                print("An unexpected error occurred while reading the file.")
-                # Reads the next line of the file.
-                currentLine = readFile.readline()
+        # Reads every valid visit in the file into columns, collecting the invalid lines.
+        visitColumns = _readVisitColumns(fileName, 0, None, deletedBefore)
 
     # Except statement which deals with any error that occurs when trying to open the file.
     except IOError:
@@ -193,11 +121,609 @@ def readPatientsFromFile(fileName):
         print("The file '%s' could not be found." % fileName)
         # Exits the program.
         exit()
+
+    # Defines a VisitStore variable that will store each patient ID and the data associated with their corresponding
+    # visits, and adds every visit read to it in one go.
+    patients = VisitStore()
+    patients.appendColumns(visitColumns['patientIds'], visitColumns['dates'], visitColumns['vitals'], {})
+    _reportRejects(fileName, visitColumns['rejects'], rejects)
+    _countLines('file', visitColumns['lineCount'], visitColumns['rejects'])
+
+    # If the file does not end with a newline character, its last line was either written without one or was cut off
+    # part way through an append. The file is repaired so that the next appended visit starts on a new line.
+    lastRawLine = visitColumns['lastRawLine']
+    if lastRawLine != b'' and not lastRawLine.endswith(b'\n'):
+        _repairTrailingLine(fileName, lastRawLine, visitColumns['lastLineValid'])
+
     # At the end of the function, the patients dictionary is returned, storing all of the data associated with each
     # visit for each patient.
     return patients
 
 
+@metrics.timed('loadPatients')
+def loadPatients(fileName, workers=None):
+    """
+    Loads patient data from a plaintext file as quickly as possible. If a binary snapshot of the file (written by
+    saveSnapshot) exists and the file and its delete log have not changed since, the snapshot is opened instead of
+    reading the file. Opening a snapshot only reads its table of patients; the visits themselves are read from the disk
+    as they are used. Otherwise, the file is read with readPatientsFromFileParallel and a new snapshot is saved.
+
+    fileName: The name of the file to read patient data from.
+    workers: The number of worker processes readPatientsFromFileParallel may use. If None, one for each CPU is used.
+    Returns a VisitStore of patient IDs, where each patient has a list of visits (see readPatientsFromFile).
+    """
+    # Opens the snapshot if it is still up to date with the file.
+    if os.path.exists(fileName):
+        snapshot = VisitStore.openSnapshot(_snapshotName(fileName))
+        if snapshot is not None and snapshot[1] == _sourceStamp(fileName):
+            # Counts the records in the delete log, which deleteAllVisitsOfPatient needs to know when to compact.
+            _readDeleteLog(fileName)
+            return snapshot[0]
+
+    # Otherwise, reads the file and saves a new snapshot of it for next time.
+    patients = readPatientsFromFileParallel(fileName, workers)
+    saveSnapshot(patients, fileName)
+    return patients
+
+
+@metrics.timed('saveSnapshot')
+def saveSnapshot(patients, fileName):
+    """
+    Saves a binary snapshot of a VisitStore next to the plaintext file it was read from, so that loadPatients can open
+    it the next time instead of reading the file. The snapshot is only used while the file and its delete log stay
+    exactly as they are now, so it should be saved when the VisitStore holds the same visits as the file.
+
+    patients: The VisitStore to save.
+    fileName: The name of the plaintext file the patients were read from.
+    """
+    try:
+        patients.writeSnapshot(_snapshotName(fileName), _sourceStamp(fileName))
+        if metrics.enabled:
+            metrics.count('bytes_written', os.path.getsize(_snapshotName(fileName)), operation='snapshot')
+    except OSError:
+        print("The snapshot of '%s' could not be saved." % fileName)
+
+
+def _snapshotName(fileName):
+    """
+    Returns the name of the binary snapshot that belongs to a patient file.
+
+    fileName: The name of the patient file.
+    """
+    return fileName + '.snap'
+
+
+def _sourceStamp(fileName):
+    """
+    Returns a tuple of 6 integers which changes whenever a patient file or its delete log is changed or replaced: the
+    file's ID, size and modification time, and the delete log's ID, size and modification time (0 if there is no log).
+
+    fileName: The name of the patient file.
+    """
+    fileStat = os.stat(fileName)
+    stamp = (fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns)
+    if os.path.exists(_deleteLogName(fileName)):
+        logStat = os.stat(_deleteLogName(fileName))
+        return stamp + (logStat.st_ino, logStat.st_size, logStat.st_mtime_ns)
+    return stamp + (0, 0, 0)
+
+
+@metrics.timed('readPatientVisits')
+def readPatientVisits(fileName, patientId):
+    """
+    Reads the visits of a single patient from a patient file, without reading the rest of the file. The first time a
+    file is used, an offset index of the lines of each patient is built and saved next to it (see OffsetIndex). After
+    that, only the patient's own lines are read and checked, so reading a patient takes time in proportion to the size
+    of the patient rather than the size of the file. The visits of the PATIENT_CACHE_SIZE patients read most recently
+    are kept in memory, until visits are appended to the patient, a patient is deleted or the file is replaced.
+
+    fileName: The name of the patient file.
+    patientId: The ID of the patient.
+    Returns a list of the patient's visits, sorted by date, in the same form as a patient's visits in the VisitStore
+    returned by readPatientsFromFile, or None if the patient has no visits in the file. The list is shared with later
+    calls, so it must not be changed. Raises OSError if the file cannot be read.
+    """
+    # Opens the offset index of the file the first time, and brings it up to date with any lines appended since.
+    if fileName in _offsetIndexes:
+        index = _offsetIndexes[fileName]
+        index.refresh()
+    else:
+        index = _offsetIndexes[fileName] = OffsetIndex(fileName)
+    ranges = index.ranges(patientId)
+
+    # The patient's visits are still up to date if they were read from the same version of the file and delete log,
+    # and no lines have been appended to the patient since.
+    key = (fileName, patientId)
+    version = (index.version, _sourceStamp(fileName)[3:])
+    if key in _patientCache:
+        cachedVersion, readSize, visits = _patientCache[key]
+        if cachedVersion == version and all(offset < readSize for offset, length in ranges):
+            _patientCache.move_to_end(key)
+            return visits
+
+    # Reads and checks each line of the patient, skipping any written before the patient was last deleted.
+    deletedBefore = _readDeleteLog(fileName).get(patientId, 0)
+    encodedVisits = []
+    with open(fileName, 'rb') as readFile:
+        for offset, length in ranges:
+            if offset + length <= deletedBefore:
+                continue
+            readFile.seek(offset)
+            lineStart = offset
+            # Splits the range into its lines in the same way as reading the file line by line does.
+            for rawLine in [line + b'\n' for line in readFile.read(length).split(b'\n')[:-1]]:
+                lineId, encodedDate, values, reason, message = parseLine(rawLine)
+                if values is not None and lineId == patientId and lineStart >= deletedBefore:
+                    encodedVisits.append((encodedDate, values))
+                lineStart += len(rawLine)
+    metrics.count('visits_scanned', len(encodedVisits), operation='readPatientVisits')
+
+    # Sorts the visits by date. The sort is stable, so visits on the same date stay in file order.
+    encodedVisits.sort(key=lambda encodedVisit: encodedVisit[0])
+    visits = [[decodeDate(encodedDate)] + values for encodedDate, values in encodedVisits] or None
+
+    # Keeps the visits, dropping the patient read least recently if the cache is full.
+    _patientCache[key] = (version, index.indexedSize, visits)
+    _patientCache.move_to_end(key)
+    while len(_patientCache) > PATIENT_CACHE_SIZE:
+        _patientCache.popitem(last=False)
+    return visits
+
+
+@metrics.timed('readPatientsFromFileParallel')
+def readPatientsFromFileParallel(fileName, workers=None, rejects=None):
+    """
+    Reads patient data from a plaintext file in the same way as readPatientsFromFile, but splits the file into pieces
+    which are read at the same time by a pool of worker processes. Each piece starts and ends on a line boundary. The
+    visits from each piece are then combined in file order, so the result, and the invalid lines reported, are the same
+    as readPatientsFromFile's. Small files are simply read with readPatientsFromFile.
+
+    fileName: The name of the file to read patient data from.
+    workers: The number of worker processes to use. If None, one for each CPU is used.
+    rejects: A list to add a dictionary to for each invalid line, or None (see readPatientsFromFile).
+    Returns a VisitStore of patient IDs, where each patient has a list of visits (see readPatientsFromFile).
+    """
+    # Finds the size of the file. A missing file is left to readPatientsFromFile, which tells the user.
+    try:
+        fileSize = os.path.getsize(fileName)
+    except OSError:
+        fileSize = 0
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # A small file, or a single worker, is read without any worker processes.
+    if workers <= 1 or fileSize < PARALLEL_LOAD_MIN_BYTES:
+        return readPatientsFromFile(fileName, rejects)
+
+    # Reads the delete log, which each worker needs to skip the visits of deleted patients.
+    deletedBefore = _readDeleteLog(fileName)
+
+    # Splits the file into a few pieces per worker, so that a slow piece does not hold up the others for long.
+    boundaries = _chunkBoundaries(fileName, fileSize, workers * 4)
+    starts = boundaries[:-1]
+    ends = boundaries[1:]
+
+    # Reads every piece in the pool of worker processes. map returns the results in the same order as the pieces.
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_readVisitColumns, [fileName] * len(starts), starts, ends,
+                                    [deletedBefore] * len(starts)))
+
+    # Combines the columns and the invalid lines of every piece, in file order.
+    patientIds = array('q')
+    dates = array('i')
+    vitals = [array(typecode) for typecode in VITAL_TYPECODES]
+    pieceRejects = []
+    lineCount = 0
+    for result in results:
+        pieceRejects.extend(result['rejects'])
+        lineCount += result['lineCount']
+        patientIds.extend(result['patientIds'])
+        dates.extend(result['dates'])
+        for column, values in zip(vitals, result['vitals']):
+            column.extend(values)
+
+    # Builds the store from the combined columns.
+    patients = VisitStore()
+    patients.appendColumns(patientIds, dates, vitals, {})
+    _reportRejects(fileName, pieceRejects, rejects)
+    _countLines('file', lineCount, pieceRejects)
+
+    # Repairs the end of the file if its last line has no newline character, as readPatientsFromFile does.
+    lastRawLine = results[-1]['lastRawLine'] if results else b''
+    if lastRawLine != b'' and not lastRawLine.endswith(b'\n'):
+        _repairTrailingLine(fileName, lastRawLine, results[-1]['lastLineValid'])
+    return patients
+
+
+def _chunkBoundaries(fileName, fileSize, pieces):
+    """
+    Splits a file into roughly equal pieces which each start at the beginning of a line.
+
+    fileName: The name of the file to split.
+    fileSize: The size of the file in bytes.
+    pieces: The number of pieces to aim for. Fewer pieces are returned if some would be empty.
+    Returns a list of byte positions, starting with 0 and ending with fileSize, where each piece runs from one position
+    up to the next.
+    """
+    boundaries = [0]
+    with open(fileName, 'rb') as readFile:
+        for piece in range(1, pieces):
+            # Moves from an evenly spaced position to the start of the next line.
+            position = fileSize * piece // pieces
+            if position <= boundaries[-1]:
+                continue
+            readFile.seek(position - 1)
+            readFile.readline()
+            position = readFile.tell()
+            if boundaries[-1] < position < fileSize:
+                boundaries.append(position)
+    boundaries.append(fileSize)
+    return boundaries
+
+
+def _readVisitColumns(fileName, start, end, deletedBefore):
+    """
+    Reads the valid visits from part of a patient file into columns. Used by readPatientsFromFile for the whole file,
+    and by the worker processes of readPatientsFromFileParallel for each piece of the file.
+
+    fileName: The name of the file to read.
+    start: The byte position to start reading from. Must be at the start of a line.
+    end: The byte position to stop reading at, or None to read to the end of the file. Must be at the start of a line.
+    deletedBefore: The deleted patients, as returned by _readDeleteLog.
+    Returns a dictionary holding the columns of the visits read ('patientIds', 'dates' and 'vitals', in the form taken
+    by VisitStore.appendColumns), the 'rejects' for invalid lines (see readPatientsFromFile), the number of lines read
+    ('lineCount'), and the 'lastRawLine' read (as bytes) along with whether it was valid ('lastLineValid').
+    """
+    # Columns which will store the valid visits.
+    patientIds = array('q')
+    dates = array('i')
+    vitals = [array(typecode) for typecode in VITAL_TYPECODES]
+    rejects = []
+    lineCount = 0
+    lastRawLine = b''
+    lastLineValid = False
+
+    # Opens the file in binary mode, so the position of each line in the file is known exactly.
+    with open(fileName, 'rb') as readFile:
+        readFile.seek(start)
+        # Byte position in the file where the next line starts.
+        nextLineStart = start
+        lineStart = start
+        # Try statement meant to catch any unprecedented errors that occur when reading from the file.
+        try:
+            # Goes through the lines of the file until the end position is reached.
+            for rawLine in readFile:
+                lineStart = nextLineStart
+                nextLineStart += len(rawLine)
+                lastRawLine = rawLine
+                lineCount += 1
+
+                # Checks the line and converts it into a patient ID, an encoded date and the vital signs. If the line
+                # is invalid, it is added to the rejects.
+                patientId, encodedDate, values, reason, message = parseLine(rawLine)
+                lastLineValid = values is not None
+                if values is None:
+                    rejects.append({'offset': lineStart, 'patientId': patientId, 'reason': reason, 'message': message})
+
+                # Adds a valid visit to the columns, unless the patient was deleted after this line was written.
+                elif not (patientId in deletedBefore and lineStart < deletedBefore[patientId]):
+                    patientIds.append(patientId)
+                    dates.append(encodedDate)
+                    for column, value in zip(vitals, values):
+                        column.append(value)
+
+                # Stops once the end of the part being read has been reached.
+                if end is not None and nextLineStart >= end:
+                    break
+        # Except statement which reports that an unexpected error occurred. The rest of the file is not read.
+        except Exception:
+            rejects.append({'offset': lineStart, 'patientId': None, 'reason': 'error',
+                            'message': "An unexpected error occurred while reading the file."})
+
+    return {'patientIds': patientIds, 'dates': dates, 'vitals': vitals, 'rejects': rejects, 'lineCount': lineCount,
+            'lastRawLine': lastRawLine, 'lastLineValid': lastLineValid}
+
+
+def _reportRejects(fileName, found, rejects):
+    """
+    Reports the invalid lines found while reading a patient file, printing the messages for the first
+    MAX_PRINTED_REJECTS of them and how many more there were.
+
+    fileName: The name of the file which was read.
+    found: The dictionary of each invalid line found, in file order (see readPatientsFromFile).
+    rejects: A list to add the dictionaries to, or None.
+    """
+    for reject in found[:MAX_PRINTED_REJECTS]:
+        print(reject['message'])
+    if len(found) > MAX_PRINTED_REJECTS:
+        print("... and %d more invalid lines in '%s'." % (len(found) - MAX_PRINTED_REJECTS, fileName))
+    if rejects is not None:
+        rejects.extend(found)
+
+
+def _countLines(source, lineCount, rejects):
+    """
+    Counts the lines of patient data checked and rejected, by reason, in the metrics (see instrumentation).
+
+    source: Where the lines came from: 'file' for a patient file, or 'bulk' for bulkAddPatientData.
+    lineCount: The number of lines checked.
+    rejects: The dictionary of each line rejected, holding its 'reason'.
+    """
+    if metrics.enabled:
+        metrics.count('lines_parsed', lineCount, source=source)
+        for reason, amount in Counter(reject['reason'] for reject in rejects).items():
+            metrics.count('lines_rejected', amount, source=source, reason=reason)
+
+
+def _repairTrailingLine(fileName, lastRawLine, accepted):
+    """
+    Repairs the end of a patient file whose last line has no newline character. If the line held a complete, valid
+    visit, the missing newline is added. Otherwise the line is a partly written visit left behind by an interrupted
+    append, and it is cut off the end of the file.
+
+    fileName: The name of the patient file to repair.
+    lastRawLine: The last line of the file, exactly as it was read, as bytes.
+    accepted: True if the last line was read as a valid visit.
+    """
+    # Opens the file in binary mode so that it can be both extended and truncated.
+    with open(fileName, 'r+b') as repairFile:
+        # If the last line was a valid visit, only the newline character is missing, so it is added to the end.
+        if accepted:
+            repairFile.seek(0, os.SEEK_END)
+            repairFile.write(b'\n')
+        # Otherwise the partly written line is removed by truncating the file where the line begins.
+        else:
+            repairFile.seek(0, os.SEEK_END)
+            repairFile.truncate(repairFile.tell() - len(lastRawLine))
+            print("Discarded a partly written line at the end of '%s': %s" % (fileName, lastRawLine.decode(errors='replace')))
+        # Forces the repair onto the disk.
+        repairFile.flush()
+        os.fsync(repairFile.fileno())
+
+
+def appendVisitToFile(fileName, patientId, visit):
+    """
+    Appends a single visit to the end of a patient file, instead of rewriting the whole file. The line is written with
+    one write call so that an interrupted append can leave at most one partly written line, which readPatientsFromFile
+    removes the next time the file is read. The file is forced onto the disk every FSYNC_BATCH_SIZE appends.
+
+    fileName: The name of the file to append the visit to.
+    patientId: The ID of the patient the visit belongs to.
+    visit: A list storing the visit data [date, temperature, heart rate, respiratory rate, systolic blood pressure,
+    diastolic blood pressure, oxygen saturation].
+    """
+    # Builds the line for the visit in the same format used by the rest of the file.
+    line = str(patientId) + ',' + ','.join(str(value) for value in visit) + '\n'
+    _appendLines(fileName, line, 1)
+
+
+def _appendLines(fileName, lines, visitCount):
+    """
+    Appends complete lines to the end of a patient file with one write call. The file is forced onto the disk once
+    FSYNC_BATCH_SIZE visits have been appended since it was last forced onto the disk.
+
+    fileName: The name of the file to append to.
+    lines: The lines to append, as a string ending with a newline character.
+    visitCount: The number of visits in the lines.
+    """
+    # Opens the file for appending (and reading, so the last character can be checked).
+    with open(fileName, 'a+b') as appendFile:
+        # If the file does not end with a newline character, one is written first so the new visits start on their own
+        # line.
+        appendFile.seek(0, os.SEEK_END)
+        if appendFile.tell() > 0:
+            appendFile.seek(-1, os.SEEK_END)
+            if appendFile.read(1) != b'\n':
+                lines = '\n' + lines
+        # Writes all the lines at once and hands them to the operating system.
+        data = lines.encode()
+        appendFile.write(data)
+        appendFile.flush()
+        metrics.count('bytes_written', len(data), operation='append')
+
+        # Counts the visits as not yet forced onto the disk, and forces the file onto the disk once the batch is full.
+        _unsyncedAppends[fileName] = _unsyncedAppends.get(fileName, 0) + visitCount
+        if _unsyncedAppends[fileName] >= FSYNC_BATCH_SIZE:
+            os.fsync(appendFile.fileno())
+            _unsyncedAppends[fileName] = 0
+
+
+def syncPatientsFile(fileName):
+    """
+    Forces any visits appended to a patient file, but not yet written to the disk because of FSYNC_BATCH_SIZE, onto the
+    disk. Does nothing if there are no such visits.
+
+    fileName: The name of the patient file to force onto the disk.
+    """
+    # Only opens the file if some appended visits have not been forced onto the disk yet.
+    if _unsyncedAppends.get(fileName, 0) > 0 and os.path.exists(fileName):
+        with open(fileName, 'rb') as syncFile:
+            os.fsync(syncFile.fileno())
+    _unsyncedAppends[fileName] = 0
+
+
+def _deleteLogName(fileName):
+    """
+    Returns the name of the delete log that belongs to a patient file.
+
+    fileName: The name of the patient file.
+    """
+    return fileName + '.log'
+
+
+def _readDeleteLog(fileName):
+    """
+    Reads the delete log of a patient file. Each line in the log is a delete record in the format
+    'DELETE,patientId,fileSize,fileId,checksum', where fileSize is the size of the patient file when the patient was
+    deleted, fileId is the inode of the file and checksum is a checksum of the bytes just before fileSize. A record is
+    only replayed when both the inode and the checksum still match the file, so records left over from a version of
+    the file that has since been replaced by a compaction are ignored even when the new version reuses the inode.
+    Partly written records are ignored too, and records written before the checksum was added are checked by inode.
+
+    fileName: The name of the patient file whose delete log should be read.
+    Returns a dictionary mapping each deleted patient ID to the file size when they were last deleted.
+    """
+    # Dictionary which will store the deleted patient IDs.
+    deletedBefore = {}
+    # Number of records found in the log.
+    records = 0
+
+    # Reads the log only if both it and the patient file exist.
+    if os.path.exists(_deleteLogName(fileName)) and os.path.exists(fileName):
+        # Identifies the current version of the patient file.
+        fileStat = os.stat(fileName)
+        fileId = fileStat.st_ino
+        # Checksum of the file at each recorded size, worked out once per size.
+        checksums = {}
+        with open(_deleteLogName(fileName), 'r') as logFile, open(fileName, 'rb') as readFile:
+            # Loops through each record in the log.
+            for record in logFile:
+                fields = record.strip().split(',')
+                # Skips any record which is not a complete delete record.
+                if len(fields) not in (4, 5) or fields[0] != 'DELETE' or not record.endswith('\n'):
+                    continue
+                try:
+                    patientId = int(fields[1])
+                    fileSize = int(fields[2])
+                    recordFileId = int(fields[3])
+                    checksum = int(fields[4]) if len(fields) == 5 else None
+                except ValueError:
+                    continue
+                records += 1
+                # Only records written against the current version of the file are replayed.
+                if recordFileId != fileId or fileSize > fileStat.st_size:
+                    continue
+                if checksum is not None:
+                    if fileSize not in checksums:
+                        checksums[fileSize] = tailChecksum(readFile, fileSize)
+                    if checksums[fileSize] != checksum:
+                        continue
+                deletedBefore[patientId] = max(fileSize, deletedBefore.get(patientId, 0))
+
+    # Remembers how many records the log holds, so deleteAllVisitsOfPatient knows when to compact the file.
+    _deleteLogRecords[fileName] = records
+    return deletedBefore
+
+
+def _appendDeleteRecord(fileName, patientId):
+    """
+    Writes a delete record for a patient to the delete log of a patient file and forces it onto the disk. This is the
+    only write needed to delete a patient; the patient file itself is not touched.
+
+    fileName: The name of the patient file the patient was deleted from.
+    patientId: The ID of the deleted patient.
+    """
+    # Makes sure every visit already appended to the file is on the disk before a record that refers to it is.
+    syncPatientsFile(fileName)
+
+    # Finds the current size and version of the patient file. A missing file is treated as empty.
+    try:
+        with open(fileName, 'rb') as readFile:
+            fileStat = os.fstat(readFile.fileno())
+            fileSize, fileId = fileStat.st_size, fileStat.st_ino
+            checksum = tailChecksum(readFile, fileSize)
+    except FileNotFoundError:
+        fileSize, fileId, checksum = 0, 0, 0
+
+    # Writes the record in one write call and forces it onto the disk.
+    record = 'DELETE,%d,%d,%d,%d\n' % (patientId, fileSize, fileId, checksum)
+    with open(_deleteLogName(fileName), 'a') as logFile:
+        logFile.write(record)
+        logFile.flush()
+        os.fsync(logFile.fileno())
+    metrics.count('bytes_written', len(record), operation='deleteLog')
+    _deleteLogRecords[fileName] = _deleteLogRecords.get(fileName, 0) + 1
+
+
+def _discardDeleteLog(fileName):
+    """
+    Removes the delete log of a patient file. Called once the patient file has been rewritten without the deleted
+    patients, since the records no longer apply to it.
+
+    fileName: The name of the patient file whose delete log should be removed.
+    """
+    if os.path.exists(_deleteLogName(fileName)):
+        os.remove(_deleteLogName(fileName))
+    _deleteLogRecords[fileName] = 0
+
+
+@metrics.timed('compactPatientsFile')
+def compactPatientsFile(patients, fileName):
+    """
+    Compacts a patient file by writing a clean copy of it from the patients dictionary, which no longer holds any deleted
+    patients, and then removing the delete log (see writePatientsFile).
+
+    patients: The dictionary of patient IDs, where each patient has a list of visits, to write to the file.
+    fileName: The name of the patient file to compact.
+    """
+    writePatientsFile(patients, fileName, 'compact')
+
+
+def writePatientsFile(patients, fileName, operation='rewrite'):
+    """
+    Rewrites a whole patient file from the patients dictionary. The lines are formatted REWRITE_BATCH_VISITS visits at
+    a time, and each block of lines is written with a single write call. The file is written to a temporary file, forced
+    onto the disk, and then renamed over the patient file, so the patient file is never left half written or empty if
+    the program stops part way through. The delete log is removed afterwards, since the file no longer holds any deleted
+    patients; if the program stops between the two steps, the leftover records belong to the old version of the file
+    and are ignored, even if the new version is given the same inode.
+
+    patients: The dictionary of patient IDs, where each patient has a list of visits, to write to the file.
+    fileName: The name of the patient file to write.
+    operation: What the file is written for, recorded with the bytes written: 'rewrite' or 'compact'.
+    """
+    # Name of the temporary file the copy is written to.
+    tempName = fileName + '.tmp'
+
+    # Writes every visit of every patient to the temporary file, a block of lines at a time.
+    with open(tempName, 'w') as writeFile:
+        for block in _visitBlocks(patients):
+            writeFile.write(block)
+        # Forces the copy onto the disk before it replaces the patient file.
+        writeFile.flush()
+        os.fsync(writeFile.fileno())
+
+    # Replaces the patient file with the copy, which holds every appended visit, and removes the delete log.
+    os.replace(tempName, fileName)
+    _unsyncedAppends[fileName] = 0
+    _discardDeleteLog(fileName)
+    _discardOffsetIndex(fileName)
+    if metrics.enabled:
+        metrics.count('bytes_written', os.path.getsize(fileName), operation=operation)
+
+
+def _discardOffsetIndex(fileName):
+    # Removes the offset index of a patient file which has just been written again, along with the patients read
+    # through it, since they belong to the old version of the file. The index is built again when it is next needed.
+    index = _offsetIndexes.pop(fileName, None)
+    if index is not None:
+        index.close()
+    for key in [key for key in _patientCache if key[0] == fileName]:
+        del _patientCache[key]
+    try:
+        os.remove(OffsetIndex.indexName(fileName))
+    except FileNotFoundError:
+        pass
+
+
+def _visitBlocks(patients):
+    # Yields the lines of the patient file for every visit of every patient, joined into blocks of up to
+    # REWRITE_BATCH_VISITS lines. A VisitStore formats the lines straight from its columns.
+    if isinstance(patients, VisitStore):
+        yield from patients.formatLines(_VISIT_LINE, REWRITE_BATCH_VISITS)
+        return
+    lines = []
+    for patient in patients:
+        for visit in patients[patient]:
+            lines.append(_VISIT_LINE % (patient, *visit))
+        if len(lines) >= REWRITE_BATCH_VISITS:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+@metrics.timed('displayPatientData')
 def displayPatientData(patients, patientId=0):
     """
     Displays patient data for a given patient ID. If the patient ID is equal to 0, displays data for all patients. If
@@ -255,33 +781,54 @@ def displayPatientData(patients, patientId=0):
             print( "Patient with ID %d not found." % patientId)
 
 
-def displayStats(patients, patientId=0):
+def iterPatientVisits(patients, patientId=0, offset=0, limit=None):
+    """
+    Yields the visits displayed by displayPatientData one at a time, as (patient ID, visit) tuples, so they can be
+    processed or shown one page at a time without copying them into a list. If patientId is 0, yields the visits of all
+    patients. If the patient ID is not found, nothing is yielded.
+
+    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient to yield visits for. If 0, the visits of all patients are yielded.
+    offset: The number of visits to skip before the first one yielded.
+    limit: The largest number of visits to yield, or None for no limit.
+    return: An iterator of tuples containing patient ID and visit.
+    """
+    # Patients whose visits are yielded.
+    if patientId == 0:
+        patientIds = patients
+    elif patientId in patients:
+        patientIds = [patientId]
+    else:
+        patientIds = []
+    # Generator expression which goes through the visits of each patient in turn, skipping offset visits and stopping
+    # after limit visits.
+    visits = ((patient, visit) for patient in patientIds for visit in patients[patient])
+    return islice(visits, offset, None if limit is None else offset + limit)
+
+
+@metrics.timed('displayStats')
+def displayStats(patients, patientId=0, cache=None):
     """
     Prints the average of each vital sign for all patients or for the specified patient. If patientId is an integer, the
     function will display the average vital signs for that specified patient. Otherwise, if patientId is 0, it will
     the average vital signs for all the patients combined. If the patientId is not found, an error message will be
-    printed and the function will end.
+    printed and the function will end. For a VisitStore, the averages come from the running totals it keeps up to date
+    (see runningVitalStats), so no visits are read. For a dictionary, they are computed by computeVitalStats. The
+    statistics are also returned so they can be used without parsing the printed report. If a QueryCache is given, the
+    statistics are looked up in it first.
 
     patients: A dictionary of patient IDs, where each patient has a list of visits.
     patientId: The ID of the patient to display vital signs for. If 0, vital signs will be displayed for all patients.
+    cache: A QueryCache attached to patients, or None to always compute the statistics.
+    return: The dictionary returned by runningVitalStats or computeVitalStats, which holds at least the mean and standard
+    deviation of each vital sign, or None if nothing was displayed.
     """
 
-    # Declare variables that will be used to store the sum of each medical statistic. Initializes the sum of each to 0.
-    temp_sum = 0
-    heart_sum = 0
-    respiratory_sum = 0
-    systolic_sum = 0
-    diastolic_sum = 0
-    oxygen_sum = 0
-    # Declare variable which will be used in computing the averages of the statistics.
-    num_visits = 0
-
     # Declares a boolean variable that will be used to determine whether to proceed with the function based on if the
     # given patient ID is valid and if the first argument in the function is given as a dictionary.
     valid = True
-    # Declares a boolean variable which will be used to determine whether the average values should be calculated and
-    # printed, so that an error does not occur.
-    validToPrint = True
+    # Variable which will store the computed statistics.
+    stats = None
 
     # Try statement which attempts to convert the given patient ID, which is initially a string, into an integer.
     try:
@@ -293,8 +840,8 @@ def displayStats(patients, patientId=0):
         # Sets valid equal to false, since patientId is not an integer value.
         valid = False
 
-    # Checks if the first argument of the function (patients), is given as a dictionary variable.
-    if type(patients) != dict:
+    # Checks if the first argument of the function (patients), is given as a dictionary variable or a VisitStore.
+    if type(patients) != dict and not isinstance(patients, VisitStore):
         # If patients is not a dictionary, then valid will be set to false.
         valid = False
         # Tells the user that the given argument is not valid.
@@ -307,74 +854,91 @@ def displayStats(patients, patientId=0):
         # for all patients.
         if patientId == 0:
             print("Vital Signs for All Patients:")
-            # For loop that iterates through every key in the dictionary.
-            for patient in patients:
-                # For loop that iterates through every sublist in the list associated with the current key in the
-                # dictionary.
-                for visit in patients[patient]:
-                    # Increments the number of visits by 1 to keep count of each visit.
-                    num_visits += 1
-                    # Adds the data from the visit to its corresponding sum variable. These variables keep track of
-                    # the total of each statistic. The temperature is found in index position 1 in visit since the date
-                    # is in the 0th position.
-                    temp_sum += visit[1]
-                    heart_sum += visit[2]
-                    respiratory_sum += visit[3]
-                    systolic_sum += visit[4]
-                    diastolic_sum += visit[5]
-                    oxygen_sum += visit[6]
-        # This branch executes if the given patientId is not equal to 0.
+            # Computes the statistics over the visits of every patient.
+            stats = _vitalStats(patients, None, cache)
+        # This branch executes if the given patient ID is in the dictionary. Computes the statistics over that patient's
+        # visits only.
+        elif patientId in patients:
+            print('Vital Signs for Patient %d:' % patientId)
+            stats = _vitalStats(patients, patientId, cache)
+        # Otherwise, the given key is invalid.
         else:
-            # Try statement which tries to access the value associated with the given key.
+            # Tells the user that the given key was invalid.
+            print(f"No data found for patient with ID {patientId}.")
+
+        # Executes if all the given information is valid and there is at least one visit to average.
+        if stats is not None and stats['visits'] > 0:
+            # Prints the average temperature, heart rate, respiratory rate, systolic blood pressure, diastolic blood
+            # pressure, and oxygen saturation, to two decimal places.
+            averages = stats['vitals']
+            print(" Average temperature:", "%.2f" % averages['temperature']['mean'], "C")
+            print(" Average heart rate:", "%.2f" % averages['heart rate']['mean'], "bpm")
+            print(" Average respiratory rate:", "%.2f" % averages['respiratory rate']['mean'], "bpm")
+            print(" Average systolic blood pressure:", "%.2f" % averages['systolic blood pressure']['mean'], "mmHg")
+            print(" Average diastolic blood pressure:", "%.2f" % averages['diastolic blood pressure']['mean'], "mmHg")
+            print(" Average oxygen saturation:", "%.2f" % averages['oxygen saturation']['mean'], "%")
+        # If there are no visits to average, tells the user.
+        elif stats is not None:
+            print(" No visits recorded.")
+
+    # Returns the statistics so they can be used by the caller.
+    return stats
+
+
+def _vitalStats(patients, patientId, cache=None):
+    """
+    Returns the statistics displayed by displayStats, using the running totals of a VisitStore when possible.
 
-            try:
-                # Creates a variable, patientVisits, that stores the value (all the visit information) associated with
-                # the given key (patientId).
-                patientVisits = patients[patientId]
-                print('Vital Signs for Patient %d:' % patientId)
-
-                # For loop that iterates through each sublist (visit) in the list of the patient's data.
-                for visit in patientVisits:
-                    # Increments the number of visits by 1. Keeps track of each visit.
-                    num_visits += 1
-                    # Adds the data from each of the patient's visits to their corresponding sum variable.
-                    temp_sum += visit[1]
-                    heart_sum += visit[2]
-                    respiratory_sum += visit[3]
-                    systolic_sum += visit[4]
-                    diastolic_sum += visit[5]
-                    oxygen_sum += visit[6]
-            # Catches any key error that occurs when trying to access the value (list) associated with the key given
-            # by the user. Key error occurs if the user provides a key that does not exist in the given dictionary.
-            except KeyError:
-                # Tells the user that the given key was invalid.
-                print(f"No data found for patient with ID {patientId}.")
-                # Since the input was invalid, validToPrint is set to false so that the function does not try to
-                # compute the averages and print them.
-                validToPrint = False
-
-        # Executes if all the given information is valid and thus no errors occurred.
-        if validToPrint:
-            # Calculates and prints the average temperature, heart rate, respiratory rate, systolic blood pressure,
-            # diastolic blood pressure, and oxygen saturation, to two decimal places. To calculate the average of a
-            # statistic, the sum of all the data for that stat is divided by the number of visits counted. If the user
-            # provided the ID of a single patient, num_visits will equal the total number of visits from that patient,
-            # otherwise it will be equal to the total number of visits by all patients.
-            print(" Average temperature:", "%.2f" % (temp_sum / num_visits), "C")
-            print(" Average heart rate:", "%.2f" % (heart_sum / num_visits), "bpm")
-            print(" Average respiratory rate:", "%.2f" % (respiratory_sum / num_visits), "bpm")
-            print(" Average systolic blood pressure:", "%.2f" % (systolic_sum / num_visits), "mmHg")
-            print(" Average diastolic blood pressure:", "%.2f" % (diastolic_sum / num_visits), "mmHg")
-            print(" Average oxygen saturation:", "%.2f" % (oxygen_sum / num_visits), "%")
-
-
-def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, fileName):
+    patients: A VisitStore, or a dictionary of patient IDs where each patient has a list of visits.
+    patientId: The ID of the patient, or None for every patient.
+    cache: A QueryCache attached to patients, or None to always compute the statistics.
+    """
+    if cache is not None:
+        return cache.stats(patientId, lambda: _vitalStats(patients, patientId))
+    if isinstance(patients, VisitStore):
+        return runningVitalStats(patients, patientId)
+    stats = computeVitalStats(patients, None if patientId is None else [patientId])
+    metrics.count('visits_scanned', stats['visits'], operation='vitalStats')
+    return stats
+
+
+@metrics.timed('displayTrends')
+def displayTrends(patients, patientId, analyzer=None):
+    """
+    Prints the trend of each vital sign of a patient across their visits: the slope of the vital sign over time, and the
+    rolling mean and the change since the previous visit at each of the most recent visits (see trends.computeTrends).
+    If a TrendAnalyzer is given, the trends are looked up in it, so they are only computed again once the patient has
+    a new visit.
+
+    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient to display the trends of.
+    analyzer: A TrendAnalyzer attached to patients, or None to always compute the trends.
+    return: The trends of the patient, or None if the patient was not found.
+    """
+    # If the patient is not in the dictionary, tells the user and ends the function.
+    if patientId not in patients:
+        print("No data found for patient with ID %d." % patientId)
+        return None
+
+    # Looks the trends up, or computes them over the patient's visits only.
+    if analyzer is not None:
+        trends = analyzer.trends(patientId)
+    else:
+        trends = computeTrends(patients, [patientId])[patientId]
+    print('Vital Sign Trends for Patient %d:' % patientId)
+    print(formatTrends(trends))
+    return trends
+
+
+@metrics.timed('addPatientData')
+def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, fileName, appendOnly=True):
     """
     Adds new patient data to the patient list. This function takes the user input as parameters. It checks the input
     and then puts it into a list that gets added to the patients dictionary. If the patient already exists in the
-    dictionary, then the data gets appended to the list of existing visits for that patient. Otherwise, a key is created
-    for that patient and then the corresponding data is added. Then, if successful, this text file is rewritten, now
-    including the added patient data.
+    dictionary, then the data gets inserted into the list of existing visits for that patient, which is kept in date
+    order. Otherwise, a key is created for that patient and then the corresponding data is added. Then, if successful,
+    the new visit is appended to the end of the text file. If appendOnly is False, the whole text file is rewritten
+    instead, now including the added data.
 
     patients: The dictionary of patient IDs, where each patient has a list of visits, to add data to.
     patientId: The ID of the patient to add data for.
@@ -386,102 +950,33 @@ def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, file
     dbp: The patient's diastolic blood pressure.
     spo2: The patient's oxygen saturation level.
     fileName: The name of the file to append new data to.
+    appendOnly: If True, only the new visit is written to the end of the file. If False, the whole file is rewritten.
     """
     # Boolean variable used to determine whether data is valid.
     valid = True
 
     # Try statement that attempts to add the patient data and write it to the file, and catches any unforeseen errors.
     try:
-        # Try statement which tries to split the date string into a list using '-' as a delimiter. Splits twice since
-        # there should be two '-' in the date.
-        try:
-            checkDate = date.split('-', 2)
-        # Catches any error that occurs when trying to split the date. An error will occur if there is no '-' in the
-        # date.
-        except:
-            # Tells the user that the given date is invalid.
-            print("Invalid date format. Please enter date in the format ‘yyyy-mm-dd’.")
-            # Sets valid to false since input is not valid.
+        # Checks the date and every vital sign against the same rules used when reading the file. If any of them is
+        # invalid, the user is told what is wrong with it.
+        problem = checkVisit(date, [temp, hr, rr, sbp, dbp, spo2])
+        if problem is not None:
+            print(problem)
             valid = False
-        # If no error occurs, this branch executes. Continues to check if the date is valid.
-        else:
-            # Checks if the year contains non-numeric digits or is not 4 characters in length.
-            if len(checkDate[0]) != 4 or checkDate[0].isdigit() == False:
-                # If either of those conditions are true, tells the user that the date is invalid.
-                print("Invalid date format. Please enter date in the format ‘yyyy-mm-dd’.")
-                valid = False
-            # Checks if the month contains non - numeric digits or is not 2 characters in length.
-            elif len(checkDate[1]) != 2 or checkDate[1].isdigit() == False:
-                # If either of those conditions are true, tells the user that the date is invalid.
-                print("Invalid date format. Please enter date in the format ‘yyyy-mm-dd’.")
-                valid = False
-            # Checks if the day contains non - numeric digits or is not 2 characters in length.
-            elif len(checkDate[2]) != 2 or checkDate[2].isdigit() == False:
-                # If either of those conditions are true, tells the user that the date is invalid.
-                print("Invalid date format. Please enter date in the format ‘yyyy-mm-dd’.")
-                valid = False
-            # If none of the previous branches executed, then this branch will execute. This branch will check if the
-            # date given is reasonable, meaning that the year is any year after 1900, the given month is a number from
-            # 1 to 12, and the day is a number between 1 and 31.
-            else:
-                # Checks if the given year is before 1900, which is invalid.
-                if int(checkDate[0]) < 1900:
-                    # Tells the user that the date is invalid.
-                    print("Invalid date. Please enter a valid date.")
-                    valid = False
-                # Checks if the month is not in the range 1 - 12, which is invalid.
-                elif int(checkDate[1]) < 1 or int(checkDate[1]) > 12:
-                    # Tells the user that the date is invalid.
-                    print("Invalid date. Please enter a valid date.")
-                    valid = False
-                # Checks if the day is not in the range 1-31, which is invalid.
-                elif int(checkDate[2]) < 1 or int(checkDate[2]) > 31:
-                    # Tells the user that the date is invalid.
-                    print( "Invalid date. Please enter a valid date.")
-                    valid = False
-        # If none of the previous branches executed, then the date is valid. The function will now check all the other
-        # values.
-        if valid:
-            # Checks if the temperature is not between 35 and 42, which is invalid.
-            if temp < 35.0 or temp > 42.0:
-                # Tells the user that the given temperature is not valid.
-                print("Invalid temperature. Please enter a temperature between 35.0 and 42.0 Celsius.")
-                valid = False
-            # Checks if the heart rate is not between 30 and 180, which is invalid.
-            elif hr < 30 or hr > 180:
-                # Tells the user that the given heart rate is not valid.
-                print("Invalid heart rate. Please enter a heart rate between 30 and 180 bpm.")
-                valid = False
-            # Checks if the respiratory rate is not between 5 and 40, which is invalid.
-            elif rr < 5 or rr > 40:
-                # Tells the user that the given respiratory rate is not valid.
-                print("Invalid respiratory rate. Please enter a respiratory rate between 5 and 40 bpm.")
-                valid = False
-            # Checks if the systolic blood pressure is not between 70 and 200, which is invalid.
-            elif sbp < 70 or sbp > 200:
-                # Tells the user that the given systolic blood pressure is not valid.
-                print("Invalid systolic blood pressure. Please enter a systolic blood pressure between 70 and 200 mmHg.")
-                valid = False
-            # Checks if the diastolic blood pressure is not between 40 and 120, which is invalid.
-            elif dbp < 40 or dbp > 120:
-                # Tells the user that the given diastolic blood pressure is not valid.
-                print( "Invalid diastolic blood pressure. Please enter a diastolic blood pressure between 40 and 120 mmHg.")
-                valid = False
-            # Checks if the oxygen concentration is not between 70 and 100, which is invalid.
-            elif spo2 < 70 or spo2 > 100:
-                # Tells the user that the given oxygen concentration is not valid.
-                print("Invalid oxygen saturation. Please enter an oxygen saturation between 70 and 100%.")
-                valid = False
 
         # If all the data given is valid, then this branch will execute.
         if valid:
             # Creates a list variable with all the given data
             listToAppend = [date, temp, hr, rr, sbp, dbp, spo2]
 
-            # If the given patientId is already in the given dictionary, this branch executes. It will append the list,
-            # listToAppend to the list that exists containing that patient's visits.
+            # If the given patientId is already in the given dictionary, this branch executes. It will insert the list,
+            # listToAppend into the list that exists containing that patient's visits, after every visit on or before
+            # its date. A VisitStore finds the place itself; a list of visits is searched by date with insort.
             if patientId in patients:
-                patients[patientId].append(listToAppend)
+                if isinstance(patients, VisitStore):
+                    patients[patientId].append(listToAppend)
+                else:
+                    insort(patients[patientId], listToAppend, key=_visitDate)
             # If the given patientId is not in the given dictionary, this branch executes. It will create a new key in
             # the dictionary with the value patientId and set it equal to an empty list (the list of the patient's
             # visits). It then appends listToAppend to this list.
@@ -489,32 +984,12 @@ def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, file
                 patients[patientId] = []
                 patients[patientId].append(listToAppend)
 
-            # Uses with command to open the given file as writeFile, write to it, and then close it when finished.
-            with open(fileName, 'w') as writeFile:
-                # For loop that iterates through each key in the dictionary.
-                for patient in patients:
-                    # For loop that loops through each sublist in the list value associated with the current key in the
-                    # dictionary.
-                    for visit in patients[patient]:
-                        # Converts each piece of data within the sublist into a string, and writes it onto the same line
-                        # of the file, separated by a comma. This corresponds to the information for one visit.
-                        writeFile.write(str(patient))
-                        writeFile.write(',')
-                        writeFile.write(str(visit[0]))
-                        writeFile.write(',')
-                        writeFile.write(str(visit[1]))
-                        writeFile.write(',')
-                        writeFile.write(str(visit[2]))
-                        writeFile.write(',')
-                        writeFile.write(str(visit[3]))
-                        writeFile.write(',')
-                        writeFile.write(str(visit[4]))
-                        writeFile.write(',')
-                        writeFile.write(str(visit[5]))
-                        writeFile.write(',')
-                        writeFile.write(str(visit[6]))
-                        # Uses \n to go to the next line of the file when printing the information for the next visit.
-                        writeFile.write('\n')
+            # In append-only mode, only the new visit is written to the end of the file.
+            if appendOnly:
+                appendVisitToFile(fileName, patientId, listToAppend)
+            # Otherwise, the whole file is rewritten from the patients dictionary, now including the added data.
+            else:
+                writePatientsFile(patients, fileName)
             # At the end, tells the user that the data has been saved.
             print("Visit is saved successfully for Patient # %d" % patientId)
     # Catches any unprecedented errors that occur.
@@ -522,30 +997,184 @@ def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, file
         print("An unexpected error occurred while adding new data.")
 
 
-def findVisitsByDate(patients, year=None, month=None):
+def _visitDate(visit):
+    # Returns the date of a visit list. Dates in the 'yyyy-mm-dd' form sort in the same order as the dates themselves.
+    return visit[0]
+
+
+@metrics.timed('bulkAddPatientData')
+def bulkAddPatientData(patients, visits, fileName, fromFile=False):
+    """
+    Adds many visits at once, such as a day's feed from a ward system. Every visit is checked with the same rules as
+    addPatientData (see validation), but the range checks are made on whole columns of values at once. The valid
+    visits are then written to the end of the text file with a single write, forced onto the disk, and added to the
+    patients dictionary.
+    Instead of printing a message for each invalid visit, the invalid visits are listed in the returned report.
+
+    patients: The dictionary of patient IDs, where each patient has a list of visits, to add data to.
+    visits: Either an iterable of visits, each a sequence of 8 values (patient ID, date, temperature, heart rate,
+    respiratory rate, systolic blood pressure, diastolic blood pressure, oxygen saturation), which may be strings; or an
+    open text file, such as a CSV file, with one visit per line in the same format as the patient file.
+    fileName: The name of the file to append the new data to.
+    fromFile: Whether the visits were read from another patient file, such as when copying visits between files. Their
+    dates are then held to the looser rules for visits already in a file (see validation.rangeProblem), so that no
+    visit which could be read is lost.
+    Returns a dictionary with the following structure:
+    {
+        'added': number of visits added (int),
+        'rejected': [
+            {'position': position of the visit in visits, starting from 0 (int), 'patientId': int or None,
+             'reason': 'fields', 'type', 'date format', 'date' or the name of the vital sign out of range (str)
+             (see validation.rejectMessage), 'message': str},
+            ...
+        ]
+    }
+    Blank lines in a file are skipped, but still counted in the positions.
+    Raises OSError if the valid visits could not be saved to the file, in which case none of them are added to the
+    patients.
+    """
+    rejected = []
+
+    # Converts each visit into its patient ID, encoded date and vital signs, rejecting visits which do not have the
+    # right number of values or whose values are not of the right type.
+    positions, lines, patientIds, dateStrings, dates = [], [], [], [], []
+    vitals = [[] for _ in VITALS]
+    for position, fields, line in visitRecords(visits):
+        patientId, date, encodedDate, values, reason = convertFields(fields)
+        if reason is not None:
+            rejected.append({'position': position, 'patientId': patientId, 'reason': reason,
+                             'message': rejectMessage(reason, line, len(fields) if reason == 'fields' else None)})
+            continue
+        positions.append(position)
+        lines.append(line)
+        patientIds.append(patientId)
+        dateStrings.append(date)
+        dates.append(encodedDate)
+        for column, value in zip(vitals, values):
+            column.append(value)
+
+    # Range checks the dates and vital signs, finding the first check each visit fails.
+    accepted = []
+    for index, check in enumerate(failedChecks(dates, vitals, fromFile)):
+        if check < 0:
+            accepted.append(index)
+        elif check == 0:
+            rejected.append({'position': positions[index], 'patientId': patientIds[index], 'reason': 'date',
+                             'message': rejectMessage('date', lines[index])})
+        else:
+            rejected.append({'position': positions[index], 'patientId': patientIds[index],
+                             'reason': VITALS[check - 1],
+                             'message': rejectMessage(VITALS[check - 1], lines[index], vitals[check - 1][index])})
+    rejected.sort(key=lambda reject: reject['position'])
+    _countLines('bulk', len(accepted) + len(rejected), rejected)
+    report = {'added': 0, 'rejected': rejected}
+    if not accepted:
+        return report
+
+    # Builds the columns of the accepted visits, and writes them to the file with a single write. The file is written
+    # before the visits are added to the patients, so visits are only ever added once they have been saved.
+    acceptedIds = array('q', [patientIds[index] for index in accepted])
+    acceptedDates = array('i', [dates[index] for index in accepted])
+    acceptedVitals = [array(typecode, [column[index] for index in accepted])
+                      for typecode, column in zip(VITAL_TYPECODES, vitals)]
+    acceptedVisits = [[dateStrings[index]] + [column[index] for column in vitals] for index in accepted]
+    try:
+        _appendLines(fileName, ''.join(_VISIT_LINE % (patientId, *visit)
+                                       for patientId, visit in zip(acceptedIds, acceptedVisits)), len(accepted))
+    except OSError:
+        print("The visits could not be saved to '%s'." % fileName)
+        raise
+
+    # Adds the visits to the patients. A VisitStore takes all of them at once, unless it is much larger than the new
+    # visits, in which case adding them one at a time is faster than regrouping the whole store.
+    if isinstance(patients, VisitStore) and len(accepted) * 8 > patients.visitCount():
+        patients.appendColumns(acceptedIds, acceptedDates, acceptedVitals, {})
+    else:
+        # The visits of each patient are kept in date order, in the same way as addPatientData.
+        for patientId, visit in zip(acceptedIds, acceptedVisits):
+            if patientId in patients:
+                if isinstance(patients, VisitStore):
+                    patients[patientId].append(visit)
+                else:
+                    insort(patients[patientId], visit, key=_visitDate)
+            else:
+                patients[patientId] = []
+                patients[patientId].append(visit)
+    report['added'] = len(accepted)
+    return report
+
+
+@metrics.timed('findVisitsByDate')
+def findVisitsByDate(patients, year=None, month=None, cache=None):
     """
     Find visits by year, month, or both. A month and year can be given, and the data corresponding data will be
     returned. Just a month cannot be given, this will return an empty list. Just a year can be given, and all the visits
     in that year will be returned. Also, if no month or year is given, all the visits will be returned. This function
     returns a list containing tuples. Each tuple consists of the patient ID, and a list containing the visit information
-    such as date, temperature, etc.
+    such as date, temperature, etc. If patients is a VisitStore, the visits are found through its date index, so only
+    the visits in the given year or month are looked at. To go through the visits one at a time without building the
+    list, use iterVisitsByDate. If a QueryCache is given, the visits are looked up in it first, under the range of
+    dates covered by the year and month.
 
     patients: A dictionary of patient IDs, where each patient has a list of visits.
     year: The year to filter by.
     month: The month to filter by.
+    cache: A QueryCache attached to patients, or None to always search for the visits.
     return: A list of tuples containing patient ID and visit that match the filter.
     """
-    # Creates a list variable that will store all the information for the given year / month. The list will be a list
-    # of tuples. Each tuple will contain the patient ID as an integer and a list containing the information regarding
-    # the visit.
-    visits = []
+    if cache is not None:
+        return cache.visitsByDate(_dateRangeOf(year, month), lambda: findVisitsByDate(patients, year, month))
+    # Collects every visit found into a list.
+    return list(iterVisitsByDate(patients, year, month))
+
+
+def iterVisitsByDate(patients, year=None, month=None, offset=0, limit=None):
+    """
+    Finds the same visits as findVisitsByDate, in the same order, but yields them one at a time as they are found
+    instead of building a list of them. For a dictionary of patients this uses a constant amount of memory, and for a
+    VisitStore only the row numbers of the matching visits are held. Either way, the first visit is available straight
+    away. offset and limit can be used to go through the visits one page at a time.
 
+    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    year: The year to filter by.
+    month: The month to filter by.
+    offset: The number of matching visits to skip before the first one yielded.
+    limit: The largest number of visits to yield, or None for no limit.
+    return: An iterator of tuples containing patient ID and visit that match the filter.
+    """
+    # Position after the last visit to yield.
+    stop = None if limit is None else offset + limit
+
+    # If the patients are stored in a VisitStore, looks up the range of dates covered by the year and month in its date
+    # index. An invalid year or month gives no range, and so no visits. Only the rows of the page requested are turned
+    # into visit lists.
+    if isinstance(patients, VisitStore):
+        dateRange = _dateRangeOf(year, month)
+        rows = [] if dateRange is None else patients.rowsBetween(dateRange[0], dateRange[1])
+        metrics.count('visits_scanned', len(rows), operation='visitsByDate')
+        return ((patients.patientOf(row), patients.visitAt(row)) for row in islice(rows, offset, stop))
+
+    # Otherwise, skips the first offset visits found by checking every visit, and stops after limit visits.
+    if metrics.enabled:
+        metrics.count('visits_scanned', sum(len(patientVisits) for patientVisits in patients.values()),
+                      operation='visitsByDate')
+    return islice(_visitsByDate(patients, year, month), offset, stop)
+
+
+def _visitsByDate(patients, year, month):
+    """
+    Generator which yields the visits found by findVisitsByDate, one at a time.
+
+    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    year: The year to filter by.
+    month: The month to filter by.
+    """
     # Boolean variable used when determining if the given year is valid.
     valid = True
 
-    # If no year is given, but a month is given, function returns an empty list, as this is invalid.
+    # If no year is given, but a month is given, no visits are found, as this is invalid.
     if year == None and month != None:
-        return visits
+        return
     # If a year is given, but not a month, this branch executes. Displays visits for all months in the given year.
     elif year != None and month == None:
         # If the year is invalid (less than 1900), this branch will execute.
@@ -565,8 +1194,8 @@ def findVisitsByDate(patients, year=None, month=None):
                         if year == int(visitDate[0]):
                             # Creates a tuple which stores the patientId, and the list of data regarding the visit.
                             visitInGivenDate = (patient, visit)
-                            # Appends this tuple to the list of visits containing all information for the given year.
-                            visits.append(visitInGivenDate)
+                            # Yields this tuple to the caller.
+                            yield visitInGivenDate
     # This branch executes if a year and month are both given. Displays data for visits in that year and month.
     elif year != None and month != None:
         # If the given year is less than 1900, which is invalid, this branch executes.
@@ -590,8 +1219,8 @@ def findVisitsByDate(patients, year=None, month=None):
                         if year == int(visitDate[0]) and month == int(visitDate[1]):
                             # Creates a tuple storing the patient ID and the visit information.
                             visitInGivenDate = (patient, visit)
-                            # Appends the tuple to the list of visits.
-                            visits.append(visitInGivenDate)
+                            # Yields this tuple to the caller.
+                            yield visitInGivenDate
     # This branch executes if no year or month are given. Displays the visits for every month in every year.
     else:
         # Loops through each key in the dictionary.
@@ -602,118 +1231,197 @@ def findVisitsByDate(patients, year=None, month=None):
                 if len(visit[0]) ==  10:
                     # Creates tuple with patient ID and list of the visit information.
                     visitInGivenDate = (patient,visit)
-                    # Appends this tuple to the list of visits.
-                    visits.append(visitInGivenDate)
-    # Returns the list of visits.
+                    # Yields this tuple to the caller.
+                    yield visitInGivenDate
+
+
+def _dateRangeOf(year, month):
+    """
+    Returns the first and last encoded dates (see encodeDate) covered by a year and month, following the same rules as
+    findVisitsByDate: if neither is given, every date is covered; if only a year is given, every date in that year is
+    covered. Returns None if only a month is given, if the year is before 1900, or if the month is not from 1 to 12.
+
+    year: The year, or None.
+    month: The month, or None.
+    """
+    # No year or month covers every date.
+    if year is None and month is None:
+        return 0, 99999999
+    # A month without a year, or a year before 1900, is invalid.
+    if year is None or year < 1900:
+        return None
+    # A year on its own covers every day of every month in the year.
+    if month is None:
+        return year * 10000, year * 10000 + 9999
+    # A month which is not from 1 to 12 is invalid.
+    if month < 1 or month > 12:
+        return None
+    return year * 10000 + month * 100, year * 10000 + month * 100 + 99
+
+
+@metrics.timed('findVisitsInDateRange')
+def findVisitsInDateRange(patients, startDate, endDate):
+    """
+    Finds the visits between two dates, including visits on the start and end dates. The visits are returned in date
+    order, with visits on the same date in patient order. If patients is a VisitStore, the visits are found through its
+    date index.
+
+    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    startDate: The first date of the range, in the format 'yyyy-mm-dd'.
+    endDate: The last date of the range, in the format 'yyyy-mm-dd'.
+    return: A list of tuples containing patient ID and visit in the range, or an empty list if either date is not in
+    the format 'yyyy-mm-dd'.
+    """
+    # Encodes both dates so they can be compared as integers.
+    start = encodeDate(startDate)
+    end = encodeDate(endDate)
+    # If either date is not in the right format, no visits are found.
+    if start is None or end is None:
+        return []
+
+    # Looks the range up in the date index of a VisitStore.
+    if isinstance(patients, VisitStore):
+        rows = patients.rowsBetween(start, end, chronological=True)
+        metrics.count('visits_scanned', len(rows), operation='visitsInDateRange')
+        return [(patients.patientOf(row), patients.visitAt(row)) for row in rows]
+
+    # Otherwise, checks every visit of every patient, and then sorts the visits found by date. Python's sort keeps
+    # visits on the same date in patient order.
+    visits = []
+    if metrics.enabled:
+        metrics.count('visits_scanned', sum(len(patientVisits) for patientVisits in patients.values()),
+                      operation='visitsInDateRange')
+    for patient in patients:
+        for visit in patients[patient]:
+            visitDate = encodeDate(visit[0])
+            if visitDate is not None and start <= visitDate <= end:
+                visits.append((patient, visit))
+    visits.sort(key=lambda patientVisit: patientVisit[1][0])
     return visits
 
 
+@metrics.timed('findPatientsWhoNeedFollowUp')
 def findPatientsWhoNeedFollowUp(patients):
     """
     Find patients who need follow-up visits based on abnormal vital signs. This function looks at the vital signs of the
     patients (specifically, heart rate, systolic blood pressure, diastolic blood pressure, and oxygen saturation level),
     and determines if these values are abnormal. If any of these values are out of the normal ranges for a patient, then
     they are added to a list of patients who require follow-ups. This function will return the list of patients who
-    require a follow-up visit.
+    require a follow-up visit. The visits are checked with screenPatients, which checks whole vital sign columns at once
+    and also reports which rule flagged each patient, and on which visit.
 
     patients: A dictionary of patient IDs, where each patient has a list of visits.
     return: A list of patient IDs that need follow-up visits due to abnormal health stats.
     """
-    # List variable which will store patient IDs for those that require follow-up visits.
-    followup_patients = []
+    # The rules in FOLLOW_UP_RULES are the normal ranges: a heart rate from 60 to 100, a systolic blood pressure of at
+    # most 140, a diastolic blood pressure of at most 90, and an oxygen saturation of at least 90.
+    return [patientId for patientId, rule, visitIndex, visit in screenPatients(patients)]
 
-    # Iterates through each key in the dictionary.
-    for patient in patients:
-        # Iterates through each sublist in the list value associated with the current key in the dictionary.
-        for visit in patients[patient]:
-            # Boolean variable used to determine whether the patient requires a follow-up.
-            followUpNeeded = False
-            # If the heart rate (the value in index position 0 of the visit list) is greater than 100 or less than 60,
-            # this branch executes.
-            if visit[2] > 100 or visit[2] < 60:
-                # A follow-up is required.
-                followUpNeeded = True
-            # If systolic is greater than 140, this branch executes.
-            elif visit [4] > 140:
-                # A follow-up is required.
-                followUpNeeded = True
-            # If diastolic is greater than 90, this branch executes.
-            elif visit[5] > 90:
-                # A follow-up is required.
-                followUpNeeded = True
-            # If oxygen saturation is less than 90, this branch executes.
-            elif visit[6] < 90:
-                # A follow-up is required.
-                followUpNeeded = True
-
-            # If followUpNeeded is True, this branch executes.
-            if followUpNeeded:
-                # If the patient is not already in the list of follow-up patients, they are added to it.
-                if patient not in followup_patients:
-                    followup_patients.append(patient)
-    # Returns the list of patients who require follow-ups.
-    return followup_patients
-
-
-def deleteAllVisitsOfPatient(patients, patientId, filename):
+
+def readFollowUpRules(fileName):
+    """
+    Reads the rules used to find patients who need a follow-up visit from a JSON file (see screening.loadRules). If the
+    file does not exist, the default rules in FOLLOW_UP_RULES are used. If the file cannot be read or holds a rule that
+    is not valid, an error message is printed and the default rules are used.
+
+    fileName: The name of the JSON file.
+    Returns the rules.
+    """
+    if not os.path.exists(fileName):
+        return FOLLOW_UP_RULES
+    try:
+        return loadRules(fileName)
+    except (OSError, ValueError) as error:
+        print("The follow-up rules in '%s' could not be read: %s" % (fileName, error))
+        return FOLLOW_UP_RULES
+
+
+@metrics.timed('deleteAllVisitsOfPatient')
+def deleteAllVisitsOfPatient(patients, patientId, filename, useLog=True):
     """
     Delete all visits of a particular patient. This function uses the pop() method to remove all visits of a particular
     patient from the patients dictionary. It removes both the key and its associated list for the given patient. Then,
-    the textfile is re-written, exluding the visit information for that patient. Since the data no longer exists in the
-    dictionary, it will also not be written to the file.
-
-    patients: The dictionary of patient IDs, where each patient has a list of visits, to delete data from.
+    a delete record for the patient is written to the file's delete log, which readPatientsFromFile replays when the
+    file is read again. Once COMPACTION_THRESHOLD records have built up, the file is compacted. If useLog is False, the
+    textfile is re-written instead, exluding the visit information for that patient. Since the data no longer exists in
+    the dictionary, it will also not be written to the file. If the patients have not been loaded, only the patient's
+    own lines are read to check that they have visits (see readPatientVisits), and every patient is only read from the
+    file if the whole file has to be written.
+
+    patients: The dictionary of patient IDs, where each patient has a list of visits, to delete data from, or None if
+    the patients have not been loaded.
     patientId: The ID of the patient to delete data for.
     filename: The name of the file to save the updated patient data.
+    useLog: If True, the delete is recorded in the delete log. If False, the whole file is rewritten.
     return: None
     """
 
+    # Removes the patient, and then tells the user whether the patient's data was found and removed.
+    if removePatientVisits(patients, patientId, filename, useLog):
+        print("Data for patient %d has been deleted." % patientId)
+    else:
+        print("No data found for patient with ID %d" % patientId)
+
+
+def removePatientVisits(patients, patientId, filename, useLog=True):
+    """
+    Deletes all visits of a patient in the same way as deleteAllVisitsOfPatient, but without printing anything, for
+    callers such as the server which report the result themselves.
+
+    patients: The dictionary of patient IDs to delete data from, or None if the patients have not been loaded.
+    patientId: The ID of the patient to delete data for.
+    filename: The name of the file to save the updated patient data.
+    useLog: If True, the delete is recorded in the delete log. If False, the whole file is rewritten.
+    Returns True if the patient was found and deleted, or False if the patient has no data.
+    """
     # Try statement that attempts to remove the given key (patientId) and its associated value from the dictionary.
     try:
-        patients.pop(patientId)
-
-        # This section of code rewrites the file now that the patient data has been removed from the dictionary. Uses
-        # with to open the file for writing as writeFile, write to it, and then close it when finished.
-        with open(filename, 'w') as writeFile:
-            # Loops through each key in dictionary.
-            for patient in patients:
-                # Loops through each sublist in the list value associated with the current key in the dictionary.
-                for visit in patients[patient]:
-                    # Writes out each piece of data relating to the current visit on the same line, separated by commas.
-                    # Writes the patient ID first, followed by the date, which is in the 0th position of the visit list,
-                    # and so on. Converts each value to a string before writing it to the file.
-                    writeFile.write(str(patient))
-                    writeFile.write(',')
-                    writeFile.write(str(visit[0]))
-                    writeFile.write(',')
-                    writeFile.write(str(visit[1]))
-                    writeFile.write(',')
-                    writeFile.write(str(visit[2]))
-                    writeFile.write(',')
-                    writeFile.write(str(visit[3]))
-                    writeFile.write(',')
-                    writeFile.write(str(visit[4]))
-                    writeFile.write(',')
-                    writeFile.write(str(visit[5]))
-                    writeFile.write(',')
-                    writeFile.write(str(visit[6]))
-                    # At the end of the line, writes a newline character so that the data for the next visit appears
-                    # on the next line of the file.
-                    writeFile.write('\n')
+        if patients is not None:
+            patients.pop(patientId)
+        elif readPatientVisits(filename, patientId) is None:
+            raise KeyError(patientId)
     # Catches any key error that occurs when trying to remove a patient from the dictionary. Occurs if the given key
     # (patientId) does not exist in the dictionary.
     except KeyError:
-        # Tells the user that the given patient ID is invalid.
-        print( "No data found for patient with ID %d" % patientId)
-    # If an error does not occur, this branch executes, telling the user that the patient's data has been removed.
+        return False
+
+    # Records the delete in the delete log, and compacts the file once enough records have built up. Compacting needs
+    # every patient, so if the patients have not been loaded, they are read from the file, which leaves out the patient
+    # just deleted.
+    if useLog:
+        _appendDeleteRecord(filename, patientId)
+        if 0 < COMPACTION_THRESHOLD <= _deleteLogRecords[filename]:
+            compactPatientsFile(patients if patients is not None else readPatientsFromFile(filename), filename)
+    # This section of code rewrites the file now that the patient data has been removed from the dictionary. Since the
+    # data no longer exists in the dictionary, it is not written to the file.
     else:
-        print("Data for patient %d has been deleted." % patientId)
+        if patients is None:
+            patients = readPatientsFromFile(filename)
+            patients.pop(patientId)
+        writePatientsFile(patients, filename)
+    return True
 
 
 def main():
 
-    patients = readPatientsFromFile('patients.txt')
+    # The patients are only loaded once an option needs every patient. Until then, displaying or deleting a patient
+    # only reads that patient's lines of the file (see readPatientVisits).
+    patients = None
+    # Screens the patients for follow-ups once they are loaded, after which each added visit is checked as it is added.
+    followUps = FollowUpMonitor(readFollowUpRules(FOLLOW_UP_RULES_FILE))
+    # Keeps the results of recent statistics queries, dropping them when visits are added or patients deleted.
+    queryCache = QueryCache()
+    # Keeps the trends of each patient once computed, dropping them when the patient has a new visit.
+    trendAnalyzer = TrendAnalyzer()
+    # Profiles the menu from the start if the PATIENTS_PROFILE environment variable is set. Otherwise, profiling can be
+    # started and stopped from the menu.
+    profiler = Profiler(os.environ.get(PROFILE_ENV) or PROFILE_FILE)
+    if os.environ.get(PROFILE_ENV):
+        profiler.start()
     while True:
+        # Keeps the metrics file up to date after every operation, if the metrics are switched on.
+        if metrics.enabled and metrics.fileName:
+            metrics.write()
         print("\n\nWelcome to the Health Information System\n\n")
         print("1. Display all patient data")
         print("2. Display patient data by ID")
@@ -722,14 +1430,29 @@ def main():
         print("5. Find visits by year, month, or both")
         print("6. Find patients who need follow-up")
         print("7. Delete all visits of a particular patient")
-        print("8. Quit\n")
-
-        choice = input("Enter your choice (1-8): ")
+        print("8. Quit")
+        print("9. %s profiling" % ("Stop" if profiler.running else "Start"))
+        print("10. Display patient trends\n")
+
+        choice = input("Enter your choice (1-10): ")
+        # Loads the patients the first time an option needs every patient.
+        if patients is None and choice in ('1', '3', '4', '5', '6', '10'):
+            patients = loadPatients('patients.txt')
+            followUps.attach(patients)
+            queryCache.attach(patients)
+            trendAnalyzer.attach(patients)
         if choice == '1':
             displayPatientData(patients)
         elif choice == '2':
             patientID = int(input("Enter patient ID: "))
-            displayPatientData(patients, patientID)
+            if patients is None:
+                try:
+                    visits = readPatientVisits('patients.txt', patientID)
+                    displayPatientData({} if visits is None else {patientID: visits}, patientID)
+                except OSError:
+                    print("The file 'patients.txt' could not be found.")
+            else:
+                displayPatientData(patients, patientID)
         elif choice == '3':
             patientID = int(input("Enter patient ID: "))
             date = input("Enter date (YYYY-MM-DD): ")
@@ -745,38 +1468,69 @@ def main():
                 print("Invalid input. Please enter valid data.")
         elif choice == '4':
             patientID = input("Enter patient ID (or '0' for all patients): ")
-            displayStats(patients, patientID)
+            displayStats(patients, patientID, queryCache)
         elif choice == '5':
             year = input("Enter year (YYYY) (or 0 for all years): ")
             month = input("Enter month (MM) (or 0 for all months): ")
-            visits = findVisitsByDate(patients, int(year) if year != '0' else None,
+            # Goes through the visits as they are found, pausing after each page of visits.
+            visits = iterVisitsByDate(patients, int(year) if year != '0' else None,
                                       int(month) if month != '0' else None)
-            if visits:
-                for visit in visits:
-                    print("Patient ID:", visit[0])
-                    print(" Visit Date:", visit[1][0])
-                    print("  Temperature:", "%.2f" % visit[1][1], "C")
-                    print("  Heart Rate:", visit[1][2], "bpm")
-                    print("  Respiratory Rate:", visit[1][3], "bpm")
-                    print("  Systolic Blood Pressure:", visit[1][4], "mmHg")
-                    print("  Diastolic Blood Pressure:", visit[1][5], "mmHg")
-                    print("  Oxygen Saturation:", visit[1][6], "%")
-            else:
+            visitsShown = 0
+            for visit in visits:
+                if visitsShown > 0 and visitsShown % VISITS_PER_PAGE == 0:
+                    if input("-- Press Enter to see more visits, or enter 'q' to stop: ").strip().lower() == 'q':
+                        break
+                visitsShown += 1
+                print("Patient ID:", visit[0])
+                print(" Visit Date:", visit[1][0])
+                print("  Temperature:", "%.2f" % visit[1][1], "C")
+                print("  Heart Rate:", visit[1][2], "bpm")
+                print("  Respiratory Rate:", visit[1][3], "bpm")
+                print("  Systolic Blood Pressure:", visit[1][4], "mmHg")
+                print("  Diastolic Blood Pressure:", visit[1][5], "mmHg")
+                print("  Oxygen Saturation:", visit[1][6], "%")
+            if visitsShown == 0:
                 print("No visits found for the specified year/month.")
         elif choice == '6':
-            followup_patients = findPatientsWhoNeedFollowUp(patients)
+            followup_patients = followUps.flagged()
             if followup_patients:
                 print("Patients who need follow-up visits:")
-                for patientId in followup_patients:
-                    print(patientId)
+                # Prints each patient ID along with the rule that flagged the patient and the date of the visit.
+                for patientId, rule, visitIndex, visit in followup_patients:
+                    print("%d (%s on %s)" % (patientId, rule, visit[0]))
             else:
                 print("No patients found who need follow-up visits.")
         elif choice == '7':
             patientID = input("Enter patient ID: ")
             deleteAllVisitsOfPatient(patients, int(patientID), "patients.txt")
         elif choice == '8':
+            # Makes sure every saved visit has been forced onto the disk before quitting.
+            syncPatientsFile('patients.txt')
+            # Saves a snapshot of the patients so the next start up does not need to read the whole file.
+            if patients is not None:
+                saveSnapshot(patients, 'patients.txt')
+            # Saves the profile and the metrics, if they are being captured.
+            if profiler.running:
+                print(profiler.stop())
+            if metrics.enabled and metrics.fileName:
+                metrics.write()
             print("Goodbye!")
             break
+        elif choice == '9':
+            # Starts profiling, switching the metrics on as well so the operations are timed, or stops profiling and
+            # shows where the time and memory went along with the metrics.
+            if not profiler.running:
+                metrics.enable()
+                profiler.start()
+                print("Profiling started. Choose option 9 again to stop profiling and see the results.")
+            else:
+                print(profiler.stop())
+                print(metrics.export())
+        elif choice == '10':
+            try:
+                displayTrends(patients, int(input("Enter patient ID: ")), trendAnalyzer)
+            except ValueError:
+                print("Invalid input. Please enter a valid patient ID.")
         else:
             print("Invalid choice. Please try again.\n")
 
@@ -0,0 +1,321 @@
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import count
+
+from instrumentation import metrics
+from validation import MAX_PATIENT_ID, MIN_PATIENT_ID
+
+
+# Number of lines that can be appended to a patient file after its offset index was saved before the index is saved
+# again. Until then, the lines appended are found by reading just the end of the file each time the index is opened.
+OFFSET_INDEX_TAIL_LINES = 10000
+
+# Number of bytes before a position in a patient file whose checksum is kept to recognise the version of the file, since
+# the file system can give a replaced file the ID of the file it replaced (see tailChecksum).
+VERSION_CHECK_BYTES = 256
+
+# Magic bytes at the start of every offset index file, and the version of its layout.
+_INDEX_MAGIC = b'PTIDX\x00\x00\x00'
+_INDEX_VERSION = 2
+
+# Header of an offset index file: magic bytes, version, whether the columns are little-endian, padding, the ID, size
+# and modification time of the patient file when it was last looked at, the number of bytes of it indexed, the checksum
+# of the end of the part indexed, padding so the columns start on a multiple of 8 bytes, and the number of ranges.
+_INDEX_HEADER = struct.Struct('<8sI?3xqqqqI4xq')
+
+# Numbers each version of a patient file that an index is built or opened for in this process (see OffsetIndex.version).
+_versions = count(1)
+
+
+class OffsetIndex:
+    """
+    An index of a patient file which maps each patient ID to the byte ranges of the lines holding their visits, so that
+    one patient's visits can be read without reading the rest of the file. Lines of the same patient which follow each
+    other in the file share one range.
+
+    The index is saved next to the patient file (see indexName) and memory mapped when it is opened, so opening it only
+    reads its header and looking a patient up is a binary search. It belongs to one version of the patient file: once
+    the file has been replaced, such as by a compaction, the index is built again. Lines appended to the file since the
+    index was saved are read from the end of the file by refresh.
+
+    Only complete lines are indexed. Lines are not checked, so a range may hold invalid lines, which must be checked by
+    whoever reads them.
+
+    A version of the file is recognised by its ID, size and modification time. Once the file has changed, it is only
+    taken to be the same version with lines appended if it has the same ID, has grown, and still has the same bytes
+    just before the end of the part indexed (see tailChecksum), since the ID of a replaced file can be reused.
+    """
+
+    def __init__(self, fileName):
+        """
+        Opens the offset index of a patient file, building and saving it first if it does not exist or belongs to
+        another version of the file. Raises OSError if the patient file cannot be read.
+
+        fileName: The name of the patient file.
+        """
+        self.fileName = fileName
+        # The ID, size and modification time of the patient file when it was last looked at, the number of bytes of it
+        # indexed so far, and the checksum of the end of the part indexed.
+        self.fileId = None
+        self.fileSize = 0
+        self.modified = 0
+        self.indexedSize = 0
+        self.checksum = 0
+        # A number which is different for every version of the patient file indexed in this process, so that anything
+        # read from one version can be told apart from another.
+        self.version = None
+        # The columns of the saved index, sorted by patient ID and then by offset: the patient ID, offset and length
+        # of each range.
+        self._patientIds = array('q')
+        self._offsets = array('q')
+        self._lengths = array('q')
+        # Dictionary mapping each patient ID to a list of the (offset, length) ranges of lines appended since the index
+        # was saved, and the number of those lines.
+        self._recent = {}
+        self._recentLines = 0
+        self._mapping = None
+        if not self._open():
+            self._build()
+        self.refresh()
+
+    @staticmethod
+    def indexName(fileName):
+        """
+        Returns the name of the offset index file that belongs to a patient file.
+
+        fileName: The name of the patient file.
+        """
+        return fileName + '.idx'
+
+    def refresh(self):
+        """
+        Brings the index up to date with the patient file. Lines appended since the last refresh are indexed by reading
+        them from the end of the file, and the index is saved again once OFFSET_INDEX_TAIL_LINES lines have built up.
+        If the file has been replaced, the whole index is built again.
+        """
+        fileStat = os.stat(self.fileName)
+        if self._unchanged(fileStat):
+            return
+        if not self._appended(fileStat):
+            self._build()
+            return
+        patientIds, offsets, lengths, lineCount, indexedSize = _scanLines(self.fileName, self.indexedSize)
+        for patientId, offset, length in zip(patientIds, offsets, lengths):
+            self._recent.setdefault(patientId, []).append((offset, length))
+        self._recentLines += lineCount
+        self._looked(fileStat, indexedSize)
+        if self._recentLines >= OFFSET_INDEX_TAIL_LINES:
+            self._save(*self._merged())
+
+    def ranges(self, patientId):
+        """
+        Returns a list of the (offset, length) byte ranges of the lines of a patient, in file order. The list is empty
+        if the patient has no lines in the part of the file indexed.
+
+        patientId: The ID of the patient.
+        """
+        first = bisect_left(self._patientIds, patientId)
+        last = bisect_right(self._patientIds, patientId, first)
+        found = list(zip(self._offsets[first:last], self._lengths[first:last]))
+        found.extend(self._recent.get(patientId, ()))
+        return found
+
+    def close(self):
+        """
+        Releases the memory mapped index file.
+        """
+        self._release()
+        self._patientIds = self._offsets = self._lengths = array('q')
+
+    def _unchanged(self, fileStat):
+        # Returns True if the patient file has not changed since it was last looked at.
+        return (fileStat.st_ino == self.fileId and fileStat.st_size == self.fileSize
+                and fileStat.st_mtime_ns == self.modified)
+
+    def _appended(self, fileStat):
+        # Returns True if the patient file has changed since it was last looked at only by having lines appended: it
+        # has the same ID, has grown, and the bytes just before the end of the part indexed are the same.
+        if fileStat.st_ino != self.fileId or fileStat.st_size <= self.fileSize or fileStat.st_size < self.indexedSize:
+            return False
+        try:
+            with open(self.fileName, 'rb') as readFile:
+                return tailChecksum(readFile, self.indexedSize) == self.checksum
+        except OSError:
+            return False
+
+    def _looked(self, fileStat, indexedSize):
+        # Records the ID, size and modification time of the patient file, and how much of it has been indexed.
+        with open(self.fileName, 'rb') as readFile:
+            self.checksum = tailChecksum(readFile, indexedSize)
+        self.fileId = fileStat.st_ino
+        self.fileSize = fileStat.st_size
+        self.modified = fileStat.st_mtime_ns
+        self.indexedSize = indexedSize
+
+    def _open(self):
+        # Memory maps the saved index if it belongs to the current version of the patient file, or to it before lines
+        # were appended. Returns False if there is no such index.
+        try:
+            fileStat = os.stat(self.fileName)
+            with open(self.indexName(self.fileName), 'rb') as indexFile:
+                mapping = mmap.mmap(indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        if len(mapping) < _INDEX_HEADER.size:
+            mapping.close()
+            return False
+        (magic, version, littleEndian, fileId, fileSize, modified, indexedSize, checksum,
+         rangeCount) = _INDEX_HEADER.unpack_from(mapping)
+        if (magic != _INDEX_MAGIC or version != _INDEX_VERSION or littleEndian != (sys.byteorder == 'little')
+                or len(mapping) != _INDEX_HEADER.size + 24 * rangeCount):
+            mapping.close()
+            return False
+        self.fileId, self.fileSize, self.modified = fileId, fileSize, modified
+        self.indexedSize, self.checksum = indexedSize, checksum
+        if not self._unchanged(fileStat) and not self._appended(fileStat):
+            mapping.close()
+            return False
+        self._release()
+        self._mapping = mapping
+        view = memoryview(mapping)[_INDEX_HEADER.size:].cast('q')
+        self._patientIds = view[0:rangeCount]
+        self._offsets = view[rangeCount:2 * rangeCount]
+        self._lengths = view[2 * rangeCount:3 * rangeCount]
+        self._recent = {}
+        self._recentLines = 0
+        if self.version is None:
+            self.version = next(_versions)
+        return True
+
+    @metrics.timed('buildOffsetIndex')
+    def _build(self):
+        # Indexes the whole patient file, and saves the index.
+        fileStat = os.stat(self.fileName)
+        patientIds, offsets, lengths, lineCount, indexedSize = _scanLines(self.fileName, 0)
+        # Sorts the ranges by patient ID. The sort is stable, so each patient's ranges stay in file order.
+        order = sorted(range(len(patientIds)), key=patientIds.__getitem__)
+        self._looked(fileStat, indexedSize)
+        self.version = next(_versions)
+        self._save(array('q', [patientIds[position] for position in order]),
+                   array('q', [offsets[position] for position in order]),
+                   array('q', [lengths[position] for position in order]))
+
+    def _merged(self):
+        # Returns the columns of the saved index with the ranges of the recently appended lines merged in.
+        patientIds = array('q')
+        offsets = array('q')
+        lengths = array('q')
+        start = 0
+        for patientId in sorted(self._recent):
+            end = bisect_right(self._patientIds, patientId, start)
+            patientIds.extend(self._patientIds[start:end])
+            offsets.extend(self._offsets[start:end])
+            lengths.extend(self._lengths[start:end])
+            for offset, length in self._recent[patientId]:
+                patientIds.append(patientId)
+                offsets.append(offset)
+                lengths.append(length)
+            start = end
+        patientIds.extend(self._patientIds[start:])
+        offsets.extend(self._offsets[start:])
+        lengths.extend(self._lengths[start:])
+        return patientIds, offsets, lengths
+
+    def _save(self, patientIds, offsets, lengths):
+        # Writes the index to a temporary file which then replaces the index file, so an index which is in use is never
+        # changed, and then opens it. If the index cannot be saved, it is kept in memory instead.
+        indexName = self.indexName(self.fileName)
+        tempName = indexName + '.tmp'
+        try:
+            with open(tempName, 'wb') as indexFile:
+                indexFile.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, sys.byteorder == 'little', self.fileId,
+                                                   self.fileSize, self.modified, self.indexedSize, self.checksum,
+                                                   len(patientIds)))
+                for column in (patientIds, offsets, lengths):
+                    indexFile.write(memoryview(column).cast('B'))
+            os.replace(tempName, indexName)
+            metrics.count('bytes_written', os.path.getsize(indexName), operation='offsetIndex')
+        except OSError:
+            print("The offset index of '%s' could not be saved." % self.fileName)
+            self._release()
+            self._patientIds, self._offsets, self._lengths = patientIds, offsets, lengths
+            self._recent = {}
+            self._recentLines = 0
+            return
+        if not self._open():
+            self._release()
+            self._patientIds, self._offsets, self._lengths = patientIds, offsets, lengths
+            self._recent = {}
+            self._recentLines = 0
+
+    def _release(self):
+        # Releases the views of the memory mapped index, and then the mapping itself.
+        if self._mapping is not None:
+            for column in (self._patientIds, self._offsets, self._lengths):
+                if isinstance(column, memoryview):
+                    column.release()
+            self._mapping.close()
+            self._mapping = None
+
+
+def tailChecksum(readFile, end, length=VERSION_CHECK_BYTES):
+    """
+    Returns the CRC-32 checksum of the bytes just before a position in a file. Appending to a file never changes these
+    bytes, while a file written again in its place almost always has different bytes there, so the checksum tells a
+    file with lines appended apart from a new version of it, even when the new version is given the same file ID.
+
+    readFile: The file, opened for reading in binary mode.
+    end: The position the bytes end at.
+    length: The largest number of bytes to check.
+    """
+    start = max(end - length, 0)
+    readFile.seek(start)
+    return zlib.crc32(readFile.read(end - start))
+
+
+def _scanLines(fileName, start):
+    """
+    Finds the byte range of the lines of each patient in a patient file, from a position to the last complete line.
+    Consecutive lines of the same patient are given as one range. Lines whose patient ID cannot be read, or does not
+    fit in a 64-bit integer, are skipped.
+
+    fileName: The name of the patient file.
+    start: The byte position to start from, which must be at the start of a line.
+    Returns a tuple (patient IDs, offsets, lengths, number of lines read, position after the last complete line), where
+    the first three are arrays with one entry for each range, in file order.
+    """
+    patientIds = array('q')
+    offsets = array('q')
+    lengths = array('q')
+    lineCount = 0
+    position = start
+    with open(fileName, 'rb') as readFile:
+        readFile.seek(start)
+        for rawLine in readFile:
+            # A line without a newline character is still being written, so it is left for the next scan.
+            if not rawLine.endswith(b'\n'):
+                break
+            lineCount += 1
+            comma = rawLine.find(b',')
+            try:
+                patientId = int(rawLine[:comma]) if comma > 0 else None
+            except ValueError:
+                patientId = None
+            # A patient ID which does not fit in the index is rejected by parseLine anyway, so the line is skipped.
+            if patientId is not None and not MIN_PATIENT_ID <= patientId <= MAX_PATIENT_ID:
+                patientId = None
+            if patientId is not None:
+                # Extends the last range if it belongs to the same patient and ends where this line starts.
+                if patientIds and patientIds[-1] == patientId and offsets[-1] + lengths[-1] == position:
+                    lengths[-1] += len(rawLine)
+                else:
+                    patientIds.append(patientId)
+                    offsets.append(position)
+                    lengths.append(len(rawLine))
+            position += len(rawLine)
+    return patientIds, offsets, lengths, lineCount, position
@@ -0,0 +1,159 @@
+from collections import OrderedDict
+
+from visitstore import encodeDate
+
+
+# Largest number of results a QueryCache keeps unless another size is given.
+QUERY_CACHE_SIZE = 256
+
+
+class QueryCache:
+    """
+    Keeps the results of the most recent statistics and date queries on a VisitStore, so that repeating a query does
+    not compute it again. Once the cache is full, the least recently used result is evicted to make room.
+
+    The cache watches the store (see VisitStore.subscribe) and only drops the results a change can affect:
+    - Adding a visit drops the statistics of its patient and of every patient, and the date queries whose range of
+      dates includes the visit's date.
+    - Deleting a patient drops the statistics of the patient and of every patient, and the date queries whose results
+      include one of the patient's visits.
+    - Loading many visits at once drops everything.
+
+    Results are shared between callers, so they must not be changed.
+    """
+
+    def __init__(self, maxEntries=QUERY_CACHE_SIZE):
+        # The largest number of results kept.
+        self.maxEntries = maxEntries
+        # The results, from least to most recently used, by key.
+        self._entries = OrderedDict()
+        # Dictionary mapping each patient ID (or None, for every patient) to the keys of the statistics cached for it.
+        self._statsKeys = {}
+        # Dictionary mapping the key of each cached date query to a tuple (first encoded date, last encoded date, set of
+        # the patient IDs in its results).
+        self._dateKeys = {}
+        # Counters of how well the cache is working.
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        # The store being watched.
+        self._store = None
+
+    def attach(self, store):
+        """
+        Starts watching a store for changes. The cache is emptied, since its results may belong to another store.
+
+        store: The VisitStore the cached queries are run on.
+        """
+        if self._store is not None:
+            self.detach()
+        self.clear()
+        self._store = store
+        store.subscribe(self._onChange)
+
+    def detach(self):
+        """
+        Stops watching the store, and empties the cache.
+        """
+        self._store.unsubscribe(self._onChange)
+        self._store = None
+        self.clear()
+
+    def stats(self, patientId, compute, full=False):
+        """
+        Returns the cached statistics of a patient, computing and caching them first if needed.
+
+        patientId: The ID of the patient, or None for every patient.
+        compute: A function with no arguments which computes the statistics.
+        full: True if compute gives every statistic rather than only the running ones, so both kinds can be cached.
+        """
+        key = ('stats', patientId, full)
+        if self._lookUp(key):
+            return self._entries[key]
+        result = compute()
+        self._statsKeys.setdefault(patientId, set()).add(key)
+        self._remember(key, result)
+        return result
+
+    def visitsByDate(self, dateRange, compute):
+        """
+        Returns the cached visits in a range of dates, computing and caching them first if needed.
+
+        dateRange: A tuple (first encoded date, last encoded date) of the range (see encodeDate), or None for a query
+        which finds no visits.
+        compute: A function with no arguments which finds the visits, as a list of (patient ID, visit) tuples.
+        Returns a new list of the visits.
+        """
+        key = ('visits', dateRange)
+        if self._lookUp(key):
+            return list(self._entries[key])
+        result = compute()
+        if dateRange is not None:
+            self._dateKeys[key] = (dateRange[0], dateRange[1], {patientId for patientId, visit in result})
+        self._remember(key, result)
+        return list(result)
+
+    def info(self):
+        """
+        Returns a dictionary with the number of 'hits', 'misses', 'evictions' (results dropped to make room) and
+        'invalidations' (results dropped because of a change) so far, and the current number of 'entries' and
+        'maxEntries'.
+        """
+        return dict(self._counters, entries=len(self._entries), maxEntries=self.maxEntries)
+
+    def clear(self):
+        """
+        Drops every cached result. The counters are kept.
+        """
+        self._entries.clear()
+        self._statsKeys.clear()
+        self._dateKeys.clear()
+
+    def _lookUp(self, key):
+        # Counts a hit, marking the result as the most recently used, or counts a miss.
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return True
+        self._counters['misses'] += 1
+        return False
+
+    def _remember(self, key, result):
+        # Caches a result, evicting the least recently used results while the cache is too large.
+        self._entries[key] = result
+        while len(self._entries) > self.maxEntries:
+            self._drop(next(iter(self._entries)))
+            self._counters['evictions'] += 1
+
+    def _drop(self, key):
+        # Drops a cached result along with what is recorded about what it depends on.
+        del self._entries[key]
+        if key[0] == 'stats':
+            keys = self._statsKeys[key[1]]
+            keys.discard(key)
+            if not keys:
+                del self._statsKeys[key[1]]
+        else:
+            self._dateKeys.pop(key, None)
+
+    def _invalidate(self, keys):
+        # Drops the results which a change has made out of date.
+        for key in list(keys):
+            if key in self._entries:
+                self._drop(key)
+                self._counters['invalidations'] += 1
+
+    def _onChange(self, event, patientId, row):
+        # Drops the results affected by a change to the store.
+        if event == 'load':
+            self._counters['invalidations'] += len(self._entries)
+            self.clear()
+            return
+        self._invalidate(self._statsKeys.get(patientId, ()))
+        self._invalidate(self._statsKeys.get(None, ()))
+        if event == 'add':
+            # A visit whose date cannot be encoded is not found by date queries, but drops them all to be safe.
+            date = encodeDate(self._store.visitAt(row)[0])
+            self._invalidate([key for key, (first, last, patientIds) in self._dateKeys.items()
+                              if date is None or first <= date <= last])
+        else:
+            self._invalidate([key for key, (first, last, patientIds) in self._dateKeys.items()
+                              if patientId in patientIds])
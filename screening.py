@@ -0,0 +1,380 @@
+import json
+import operator
+from functools import reduce
+
+from instrumentation import metrics
+from visitstore import VITAL_TYPECODES, VITALS, VisitStore
+
+# NumPy is used to check every visit against the rules in a few batched array operations when it is installed. Without
+# it, the visits are checked one at a time with plain Python.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Rules used to decide whether a patient needs a follow-up visit, in the order they are checked. Each rule is a
+# dictionary with a 'name', and one of the following forms:
+# {'vital': vital sign, 'above': threshold} or {'vital': vital sign, 'below': threshold}: Fires for a visit when the
+# vital sign is above (or below) the threshold.
+# {'vital': vital sign, 'rising': n} or {'vital': vital sign, 'falling': n}: Fires for a visit when the vital sign
+# strictly rose (or fell) from each visit to the next across the patient's last n visits, ending with this one.
+# {'all': [rules]} or {'any': [rules]}: Fires for a visit when all (or any) of the rules fire for it. The rules inside
+# do not need names.
+FOLLOW_UP_RULES = (
+    {'name': 'heart rate above 100', 'vital': 'heart rate', 'above': 100},
+    {'name': 'heart rate below 60', 'vital': 'heart rate', 'below': 60},
+    {'name': 'systolic blood pressure above 140', 'vital': 'systolic blood pressure', 'above': 140},
+    {'name': 'diastolic blood pressure above 90', 'vital': 'diastolic blood pressure', 'above': 90},
+    {'name': 'oxygen saturation below 90', 'vital': 'oxygen saturation', 'below': 90},
+)
+
+# Comparison used by each form of rule, by the key which holds the rule's threshold or number of visits.
+_COMPARISONS = {'above': operator.gt, 'below': operator.lt, 'rising': operator.gt, 'falling': operator.lt}
+
+
+class CompiledRule:
+    """
+    A rule in the same form as FOLLOW_UP_RULES, turned into the functions which check it, so that it is only parsed once
+    however many visits it is checked against.
+    """
+
+    def __init__(self, name, window, masks, check):
+        # The name of the rule.
+        self.name = name
+        # The number of visits, up to and including the one being checked, that the rule needs to look at.
+        self.window = window
+        # Function taking a _Columns and returning a NumPy boolean array which is True for each row the rule fires for.
+        self.masks = masks
+        # Function taking a list of a patient's most recent visit lists (the visit being checked last) and returning
+        # True if the rule fires for the last visit.
+        self.check = check
+        # The dictionary the rule was compiled from, or None. Kept so the rule can also be checked in other ways, such
+        # as by SQLiteBackend.
+        self.source = None
+
+    def __repr__(self):
+        return 'CompiledRule(%r)' % self.name
+
+
+def compileRules(rules):
+    """
+    Compiles a list of rules in the same form as FOLLOW_UP_RULES. Rules which are already compiled are kept as they are.
+
+    rules: The rules to compile.
+    Returns a tuple of CompiledRule objects, in the same order as the rules. Raises ValueError if a rule is not valid.
+    """
+    compiledRules = []
+    for rule in rules:
+        if isinstance(rule, CompiledRule):
+            compiledRules.append(rule)
+        elif not isinstance(rule, dict) or not isinstance(rule.get('name'), str):
+            raise ValueError('Every rule must be a dictionary with a name: %r' % (rule,))
+        else:
+            compiledRule = _compileRule(rule, rule['name'])
+            compiledRule.source = rule
+            compiledRules.append(compiledRule)
+    return tuple(compiledRules)
+
+
+def loadRules(fileName):
+    """
+    Reads a list of rules in the same form as FOLLOW_UP_RULES from a JSON file, and compiles them.
+
+    fileName: The name of the JSON file.
+    Returns a tuple of CompiledRule objects. Raises OSError if the file cannot be read, and ValueError if it is not valid
+    JSON or a rule is not valid.
+    """
+    with open(fileName) as rulesFile:
+        rules = json.load(rulesFile)
+    if not isinstance(rules, list):
+        raise ValueError("The rules in '%s' must be a list." % fileName)
+    return compileRules(rules)
+
+
+def _compileRule(rule, name):
+    # Rules which combine other rules fire when all (or any) of them fire.
+    if 'all' in rule or 'any' in rule:
+        combineAll = 'all' in rule
+        parts = rule['all'] if combineAll else rule['any']
+        if not isinstance(parts, list) or not parts or not all(isinstance(part, dict) for part in parts):
+            raise ValueError("Rule '%s' must combine a list of at least one rule." % name)
+        parts = [_compileRule(part, name) for part in parts]
+        window = max(part.window for part in parts)
+        if combineAll:
+            return CompiledRule(name, window,
+                                lambda columns: reduce(numpy.logical_and, [part.masks(columns) for part in parts]),
+                                lambda visits: all(part.check(visits) for part in parts))
+        return CompiledRule(name, window,
+                            lambda columns: reduce(numpy.logical_or, [part.masks(columns) for part in parts]),
+                            lambda visits: any(part.check(visits) for part in parts))
+
+    # Every other rule is about a single vital sign.
+    vital = rule.get('vital')
+    if vital not in VITALS:
+        raise ValueError("Rule '%s' must name one of the vital signs: %s." % (name, ', '.join(VITALS)))
+    position = VITALS.index(vital) + 1
+    keys = [key for key in _COMPARISONS if key in rule]
+    if len(keys) != 1:
+        raise ValueError("Rule '%s' must have exactly one of: %s." % (name, ', '.join(_COMPARISONS)))
+    key = keys[0]
+    comparison = _COMPARISONS[key]
+
+    # A threshold rule compares the visit's vital sign with the threshold.
+    if key in ('above', 'below'):
+        threshold = rule[key]
+        if isinstance(threshold, bool) or not isinstance(threshold, (int, float)):
+            raise ValueError("The threshold of rule '%s' must be a number." % name)
+        return CompiledRule(name, 1,
+                            lambda columns: comparison(columns.values(vital), threshold),
+                            lambda visits: comparison(visits[-1][position], threshold))
+
+    # A trend rule compares the vital sign of each of the last visits with the visit before it. A patient with fewer
+    # visits than the rule looks at never fires it.
+    count = rule[key]
+    if isinstance(count, bool) or not isinstance(count, int) or count < 2:
+        raise ValueError("The number of visits in rule '%s' must be a whole number of at least 2." % name)
+
+    def trendMasks(columns):
+        masks = columns.samePatient(count - 1)
+        for shift in range(count - 1):
+            masks &= comparison(columns.values(vital, shift), columns.values(vital, shift + 1))
+        return masks
+
+    def trendCheck(visits):
+        if len(visits) < count:
+            return False
+        recent = visits[-count:]
+        return all(comparison(later[position], earlier[position]) for earlier, later in zip(recent, recent[1:]))
+
+    return CompiledRule(name, count, trendMasks, trendCheck)
+
+
+class _Columns:
+    """
+    The columns of a VisitStore as NumPy arrays, in the order of a selection of rows which lists the rows of each
+    patient together, in the order of their visits. Shifted copies of the columns, used by trend rules to compare a
+    visit with the visits before it, are only built once.
+    """
+
+    def __init__(self, store, rows):
+        self._store = store
+        self._selection = numpy.frombuffer(rows, dtype=numpy.int64)
+        self._cache = {}
+
+    def values(self, vital, shift=0):
+        # Returns the vital sign of each selected row, or of the row the given number of places before it.
+        key = (vital, shift)
+        if key not in self._cache:
+            if shift == 0:
+                typecode = VITAL_TYPECODES[VITALS.index(vital)]
+                self._cache[key] = numpy.frombuffer(self._store.column(vital), dtype=typecode)[self._selection]
+            else:
+                self._cache[key] = self._shift(self.values(vital), shift)
+        return self._cache[key]
+
+    def patientIds(self, shift=0):
+        # Returns the patient ID of each selected row, or of the row the given number of places before it.
+        key = (None, shift)
+        if key not in self._cache:
+            if shift == 0:
+                self._cache[key] = numpy.frombuffer(self._store.patientIdColumn(), dtype=numpy.int64)[self._selection]
+            else:
+                self._cache[key] = self._shift(self.patientIds(), shift)
+        return self._cache[key]
+
+    def samePatient(self, shift):
+        # Returns a mask which is True for each selected row that has at least the given number of rows of the same
+        # patient before it. Since the rows of each patient are together, only the row that many places before it needs
+        # to be checked.
+        masks = self.patientIds() == self.patientIds(shift)
+        masks[:shift] = False
+        return masks
+
+    def __len__(self):
+        return len(self._selection)
+
+    @staticmethod
+    def _shift(values, shift):
+        # The first rows, which have nothing that many places before them, keep their own value.
+        shifted = values.copy()
+        shifted[shift:] = values[:len(values) - shift]
+        return shifted
+
+
+def screenPatients(patients, rules=FOLLOW_UP_RULES):
+    """
+    Finds the patients with at least one visit for which a rule fires. For each of these patients, the first such visit
+    is reported along with the first rule that fired for it.
+
+    patients: A VisitStore, or a dictionary of patient IDs where each patient has a list of visits.
+    rules: The rules to check, in the same form as FOLLOW_UP_RULES, or compiled by compileRules.
+    Returns a list of (patient ID, rule name, visit index, visit) tuples, one for each flagged patient, in the same order
+    as the patients. The visit index is the position of the visit in the patient's list of visits.
+    """
+    rules = compileRules(rules)
+    # A dictionary is screened with plain Python, straight from its visit lists. Copying it into a VisitStore would cost
+    # more than the screening, and the typed columns of a store cannot hold every value a dictionary can.
+    if not isinstance(patients, VisitStore):
+        return _screenVisits(patients, rules) if rules else []
+    store = patients
+    if store.visitCount() == 0 or not rules:
+        return []
+
+    # Finds the first flagged row of each patient, and the rule that fired for it. The rows are listed patient by
+    # patient, so that trend rules can look back through each patient's visits.
+    rows = store.selectRows(list(store))
+    metrics.count('visits_scanned', len(rows), operation='screenPatients')
+    if numpy is not None:
+        firstFlagged = _screenWithNumpy(store, rows, rules)
+    else:
+        firstFlagged = _screenRows(store, rows, rules)
+
+    # Lists the flagged patients in order, working out where each flagged row is in the patient's list of visits.
+    flagged = []
+    for patientId in store:
+        if patientId not in firstFlagged:
+            continue
+        ruleIndex, row = firstFlagged[patientId]
+        flagged.append((patientId, rules[ruleIndex].name, store.positionOf(patientId, row), store.visitAt(row)))
+    return flagged
+
+
+def _screenWithNumpy(store, rows, rules):
+    # Checks every selected row against every rule at once, giving one boolean mask per rule.
+    columns = _Columns(store, rows)
+    masks = numpy.empty((len(rules), len(columns)), dtype=bool)
+    for index, rule in enumerate(rules):
+        masks[index] = rule.masks(columns)
+
+    # Keeps the rows for which any rule fired, and the first rule that fired for each of them.
+    positions = numpy.flatnonzero(masks.any(axis=0))
+    if len(positions) == 0:
+        return {}
+    ruleIndexes = masks[:, positions].argmax(axis=0)
+    flaggedRows = numpy.frombuffer(rows, dtype=numpy.int64)[positions]
+
+    # Groups the flagged rows by patient. The rows of each patient are in the order of their visits, so the first
+    # flagged row found for a patient is their first flagged visit.
+    uniqueIds, firstPositions = numpy.unique(columns.patientIds()[positions], return_index=True)
+    return dict(zip(uniqueIds.tolist(), zip(ruleIndexes[firstPositions].tolist(),
+                                            flaggedRows[firstPositions].tolist())))
+
+
+def _screenVisits(patients, rules):
+    # Screens the visit lists of a dictionary of patients one visit at a time, in the same way as _screenRows.
+    window = max(rule.window for rule in rules)
+    flagged = []
+    for patientId in patients:
+        visits = patients[patientId]
+        for index, visit in enumerate(visits):
+            recent = visits[max(index + 1 - window, 0):index + 1]
+            rule = next((rule for rule in rules if rule.check(recent)), None)
+            if rule is not None:
+                flagged.append((patientId, rule.name, index, visit))
+                break
+    return flagged
+
+
+def _screenRows(store, rows, rules):
+    # Checks the selected rows one at a time, keeping each patient's most recent visits for the trend rules, and
+    # stopping at the first rule that fires for each row.
+    window = max(rule.window for rule in rules)
+    patientIds = store.patientIdColumn()
+    firstFlagged = {}
+    visits = []
+    previousId = None
+    for row in rows:
+        patientId = patientIds[row]
+        if patientId != previousId:
+            visits = []
+            previousId = patientId
+        if patientId in firstFlagged:
+            continue
+        visits.append(store.visitAt(row))
+        del visits[:-window]
+        for index, rule in enumerate(rules):
+            if rule.check(visits):
+                firstFlagged[patientId] = (index, row)
+                break
+    return firstFlagged
+
+
+class FollowUpMonitor:
+    """
+    Keeps the list of patients who need a follow-up visit up to date as visits are added to a VisitStore. The whole
+    store is screened once (see screenPatients) when the monitor is attached to it. After that, each new visit is
+    checked on its own against the patient's most recent visits, so the flagged patients never need to be found again
+    from scratch. A visit dated before the patient's most recent visit only screens that patient again.
+    """
+
+    def __init__(self, rules=FOLLOW_UP_RULES):
+        # The compiled rules, and the number of most recent visits they need to look at.
+        self._rules = compileRules(rules)
+        self._window = max((rule.window for rule in self._rules), default=1)
+        # The store being watched.
+        self._store = None
+        # Dictionary mapping each flagged patient ID to a tuple (rule name, visit index, visit) for the first visit a
+        # rule fired for.
+        self._flagged = {}
+
+    def attach(self, store):
+        """
+        Screens every visit in a store, and then watches it for changes.
+
+        store: The VisitStore to watch.
+        """
+        if self._store is not None:
+            self.detach()
+        self._store = store
+        self._rescreen()
+        store.subscribe(self._onChange)
+
+    def detach(self):
+        """
+        Stops watching the store.
+        """
+        self._store.unsubscribe(self._onChange)
+        self._store = None
+
+    def flagged(self):
+        """
+        Returns the patients who need a follow-up visit, in the same form as screenPatients.
+        """
+        return [(patientId,) + self._flagged[patientId] for patientId in self._store if patientId in self._flagged]
+
+    def reason(self, patientId):
+        """
+        Returns the tuple (rule name, visit index, visit) for the first visit of a patient that a rule fired for, or None
+        if the patient does not need a follow-up visit.
+
+        patientId: The ID of the patient.
+        """
+        return self._flagged.get(patientId)
+
+    def _rescreen(self):
+        # Screens every visit in the store.
+        self._flagged = {flagged[0]: flagged[1:] for flagged in screenPatients(self._store, self._rules)}
+
+    def _onChange(self, event, patientId, row):
+        # Checks a new visit against the patient's most recent visits, unless the patient is already flagged.
+        if event == 'add':
+            visits = self._store[patientId]
+            # A visit dated before the patient's most recent visit goes in among their earlier visits, which can change
+            # which visit is flagged first, or whether a trend rule fires at all, so the patient is screened again.
+            if self._store.positionOf(patientId, row) != len(visits) - 1:
+                self._flagged.pop(patientId, None)
+                for flagged in screenPatients({patientId: list(visits)}, self._rules):
+                    self._flagged[patientId] = flagged[1:]
+                return
+            if patientId in self._flagged:
+                return
+            recent = visits[max(len(visits) - self._window, 0):]
+            for rule in self._rules:
+                if rule.check(recent):
+                    self._flagged[patientId] = (rule.name, len(visits) - 1, recent[-1])
+                    break
+        elif event == 'remove':
+            self._flagged.pop(patientId, None)
+        else:
+            self._rescreen()
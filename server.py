@@ -0,0 +1,578 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import deque
+from itertools import islice
+from urllib.parse import parse_qs, urlsplit
+
+from cohort import CohortQuery
+from main import (bulkAddPatientData, findVisitsByDate, iterPatientVisits, loadPatients, readFollowUpRules,
+                  removePatientVisits, saveSnapshot, syncPatientsFile, FOLLOW_UP_RULES_FILE, VISITS_PER_PAGE)
+from instrumentation import metrics
+from querycache import QueryCache
+from screening import FollowUpMonitor
+from validation import visitRecords
+from visitstore import VisitStore
+from vitalstats import computeVitalStats, percentile, runningVitalStats
+
+
+# Largest number of visits a single request can ask for. Requests for more visits must be made one page at a time.
+MAX_VISITS_PER_REQUEST = 10000
+
+# Number of most recent request latencies kept for each endpoint, from which the latency percentiles are reported.
+LATENCY_SAMPLES = 10000
+
+# Percentiles of the request latencies reported by the /latency endpoint and by runLoadTest.
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# Reason phrases of the HTTP status codes the server responds with.
+_STATUS_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                   500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    """
+    Raised by a request handler to respond with an error status and message instead of a result.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class PatientServer:
+    """
+    Serves the operations of the menu in main (displaying visits, statistics, finding visits by date, finding patients
+    who need a follow-up, adding visits and deleting patients), along with cohort queries (see CohortQuery), as JSON
+    over HTTP, keeping the patients in memory between requests so that many clinicians can use the same data at once.
+
+    Everything runs in one asyncio event loop. Requests which only read the patients are answered straight away and
+    never wait for each other. Requests which change the patients or the patient file are put in a queue and carried out
+    one at a time by a single writer task, so writes never overlap. Adds which are waiting in the queue together are
+    saved with a single call to bulkAddPatientData.
+
+    The server can be used without HTTP through handle, which InProcessClient wraps for local testing.
+    """
+
+    def __init__(self, patients, fileName, rules=None):
+        # The patients being served, and the file they are saved to.
+        self.patients = patients
+        self.fileName = fileName
+        # Keeps the patients who need a follow-up up to date as visits are added and patients are deleted.
+        self.followUps = FollowUpMonitor(readFollowUpRules(FOLLOW_UP_RULES_FILE) if rules is None else rules)
+        self.followUps.attach(patients)
+        # Keeps the results of recent statistics and date queries, which dashboards repeat many times.
+        self.cache = QueryCache()
+        self.cache.attach(patients)
+        # Queue of writes waiting for the writer task, each a tuple (kind, argument, future).
+        self._writes = None
+        self._writerTask = None
+        self._server = None
+        # Dictionary mapping each endpoint to its most recent request latencies, in seconds.
+        self._latencies = {}
+        # Endpoints, as tuples (method, path pattern, name, handler). Each handler is a coroutine taking the match of the
+        # path, the query parameters and the decoded JSON body. Latencies are recorded under the method and name.
+        self._routes = [
+            ('GET', re.compile(r'/visits'), '/visits', self._getVisits),
+            ('GET', re.compile(r'/visits/by-date'), '/visits/by-date', self._getVisitsByDate),
+            ('GET', re.compile(r'/stats'), '/stats', self._getStats),
+            ('GET', re.compile(r'/follow-up'), '/follow-up', self._getFollowUp),
+            ('GET', re.compile(r'/cohort'), '/cohort', self._getCohort),
+            ('GET', re.compile(r'/latency'), '/latency', self._getLatency),
+            ('GET', re.compile(r'/cache'), '/cache', self._getCache),
+            ('GET', re.compile(r'/metrics'), '/metrics', self._getMetrics),
+            ('POST', re.compile(r'/visits'), '/visits', self._postVisits),
+            ('DELETE', re.compile(r'/patients/(-?\d+)'), '/patients/{id}', self._deletePatient),
+        ]
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """
+        Starts the writer task, and starts listening for HTTP requests.
+
+        host: The address to listen on.
+        port: The port to listen on, or 0 to pick any free port.
+        Returns the port being listened on.
+        """
+        self.startWriter()
+        self._server = await asyncio.start_server(self._serveConnection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    def startWriter(self):
+        """
+        Starts the writer task, which must be running before any writes are handled. Called by start, and by
+        InProcessClient when the server is used without HTTP.
+        """
+        if self._writerTask is None:
+            self._writes = asyncio.Queue()
+            self._writerTask = asyncio.get_running_loop().create_task(self._writer())
+
+    async def stop(self):
+        """
+        Stops listening for requests, waits for the queued writes to finish, and forces the patient file onto the disk.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._writerTask is not None:
+            await self._writes.join()
+            self._writerTask.cancel()
+            self._writerTask = None
+        syncPatientsFile(self.fileName)
+
+    async def handle(self, method, target, body=None):
+        """
+        Handles one request.
+
+        method: The HTTP method of the request, such as 'GET'.
+        target: The path of the request, with its query string.
+        body: The JSON body of the request as a string or bytes, or None if it has no body.
+        Returns a tuple (HTTP status code, response). The response is JSON-compatible, or a string of plain text for
+        /metrics.
+        """
+        start = time.perf_counter()
+        url = urlsplit(target)
+        endpoint = None
+        try:
+            # Finds the endpoint for the path, and checks that it accepts the method.
+            matches = [(routeMethod, match, name, handler) for routeMethod, pattern, name, handler in self._routes
+                       for match in [pattern.fullmatch(url.path)] if match]
+            if not matches:
+                raise RequestError(404, 'There is no endpoint %s.' % url.path)
+            handlers = [(match, name, handler) for routeMethod, match, name, handler in matches if routeMethod == method]
+            if not handlers:
+                raise RequestError(405, 'The endpoint %s does not accept %s requests.' % (url.path, method))
+            match, name, handler = handlers[0]
+            endpoint = method + ' ' + name
+
+            # Decodes the query parameters (keeping the last value of each) and the JSON body.
+            query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            try:
+                data = None if not body else json.loads(body)
+            except ValueError:
+                raise RequestError(400, 'The body of the request is not valid JSON.')
+            status, response = 200, await handler(match, query, data)
+        except RequestError as error:
+            status, response = error.status, {'error': str(error)}
+        except Exception:
+            status, response = 500, {'error': 'An unexpected error occurred while handling the request.'}
+
+        # Records how long the request took, under its endpoint.
+        if endpoint is not None:
+            seconds = time.perf_counter() - start
+            samples = self._latencies.setdefault(endpoint, deque(maxlen=LATENCY_SAMPLES))
+            samples.append(seconds)
+            metrics.observe('request', seconds, endpoint=endpoint, status=status)
+        return status, response
+
+    def latencyPercentiles(self):
+        """
+        Returns a dictionary mapping each endpoint to its number of recent requests and the percentiles
+        (LATENCY_PERCENTILES) of their latencies, in milliseconds.
+        """
+        report = {}
+        for endpoint, samples in self._latencies.items():
+            ordered = sorted(samples)
+            report[endpoint] = {'requests': len(ordered)}
+            for point in LATENCY_PERCENTILES:
+                report[endpoint]['p%d' % point] = percentile(ordered, point) * 1000
+        return report
+
+    # The handlers below answer the requests which only read the patients.
+
+    async def _getVisits(self, match, query, data):
+        # Lists the visits of every patient, or of one patient, one page at a time.
+        patientId = _intParameter(query, 'patientId', 0)
+        offset, limit = _pageParameters(query)
+        if patientId != 0 and patientId not in self.patients:
+            raise RequestError(404, 'No data found for patient with ID %d' % patientId)
+        return {'visits': [[patient, list(visit)] for patient, visit in
+                           iterPatientVisits(self.patients, patientId, offset, limit)]}
+
+    async def _getVisitsByDate(self, match, query, data):
+        # Lists the visits in a year, or in a month of a year, one page at a time.
+        year = _intParameter(query, 'year', None)
+        month = _intParameter(query, 'month', None)
+        offset, limit = _pageParameters(query)
+        visits = findVisitsByDate(self.patients, year, month, self.cache)
+        return {'visits': [[patient, list(visit)] for patient, visit in visits[offset:offset + limit]]}
+
+    async def _getStats(self, match, query, data):
+        # Gives the mean and standard deviation of each vital sign from the running totals, or every statistic if
+        # 'full' is given.
+        patientId = _intParameter(query, 'patientId', 0)
+        if patientId != 0 and patientId not in self.patients:
+            raise RequestError(404, 'No data found for patient with ID %d' % patientId)
+        patientId = None if patientId == 0 else patientId
+        if query.get('full') in ('1', 'true'):
+            return self.cache.stats(patientId, lambda: computeVitalStats(self.patients, None if patientId is None
+                                                                         else [patientId]), full=True)
+        return self.cache.stats(patientId, lambda: runningVitalStats(self.patients, patientId))
+
+    async def _getFollowUp(self, match, query, data):
+        # Lists the patients who need a follow-up visit, with the rule that flagged them and the visit it fired for, one
+        # page at a time.
+        offset, limit = _pageParameters(query)
+        flagged = ((patientId, reason) for patientId in self.patients
+                   for reason in [self.followUps.reason(patientId)] if reason is not None)
+        return {'patients': [{'patientId': patientId, 'rule': rule, 'visitIndex': visitIndex, 'visit': list(visit)}
+                             for patientId, (rule, visitIndex, visit) in islice(flagged, offset, offset + limit)]}
+
+    async def _getCohort(self, match, query, data):
+        # Lists the visits which match a filter (see CohortQuery), given as JSON in the 'where' parameter, one page at a
+        # time. The visits are found as they are needed, so only the visits up to the end of the page are looked for.
+        try:
+            cohort = CohortQuery(json.loads(query.get('where', '')))
+        except ValueError as error:
+            raise RequestError(400, "The parameter 'where' must be a filter in JSON: %s" % error)
+        offset, limit = _pageParameters(query)
+        return {'plan': cohort.plan(self.patients),
+                'visits': [[patient, visit] for patient, visit in
+                           islice(cohort.visits(self.patients), offset, offset + limit)]}
+
+    async def _getLatency(self, match, query, data):
+        return self.latencyPercentiles()
+
+    async def _getCache(self, match, query, data):
+        # Gives the counters of the query cache, to help choose its size.
+        return self.cache.info()
+
+    async def _getMetrics(self, match, query, data):
+        # Gives the metrics in the Prometheus text format, for Prometheus to scrape. The metrics are only recorded if
+        # they were switched on with the PATIENTS_METRICS environment variable (see instrumentation).
+        return metrics.export()
+
+    # The handlers below change the patients, so their work is queued for the writer task.
+
+    async def _postVisits(self, match, query, data):
+        # Adds a visit, or a list of visits, each a list [patient ID, date, temperature, heart rate, respiratory rate,
+        # systolic blood pressure, diastolic blood pressure, oxygen saturation].
+        if not isinstance(data, list) or not data:
+            raise RequestError(400, 'The body must be a visit or a list of visits.')
+        visits = data if isinstance(data[0], list) else [data]
+        # Every visit of a list must itself be a list, so a request which mixes visits with other values is turned away
+        # here rather than failing while it is saved with other requests' visits.
+        if not all(isinstance(visit, list) for visit in visits):
+            raise RequestError(400, 'The body must be a visit or a list of visits.')
+        return await self._queueWrite('add', visits)
+
+    async def _deletePatient(self, match, query, data):
+        # Deletes all visits of a patient.
+        patientId = int(match.group(1))
+        if patientId not in self.patients:
+            raise RequestError(404, 'No data found for patient with ID %d' % patientId)
+        return await self._queueWrite('delete', patientId)
+
+    async def _queueWrite(self, kind, argument):
+        # Queues a write for the writer task, and waits for its result.
+        if self._writerTask is None:
+            raise RequestError(500, 'The server is not accepting changes.')
+        future = asyncio.get_running_loop().create_future()
+        await self._writes.put((kind, argument, future))
+        return await future
+
+    async def _writer(self):
+        # Carries out the queued writes in the order they were queued, one at a time. Takes every write waiting in the
+        # queue at once, so that adds which are waiting next to each other can be saved with one call to
+        # bulkAddPatientData.
+        while True:
+            writes = [await self._writes.get()]
+            while not self._writes.empty():
+                writes.append(self._writes.get_nowait())
+            position = 0
+            while position < len(writes):
+                end = position + 1
+                if writes[position][0] == 'add':
+                    while end < len(writes) and writes[end][0] == 'add':
+                        end += 1
+                self._carryOut(writes[position:end])
+                position = end
+            for _ in writes:
+                self._writes.task_done()
+
+    def _carryOut(self, writes):
+        # Carries out a single delete, or several adds at once. An error is only passed on to the requests it belongs
+        # to, so one bad request never fails the other writes waiting with it.
+        if writes[0][0] != 'add':
+            kind, patientId, future = writes[0]
+            try:
+                # The patient may have been deleted while the request was waiting in the queue.
+                if removePatientVisits(self.patients, patientId, self.fileName):
+                    future.set_result({'deleted': patientId})
+                else:
+                    future.set_exception(RequestError(404, 'No data found for patient with ID %d' % patientId))
+            except Exception as error:
+                future.set_exception(error)
+            return
+
+        # Goes through the visits of each add on its own first, so that an add whose visits cannot even be read only
+        # fails its own request. The rest are then saved together.
+        readable = []
+        for kind, requestVisits, future in writes:
+            try:
+                list(visitRecords(requestVisits))
+            except Exception as error:
+                future.set_exception(error)
+            else:
+                readable.append((kind, requestVisits, future))
+        if not readable:
+            return
+        try:
+            self._addVisits(readable)
+        except Exception as error:
+            for kind, argument, future in readable:
+                if not future.done():
+                    future.set_exception(error)
+
+    def _addVisits(self, writes):
+        # Saves the visits of several add requests at once. If they could not be saved, every request is told so.
+        visits = [visit for kind, requestVisits, future in writes for visit in requestVisits]
+        try:
+            report = bulkAddPatientData(self.patients, visits, self.fileName)
+        except OSError:
+            raise RequestError(500, 'The visits could not be saved.')
+        start = 0
+        for kind, requestVisits, future in writes:
+            end = start + len(requestVisits)
+            rejected = [dict(reject, position=reject['position'] - start) for reject in report['rejected']
+                        if start <= reject['position'] < end]
+            future.set_result({'added': len(requestVisits) - len(rejected), 'rejected': rejected})
+            start = end
+
+    async def _serveConnection(self, reader, writer):
+        # Answers the HTTP requests sent over one connection, until the client closes it or asks for it to be closed.
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine:
+                    break
+                parts = requestLine.decode('latin-1').split()
+                headers = {}
+                while True:
+                    headerLine = await reader.readline()
+                    if headerLine in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = headerLine.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if len(parts) != 3:
+                    status, response = 400, {'error': 'The request line is not valid.'}
+                else:
+                    status, response = await self.handle(parts[0], parts[1], body)
+                keepAlive = parts[-1:] == ['HTTP/1.1'] and headers.get('connection', '').lower() != 'close'
+
+                # A string response is sent as plain text, and anything else as JSON.
+                if isinstance(response, str):
+                    payload, contentType = response.encode(), 'text/plain; version=0.0.4'
+                else:
+                    payload, contentType = json.dumps(response).encode(), 'application/json'
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                              'Connection: %s\r\n\r\n' % (status, _STATUS_REASONS[status], contentType, len(payload),
+                                                          'keep-alive' if keepAlive else 'close')).encode() + payload)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def _intParameter(query, name, default):
+    # Reads a whole number query parameter.
+    if name not in query:
+        return default
+    try:
+        return int(query[name])
+    except ValueError:
+        raise RequestError(400, "The parameter '%s' must be a whole number." % name)
+
+
+def _pageParameters(query):
+    # Reads the offset and limit of a page of visits. Pages hold VISITS_PER_PAGE visits unless a limit is given.
+    offset = _intParameter(query, 'offset', 0)
+    limit = _intParameter(query, 'limit', VISITS_PER_PAGE)
+    if offset < 0 or not 0 <= limit <= MAX_VISITS_PER_REQUEST:
+        raise RequestError(400, 'The offset must be at least 0, and the limit from 0 to %d.' % MAX_VISITS_PER_REQUEST)
+    return offset, limit
+
+
+class InProcessClient:
+    """
+    Sends requests straight to a PatientServer's handle method, without going through HTTP, so that the server can be
+    tested and measured in the same process. Must be used inside a running event loop.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        server.startWriter()
+
+    async def get(self, target):
+        """
+        Sends a GET request, returning a tuple (HTTP status code, response).
+        """
+        return await self.server.handle('GET', target)
+
+    async def post(self, target, data):
+        """
+        Sends a POST request with data encoded as its JSON body, returning a tuple (HTTP status code, response).
+        """
+        return await self.server.handle('POST', target, json.dumps(data))
+
+    async def delete(self, target):
+        """
+        Sends a DELETE request, returning a tuple (HTTP status code, response).
+        """
+        return await self.server.handle('DELETE', target)
+
+
+async def runLoadTest(server, clients=50, requestsPerClient=100, writeRatio=0.1, seed=0):
+    """
+    Measures the server's latencies while many clients send requests at the same time through InProcessClient. Each
+    client sends a mix of reads (visits of a patient, visits in a month, statistics and follow-ups) and adds of visits.
+
+    server: The PatientServer to measure. The visits added are saved to its patient file.
+    clients: The number of clients sending requests at the same time.
+    requestsPerClient: The number of requests sent by each client, one after another.
+    writeRatio: The fraction of requests which add a visit.
+    seed: The seed of the random number generator used to pick the requests.
+    Returns the server's latency percentiles (see PatientServer.latencyPercentiles), along with the total number of
+    requests and the number of requests per second under '*'.
+    """
+    generator = random.Random(seed)
+    client = InProcessClient(server)
+    patientIds = list(islice(server.patients, 1000)) or [1]
+
+    async def runClient():
+        for _ in range(requestsPerClient):
+            patientId = generator.choice(patientIds)
+            choice = generator.random()
+            if choice < writeRatio:
+                await client.post('/visits', [patientId, '2024-%02d-%02d' % (generator.randint(1, 12),
+                                                                              generator.randint(1, 28)),
+                                              37.0, 72, 16, 120, 80, 97])
+            elif choice < writeRatio + (1 - writeRatio) / 4:
+                await client.get('/visits?patientId=%d' % patientId)
+            elif choice < writeRatio + (1 - writeRatio) / 2:
+                await client.get('/visits/by-date?year=%d&month=%d' % (generator.randint(2000, 2024),
+                                                                        generator.randint(1, 12)))
+            elif choice < writeRatio + 3 * (1 - writeRatio) / 4:
+                await client.get('/stats?patientId=%d' % patientId)
+            else:
+                await client.get('/follow-up')
+            # Gives the other clients a turn, as a client waiting on the network would.
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(runClient() for _ in range(clients)))
+    seconds = time.perf_counter() - start
+    report = server.latencyPercentiles()
+    report['*'] = {'requests': clients * requestsPerClient, 'requestsPerSecond': clients * requestsPerClient / seconds}
+    return report
+
+
+async def runChecks():
+    """
+    Checks a few requests from end to end through InProcessClient, on a new patient file in a temporary directory: a
+    visit which is added can be read back and deleted without the server printing anything, deleting a patient who does
+    not exist is answered with 404, a body which is not a visit or not valid JSON is answered with 400, an add which
+    fails does not fail another add saved with it, and visits which cannot be saved are answered with 500 instead of
+    being reported as added. Everything the server prints is hidden. Raises AssertionError if a check fails.
+    """
+    visit = [7, '2024-03-05', 37.0, 72, 16, 120, 80, 97]
+    printed = io.StringIO()
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(printed):
+        fileName = os.path.join(directory, 'patients.txt')
+        open(fileName, 'w').close()
+        server = PatientServer(loadPatients(fileName), fileName)
+        client = InProcessClient(server)
+
+        # Adds a visit, and reads it back from the server and from the file.
+        status, response = await client.post('/visits', visit)
+        assert (status, response) == (200, {'added': 1, 'rejected': []}), response
+        status, response = await client.get('/visits?patientId=7')
+        assert (status, response) == (200, {'visits': [[7, visit[1:]]]}), response
+        with open(fileName) as patientFile:
+            assert patientFile.read() == '7,2024-03-05,37.0,72,16,120,80,97\n'
+
+        # Deletes the patient, and then a patient who does not exist.
+        printedBefore = printed.getvalue()
+        status, response = await client.delete('/patients/7')
+        assert (status, response) == (200, {'deleted': 7}), response
+        assert printed.getvalue() == printedBefore, printed.getvalue()
+        status, response = await client.get('/visits?patientId=7')
+        assert status == 404, response
+        status, response = await client.delete('/patients/8')
+        assert status == 404, response
+
+        # Sends bodies which are not valid JSON, or not a visit.
+        status, response = await server.handle('POST', '/visits', '[7, "2024-03-05", 37.0')
+        assert status == 400, response
+        status, response = await client.post('/visits', {'patientId': 7})
+        assert status == 400, response
+        status, response = await client.post('/visits', [visit, 5])
+        assert status == 400, response
+
+        # Queues an add whose visits cannot be read next to a valid add, so they are carried out together. Only the
+        # first one fails.
+        results = await asyncio.gather(server._queueWrite('add', 5), client.post('/visits', [9] + visit[1:]),
+                                       return_exceptions=True)
+        assert isinstance(results[0], TypeError), results
+        assert results[1] == (200, {'added': 1, 'rejected': []}), results
+        assert 9 in server.patients
+        await server.stop()
+
+        # Adds a visit to a patient file in a directory which does not exist, so it cannot be saved.
+        brokenServer = PatientServer(VisitStore(), os.path.join(directory, 'missing', 'patients.txt'))
+        status, response = await InProcessClient(brokenServer).post('/visits', visit)
+        assert status == 500, response
+        assert 7 not in brokenServer.patients
+        await brokenServer.stop()
+
+
+async def serve(fileName='patients.txt', host='127.0.0.1', port=8080):
+    """
+    Loads the patients from a file and serves them over HTTP until interrupted. A snapshot of the patients is saved
+    when the server stops (see main.saveSnapshot).
+
+    fileName: The name of the patient file.
+    host: The address to listen on.
+    port: The port to listen on.
+    """
+    server = PatientServer(loadPatients(fileName), fileName)
+    port = await server.start(host, port)
+    print('Serving %s on http://%s:%d/' % (fileName, host, port))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        saveSnapshot(server.patients, fileName)
+
+
+if __name__ == '__main__':
+    # 'python server.py [port]' serves patients.txt, and 'python server.py loadtest [file]' measures the latencies of a
+    # copy of the patients in memory, saving the added visits to the given file. 'python server.py check' runs
+    # runChecks.
+    if sys.argv[1:2] == ['check']:
+        asyncio.run(runChecks())
+        print('Every check passed.')
+    elif sys.argv[1:2] == ['loadtest']:
+        loadFile = sys.argv[2] if len(sys.argv) > 2 else 'loadtest.txt'
+        async def loadTest():
+            open(loadFile, 'a').close()
+            return await runLoadTest(PatientServer(loadPatients(loadFile), loadFile))
+        for endpoint, latencies in asyncio.run(loadTest()).items():
+            print(endpoint, ' '.join('%s=%.4g' % item for item in latencies.items()))
+    else:
+        try:
+            asyncio.run(serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080))
+        except KeyboardInterrupt:
+            pass
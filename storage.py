@@ -0,0 +1,661 @@
+import json
+import math
+import os
+import sqlite3
+import sys
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from cohort import CohortQuery, _dateRangeOfFilter
+from main import (bulkAddPatientData, deleteAllVisitsOfPatient, findVisitsByDate, iterPatientVisits, loadPatients,
+                  saveSnapshot, syncPatientsFile, _dateRangeOf)
+from screening import FOLLOW_UP_RULES, compileRules, screenPatients
+from validation import convertFields, rangeProblem, rejectMessage, visitRecords
+from visitstore import VITALS
+from vitalstats import runningVitalStats, statsFromTotals
+
+
+# Endings of the file names opened by openBackend as SQLite databases. Any other file is opened as a patient text file.
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+# Ending of the names opened by openBackend as sharded datasets (see ShardedBackend), which are directories of shards.
+SHARDED_EXTENSION = '.shards'
+
+# Number of shards a new sharded dataset is split into unless another number is given.
+DEFAULT_SHARD_COUNT = 8
+
+# Name of the file in the directory of a sharded dataset which records the number of shards.
+SHARD_MANIFEST = 'shards.json'
+
+# Number of visits copied at a time by migrate, so that a large dataset never has to be held in memory all at once.
+MIGRATION_BATCH_SIZE = 50000
+
+# Names of the columns of the visits table holding each vital sign, in the order of VITALS.
+_VITAL_COLUMNS = tuple(vital.replace(' ', '_') for vital in VITALS)
+
+# SQL operator used by each key of a vital sign filter (see CohortQuery).
+_FILTER_OPERATORS = {'above': '>', 'below': '<', 'atLeast': '>=', 'atMost': '<='}
+
+# Statements which create the tables and indexes of a SQLite database, if they do not exist yet. Each patient has a
+# rank, which orders the patients in the same way as a dictionary of patients: by when they were first added.
+_SQLITE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS patients (patient_id INTEGER PRIMARY KEY, rank INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS visits (id INTEGER PRIMARY KEY, patient_id INTEGER NOT NULL, date TEXT NOT NULL, '
+    'date_key INTEGER, %s)' % ', '.join('%s %s' % (column, 'REAL' if column == 'temperature' else 'INTEGER NOT NULL')
+                                        for column in _VITAL_COLUMNS),
+    'CREATE INDEX IF NOT EXISTS visits_patient_date ON visits (patient_id, date_key)',
+    'CREATE INDEX IF NOT EXISTS visits_date ON visits (date_key)',
+    'CREATE INDEX IF NOT EXISTS patients_rank ON patients (rank)',
+)
+
+# The statements used by SQLiteBackend. The values are always passed as parameters, so each statement is only compiled
+# once and then reused from the connection's cache of prepared statements.
+_VISIT_COLUMNS = 'visits.date, ' + ', '.join('visits.' + column for column in _VITAL_COLUMNS)
+_INSERT_PATIENT = 'INSERT OR IGNORE INTO patients (patient_id, rank) VALUES (?, ?)'
+_INSERT_VISIT = ('INSERT INTO visits (patient_id, date, date_key, %s) VALUES (?, ?, ?, %s)'
+                 % (', '.join(_VITAL_COLUMNS), ', '.join('?' * len(_VITAL_COLUMNS))))
+_SELECT_PATIENTS = 'SELECT patient_id FROM patients ORDER BY rank'
+_SELECT_PATIENT = 'SELECT 1 FROM patients WHERE patient_id = ?'
+_SELECT_NEXT_RANK = 'SELECT COALESCE(MAX(rank), 0) + 1 FROM patients'
+_SELECT_VISITS_OF = 'SELECT %s FROM visits WHERE patient_id = ? ORDER BY date_key, id' % _VISIT_COLUMNS
+_SELECT_LATEST_VISITS = ('SELECT * FROM (SELECT %s, date_key, id FROM visits WHERE patient_id = ? '
+                         'ORDER BY date_key DESC, id DESC LIMIT ?) ORDER BY date_key, id' % _VISIT_COLUMNS)
+_SELECT_ALL_VISITS = ('SELECT visits.patient_id, %s FROM visits JOIN patients USING (patient_id) '
+                      'ORDER BY patients.rank, visits.date_key, visits.id' % _VISIT_COLUMNS)
+_SELECT_VISITS_BETWEEN = ('SELECT visits.patient_id, %s FROM visits JOIN patients USING (patient_id) '
+                          'WHERE visits.date_key BETWEEN ? AND ? ORDER BY patients.rank, visits.date_key, visits.id'
+                          % _VISIT_COLUMNS)
+_SELECT_VISIT_COUNT = 'SELECT COUNT(*) FROM visits'
+# Finds the visits which meet a condition (filled in by SQLiteBackend.cohort).
+_SELECT_VISITS_WHERE = ('SELECT visits.patient_id, %s FROM visits JOIN patients USING (patient_id) WHERE %%s '
+                        'ORDER BY patients.rank, visits.date_key, visits.id' % _VISIT_COLUMNS)
+# Finds the earliest visit of each patient which meets a condition (filled in by SQLiteBackend.followUps), along with
+# the number of the patient's visits before it.
+_SELECT_FIRST_FLAGGED = ('WITH flagged AS (SELECT id, ROW_NUMBER() OVER (PARTITION BY patient_id '
+                         'ORDER BY date_key, id) AS number FROM visits WHERE %%s) '
+                         'SELECT visits.patient_id, (SELECT COUNT(*) FROM visits AS earlier '
+                         'WHERE earlier.patient_id = visits.patient_id '
+                         'AND (earlier.date_key, earlier.id) < (visits.date_key, visits.id)), %s '
+                         'FROM flagged JOIN visits ON visits.id = flagged.id '
+                         'JOIN patients ON patients.patient_id = visits.patient_id '
+                         'WHERE flagged.number = 1 ORDER BY patients.rank' % _VISIT_COLUMNS)
+_SELECT_TOTALS = 'SELECT COUNT(*), %s FROM visits' % ', '.join(
+    'AVG(%s), AVG(%s * %s), MIN(%s), MAX(%s)' % ((column,) * 5) for column in _VITAL_COLUMNS)
+_SELECT_PATIENT_TOTALS = _SELECT_TOTALS + ' WHERE patient_id = ?'
+_DELETE_VISITS = 'DELETE FROM visits WHERE patient_id = ?'
+_DELETE_PATIENT = 'DELETE FROM patients WHERE patient_id = ?'
+
+
+class StorageBackend(ABC):
+    """
+    Where the patients are kept. Every backend answers the same queries and makes the same changes, so the rest of the
+    program, and migrate, can work with any of them:
+    - TextBackend keeps the patients in the plaintext patient file, read into memory as a VisitStore.
+    - SQLiteBackend keeps the patients in a SQLite database, and answers queries with SQL, so the visits stay on the
+      disk until they are needed.
+
+    Visit lists have the same form as in a dictionary of patients: [date, temperature, heart rate, respiratory rate,
+    systolic blood pressure, diastolic blood pressure, oxygen saturation]. Patients are listed in the order they were
+    first added, and each patient's visits in date order, with visits on the same date in the order they were added.
+
+    Every method below is abstract, so a backend which leaves any of them out cannot be created.
+    """
+
+    @abstractmethod
+    def patientIds(self):
+        """
+        Returns a list of the IDs of every patient.
+        """
+
+    @abstractmethod
+    def visitCount(self):
+        """
+        Returns the number of visits of every patient.
+        """
+
+    @abstractmethod
+    def visitsOf(self, patientId):
+        """
+        Returns a list of the visits of a patient. Raises KeyError if the patient is not found.
+        """
+
+    @abstractmethod
+    def latestVisits(self, patientId, count=1):
+        """
+        Returns a list of the most recent visits of a patient, up to count of them, in date order. Raises KeyError if
+        the patient is not found.
+        """
+
+    @abstractmethod
+    def iterVisits(self):
+        """
+        Yields every visit, as a tuple (patient ID, visit list), patient by patient.
+        """
+
+    @abstractmethod
+    def visitsByDate(self, year=None, month=None):
+        """
+        Returns the visits found by findVisitsByDate for a year and month, as a list of (patient ID, visit list) tuples.
+        """
+
+    @abstractmethod
+    def stats(self, patientId=None):
+        """
+        Returns the mean and standard deviation of each vital sign of a patient, or of every patient if patientId is
+        None, in the same form as runningVitalStats. Raises KeyError if the patient is not found.
+        """
+
+    @abstractmethod
+    def followUps(self, rules=FOLLOW_UP_RULES):
+        """
+        Returns the patients who need a follow-up visit under a list of rules, in the same form as screenPatients.
+        """
+
+    @abstractmethod
+    def cohort(self, where):
+        """
+        Yields the visits which match a filter (see CohortQuery), as (patient ID, visit list) tuples, patient by
+        patient. Raises ValueError if the filter is not valid.
+        """
+
+    @abstractmethod
+    def addVisits(self, visits, fromFile=False):
+        """
+        Checks and adds many visits at once, in the same way as bulkAddPatientData, and returns the same report. If
+        fromFile is True, the visits were read from another backend and their dates are checked with the looser rules
+        for visits already saved (see validation.rangeProblem). Raises OSError, or sqlite3.Error for a database, if
+        the visits could not be saved.
+        """
+
+    @abstractmethod
+    def deletePatient(self, patientId):
+        """
+        Deletes all visits of a patient. Returns True if the patient was found.
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Makes sure every change is saved, and releases the files held open.
+        """
+
+
+class TextBackend(StorageBackend):
+    """
+    Keeps the patients in a plaintext patient file (see readPatientsFromFile), with every query answered from a
+    VisitStore read into memory by loadPatients. The file is created if it does not exist.
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        # Creates an empty file to migrate patients into, since loadPatients stops the program if the file is missing.
+        if not os.path.exists(fileName):
+            open(fileName, 'a').close()
+        self.patients = loadPatients(fileName)
+
+    def patientIds(self):
+        return list(self.patients)
+
+    def visitCount(self):
+        return self.patients.visitCount()
+
+    def visitsOf(self, patientId):
+        return [list(visit) for visit in self.patients[patientId]]
+
+    def latestVisits(self, patientId, count=1):
+        return self.patients[patientId].latest(count)
+
+    def iterVisits(self):
+        return ((patientId, list(visit)) for patientId, visit in iterPatientVisits(self.patients))
+
+    def visitsByDate(self, year=None, month=None):
+        return [(patientId, list(visit)) for patientId, visit in findVisitsByDate(self.patients, year, month)]
+
+    def stats(self, patientId=None):
+        return runningVitalStats(self.patients, patientId)
+
+    def followUps(self, rules=FOLLOW_UP_RULES):
+        return screenPatients(self.patients, rules)
+
+    def cohort(self, where):
+        return CohortQuery(where).visits(self.patients)
+
+    def addVisits(self, visits, fromFile=False):
+        return bulkAddPatientData(self.patients, visits, self.fileName, fromFile)
+
+    def deletePatient(self, patientId):
+        # deleteAllVisitsOfPatient prints whether the patient was deleted.
+        if patientId not in self.patients:
+            return False
+        deleteAllVisitsOfPatient(self.patients, patientId, self.fileName)
+        return True
+
+    def close(self):
+        # Forces the file onto the disk, and saves a snapshot so the file opens quickly next time.
+        syncPatientsFile(self.fileName)
+        saveSnapshot(self.patients, self.fileName)
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Keeps the patients in a SQLite database. The visits are indexed by patient and date, and by date alone, so looking
+    up a patient or a range of dates only reads the visits needed. Statistics are aggregated, and follow-up rules which
+    compare vital signs with thresholds and cohort filters are checked, inside SQLite, so only the results are read into
+    Python. The database is created if it does not exist.
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._connection = sqlite3.connect(fileName)
+        with self._connection:
+            for statement in _SQLITE_SCHEMA:
+                self._connection.execute(statement)
+
+    def patientIds(self):
+        return [patientId for patientId, in self._connection.execute(_SELECT_PATIENTS)]
+
+    def visitCount(self):
+        return self._connection.execute(_SELECT_VISIT_COUNT).fetchone()[0]
+
+    def visitsOf(self, patientId):
+        visits = [_visitOf(row) for row in self._connection.execute(_SELECT_VISITS_OF, (patientId,))]
+        if not visits and self._connection.execute(_SELECT_PATIENT, (patientId,)).fetchone() is None:
+            raise KeyError(patientId)
+        return visits
+
+    def latestVisits(self, patientId, count=1):
+        # Reads the most recent visits backwards through the index on patient and date, and puts them back in order.
+        visits = [_visitOf(row[:-2]) for row in self._connection.execute(_SELECT_LATEST_VISITS, (patientId, count))]
+        if not visits and self._connection.execute(_SELECT_PATIENT, (patientId,)).fetchone() is None:
+            raise KeyError(patientId)
+        return visits
+
+    def iterVisits(self):
+        # Reads the visits from the cursor as they are used, rather than all at once.
+        return ((row[0], _visitOf(row[1:])) for row in self._connection.execute(_SELECT_ALL_VISITS))
+
+    def visitsByDate(self, year=None, month=None):
+        # Looks the range of dates covered by the year and month up in the date index.
+        dateRange = _dateRangeOf(year, month)
+        if dateRange is None:
+            return []
+        return [(row[0], _visitOf(row[1:])) for row in self._connection.execute(_SELECT_VISITS_BETWEEN, dateRange)]
+
+    def stats(self, patientId=None):
+        # Sums up the vital signs in SQL. The standard deviation is worked out from the mean of the squares, in the same
+        # way as runningVitalStats. The minimum and maximum come for free, so they are given too.
+        if patientId is None:
+            totals = self._connection.execute(_SELECT_TOTALS).fetchone()
+            patientCount = len(self.patientIds())
+        else:
+            if self._connection.execute(_SELECT_PATIENT, (patientId,)).fetchone() is None:
+                raise KeyError(patientId)
+            totals = self._connection.execute(_SELECT_PATIENT_TOTALS, (patientId,)).fetchone()
+            patientCount = 1
+        result = {'visits': totals[0], 'patients': patientCount, 'vitals': dict.fromkeys(VITALS)}
+        if totals[0] == 0:
+            return result
+        for index, vital in enumerate(VITALS):
+            mean, meanOfSquares, lowest, highest = totals[1 + 4 * index:5 + 4 * index]
+            result['vitals'][vital] = {'mean': mean, 'stddev': math.sqrt(max(meanOfSquares - mean * mean, 0.0)),
+                                       'min': lowest, 'max': highest}
+        return result
+
+    def followUps(self, rules=FOLLOW_UP_RULES):
+        rules = compileRules(rules)
+        if not rules:
+            return []
+        conditions = [_ruleCondition(rule.source) if rule.source is not None else None for rule in rules]
+
+        # Rules which look at more than one visit (trend rules) cannot be checked one row at a time, so the visits are
+        # read and screened in Python instead.
+        if None in conditions:
+            patients = {}
+            for patientId, visit in self.iterVisits():
+                patients.setdefault(patientId, []).append(visit)
+            return screenPatients(patients, rules)
+
+        # Finds the first visit of each patient for which any rule fires, and where it is in the patient's list of
+        # visits, in a single query.
+        where = ' OR '.join(condition for condition, parameters in conditions)
+        parameters = [parameter for condition, parameters in conditions for parameter in parameters]
+        rows = self._connection.execute(_SELECT_FIRST_FLAGGED % where, parameters)
+
+        # Works out which rule fired for each of those visits.
+        flagged = []
+        for row in rows:
+            visit = _visitOf(row[2:])
+            rule = next(rule for rule in rules if rule.check([visit]))
+            flagged.append((row[0], rule.name, row[1], visit))
+        return flagged
+
+    def cohort(self, where):
+        # Checks the filter the same way as CohortQuery, and then leaves SQLite to choose which index to use.
+        CohortQuery(where)
+        condition, parameters = _filterCondition(where)
+        rows = self._connection.execute(_SELECT_VISITS_WHERE % condition, parameters)
+        return ((row[0], _visitOf(row[1:])) for row in rows)
+
+    def addVisits(self, visits, fromFile=False):
+        # Checks every visit in the same way as bulkAddPatientData, but one visit at a time.
+        rejected = []
+        accepted = []
+        for position, fields, line in visitRecords(visits):
+            patientId, date, encodedDate, values, reason = convertFields(fields)
+            if reason is None:
+                reason = rangeProblem(encodedDate, values, fromFile)
+            if reason is None:
+                accepted.append((patientId, date, encodedDate, *values))
+            elif reason == 'fields':
+                rejected.append({'position': position, 'patientId': None, 'reason': reason,
+                                 'message': rejectMessage(reason, line, len(fields))})
+            else:
+                value = values[VITALS.index(reason)] if reason in VITALS else None
+                rejected.append({'position': position, 'patientId': patientId, 'reason': reason,
+                                 'message': rejectMessage(reason, line, value)})
+
+        # Adds the visits, and any new patients, in one transaction.
+        with self._connection:
+            nextRank = self._connection.execute(_SELECT_NEXT_RANK).fetchone()[0]
+            newPatients = list(dict.fromkeys(visit[0] for visit in accepted))
+            ranks = range(nextRank, nextRank + len(newPatients))
+            self._connection.executemany(_INSERT_PATIENT, zip(newPatients, ranks))
+            self._connection.executemany(_INSERT_VISIT, accepted)
+        return {'added': len(accepted), 'rejected': rejected}
+
+    def deletePatient(self, patientId):
+        with self._connection:
+            found = self._connection.execute(_DELETE_PATIENT, (patientId,)).rowcount > 0
+            self._connection.execute(_DELETE_VISITS, (patientId,))
+        return found
+
+    def close(self):
+        self._connection.close()
+
+
+class ShardedBackend(StorageBackend):
+    """
+    Keeps the patients in a directory of patient text files, called shards. Each patient's visits are all kept in one
+    shard, chosen by the patient ID modulo the number of shards, and each shard is a patient file in its own right,
+    with its own delete log and snapshot. Looking up, adding visits to or deleting a patient only loads and writes that
+    patient's shard, so the memory and the writing needed by each change depend on the size of a shard rather than the
+    whole dataset. Shards are only loaded when they are first needed.
+
+    Statistics, finding visits by date and finding patients who need a follow-up look at every shard. Each shard is
+    handled by one of a pool of worker processes, which loads the shard from its snapshot when it is up to date, and
+    the results of the shards are then merged. Patients are listed shard by shard, in the order they were added within
+    each shard.
+    """
+
+    def __init__(self, directory, shardCount=None, workers=None):
+        """
+        Opens a sharded dataset, creating it with empty shards if the directory has no manifest yet. Raises ValueError
+        if shardCount is given and differs from the number of shards of an existing dataset, or is less than 1.
+
+        directory: The name of the directory holding the shards.
+        shardCount: The number of shards, or None to use the number the dataset already has (DEFAULT_SHARD_COUNT for
+        a new dataset).
+        workers: The number of worker processes that look at the shards at the same time. If None, one for each CPU is
+        used. With 1, every shard is looked at in this process.
+        """
+        self.directory = directory
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        manifestName = os.path.join(directory, SHARD_MANIFEST)
+        if os.path.exists(manifestName):
+            with open(manifestName) as manifestFile:
+                existingCount = json.load(manifestFile)['shards']
+            if shardCount is not None and shardCount != existingCount:
+                raise ValueError("'%s' has %d shards, not %d." % (directory, existingCount, shardCount))
+            shardCount = existingCount
+        else:
+            shardCount = DEFAULT_SHARD_COUNT if shardCount is None else shardCount
+            if shardCount < 1:
+                raise ValueError('A sharded dataset must have at least 1 shard.')
+            # Creates every shard before the manifest, so that a dataset with a manifest always has all of its shards.
+            os.makedirs(directory, exist_ok=True)
+            for shard in range(shardCount):
+                open(self._shardFileName(shard, directory), 'a').close()
+            with open(manifestName, 'w') as manifestFile:
+                json.dump({'shards': shardCount}, manifestFile)
+        self.shardCount = shardCount
+        # Dictionary mapping the number of each shard loaded so far to its TextBackend.
+        self._shards = {}
+
+    def shardOf(self, patientId):
+        """
+        Returns the number of the shard holding a patient's visits, from 0 to shardCount - 1.
+
+        patientId: The ID of the patient.
+        """
+        return patientId % self.shardCount
+
+    def patientIds(self):
+        return [patientId for shard in range(self.shardCount) for patientId in self._shard(shard).patientIds()]
+
+    def visitCount(self):
+        return sum(self._shard(shard).visitCount() for shard in range(self.shardCount))
+
+    def visitsOf(self, patientId):
+        return self._shard(self.shardOf(patientId)).visitsOf(patientId)
+
+    def latestVisits(self, patientId, count=1):
+        return self._shard(self.shardOf(patientId)).latestVisits(patientId, count)
+
+    def iterVisits(self):
+        return (visit for shard in range(self.shardCount) for visit in self._shard(shard).iterVisits())
+
+    def visitsByDate(self, year=None, month=None):
+        return [visit for visits in self._fanOut(_shardVisitsByDate, (year, month)) for visit in visits]
+
+    def stats(self, patientId=None):
+        if patientId is not None:
+            return self._shard(self.shardOf(patientId)).stats(patientId)
+        # Adds up the running totals of every shard. No patient is in more than one shard, so the patients can be
+        # counted by adding up the patients of each shard too.
+        count, sums, sumsOfSquares, patientCount = 0, [0.0] * len(VITALS), [0.0] * len(VITALS), 0
+        for shardCount, shardSums, shardSumsOfSquares, shardPatients in self._fanOut(_shardTotals, None):
+            count += shardCount
+            sums = [total + shardTotal for total, shardTotal in zip(sums, shardSums)]
+            sumsOfSquares = [total + shardTotal for total, shardTotal in zip(sumsOfSquares, shardSumsOfSquares)]
+            patientCount += shardPatients
+        return statsFromTotals(count, sums, sumsOfSquares, patientCount)
+
+    def followUps(self, rules=FOLLOW_UP_RULES):
+        rules = compileRules(rules)
+        # The worker processes are sent the rules as dictionaries, since compiled rules cannot be sent between
+        # processes. Rules which were compiled elsewhere and have no dictionary are checked in this process instead.
+        sources = [rule.source for rule in rules]
+        if None in sources:
+            return [flagged for shard in range(self.shardCount)
+                    for flagged in screenPatients(self._shard(shard).patients, rules)]
+        return [flagged for shardFlagged in self._fanOut(_shardFollowUps, sources) for flagged in shardFlagged]
+
+    def cohort(self, where):
+        # Checks the filter straight away, rather than when the first visit is asked for.
+        CohortQuery(where)
+        return (visit for shard in range(self.shardCount) for visit in self._shard(shard).cohort(where))
+
+    def addVisits(self, visits, fromFile=False):
+        # Sends each visit to the shard of its patient, remembering its position so that the rejected visits can be
+        # reported by their position in visits. A visit whose patient ID cannot be read is sent to the first shard,
+        # which rejects it.
+        shardVisits = {}
+        for position, fields, line in visitRecords(visits):
+            try:
+                shard = self.shardOf(int(fields[0]))
+            except (ValueError, TypeError, IndexError):
+                shard = 0
+            positions, values = shardVisits.setdefault(shard, ([], []))
+            positions.append(position)
+            values.append(fields)
+
+        # Adds the visits of each shard with one call to bulkAddPatientData.
+        report = {'added': 0, 'rejected': []}
+        for shard, (positions, values) in sorted(shardVisits.items()):
+            shardReport = self._shard(shard).addVisits(values, fromFile)
+            report['added'] += shardReport['added']
+            for reject in shardReport['rejected']:
+                reject['position'] = positions[reject['position']]
+                report['rejected'].append(reject)
+        report['rejected'].sort(key=lambda reject: reject['position'])
+        return report
+
+    def deletePatient(self, patientId):
+        return self._shard(self.shardOf(patientId)).deletePatient(patientId)
+
+    def close(self):
+        for backend in self._shards.values():
+            backend.close()
+        self._shards.clear()
+
+    @staticmethod
+    def _shardFileName(shard, directory):
+        # Returns the name of the patient file of a shard.
+        return os.path.join(directory, 'shard-%03d.txt' % shard)
+
+    def _shard(self, shard):
+        # Returns the backend of a shard, loading the shard if it has not been loaded yet.
+        if shard not in self._shards:
+            self._shards[shard] = TextBackend(self._shardFileName(shard, self.directory))
+        return self._shards[shard]
+
+    def _fanOut(self, task, argument):
+        # Runs a task on the patients of every shard, returning the result of each shard in shard order. The shards are
+        # shared out between the worker processes, unless there is only one worker or one shard. Every change made to a
+        # shard is written to its file straight away, so the workers see the same visits as this process.
+        if self.workers <= 1 or self.shardCount == 1:
+            return [task(self._shard(shard).patients, argument) for shard in range(self.shardCount)]
+        fileNames = [self._shardFileName(shard, self.directory) for shard in range(self.shardCount)]
+        with ProcessPoolExecutor(max_workers=min(self.workers, self.shardCount)) as executor:
+            return list(executor.map(_runShardTask, fileNames, [task] * len(fileNames), [argument] * len(fileNames)))
+
+
+def _runShardTask(fileName, task, argument):
+    # Loads a shard in a worker process, and runs a task on its patients.
+    return task(loadPatients(fileName, workers=1), argument)
+
+
+def _shardVisitsByDate(patients, dateArguments):
+    # Finds the visits of a shard in a year and month.
+    year, month = dateArguments
+    return [(patientId, list(visit)) for patientId, visit in findVisitsByDate(patients, year, month)]
+
+
+def _shardTotals(patients, argument):
+    # Returns the running totals of a shard, and its number of patients.
+    return (*patients.runningTotals(), len(patients))
+
+
+def _shardFollowUps(patients, rules):
+    # Finds the patients of a shard who need a follow-up.
+    return screenPatients(patients, rules)
+
+
+def _visitOf(row):
+    # Turns a row of the visit columns into a visit list. SQLite stores a temperature which is not a number as NULL.
+    visit = list(row)
+    if visit[1] is None:
+        visit[1] = math.nan
+    return visit
+
+
+def _ruleCondition(rule):
+    """
+    Turns a follow-up rule (see FOLLOW_UP_RULES) into a SQL condition on a row of the visits table.
+
+    rule: The rule dictionary.
+    Returns a tuple (condition, list of parameters), or None if the rule looks at more than one visit.
+    """
+    if 'all' in rule or 'any' in rule:
+        parts = [_ruleCondition(part) for part in rule['all' if 'all' in rule else 'any']]
+        if None in parts:
+            return None
+        joiner = ' AND ' if 'all' in rule else ' OR '
+        return ('(%s)' % joiner.join(condition for condition, parameters in parts),
+                [parameter for condition, parameters in parts for parameter in parameters])
+    column = _VITAL_COLUMNS[VITALS.index(rule['vital'])]
+    if 'above' in rule:
+        return column + ' > ?', [rule['above']]
+    if 'below' in rule:
+        return column + ' < ?', [rule['below']]
+    return None
+
+
+def _filterCondition(where):
+    """
+    Turns a cohort filter (see CohortQuery) into a SQL condition on a row of the visits table. Each condition on a
+    single column is false, rather than NULL, for a temperature which is not a number or a date which cannot be
+    encoded, so that 'not' filters match the same visits as CohortQuery.
+
+    where: The filter, which must already have been checked by CohortQuery.
+    Returns a tuple (condition, list of parameters).
+    """
+    if 'all' in where or 'any' in where:
+        parts = [_filterCondition(part) for part in where['all' if 'all' in where else 'any']]
+        joiner = ' AND ' if 'all' in where else ' OR '
+        return ('(%s)' % joiner.join(condition for condition, parameters in parts),
+                [parameter for condition, parameters in parts for parameter in parameters])
+    if 'not' in where:
+        condition, parameters = _filterCondition(where['not'])
+        return 'NOT ' + condition, parameters
+    if 'patients' in where:
+        patientIds = list(dict.fromkeys(where['patients']))
+        return 'visits.patient_id IN (%s)' % ', '.join('?' * len(patientIds)), patientIds
+    if 'vital' in where:
+        column = 'visits.' + _VITAL_COLUMNS[VITALS.index(where['vital'])]
+        limits = [(operator, where[key]) for key, operator in _FILTER_OPERATORS.items() if key in where]
+        return ('COALESCE(%s, 0)' % ' AND '.join('%s %s ?' % (column, operator) for operator, limit in limits),
+                [limit for operator, limit in limits])
+    return 'COALESCE(visits.date_key BETWEEN ? AND ?, 0)', list(_dateRangeOfFilter(where))
+
+
+def openBackend(fileName):
+    """
+    Opens the backend for a file: a SQLiteBackend if the name ends with one of SQLITE_EXTENSIONS, a ShardedBackend if it
+    is a directory or ends with SHARDED_EXTENSION, or a TextBackend otherwise.
+
+    fileName: The name of the file, or directory, holding the patients.
+    """
+    if fileName.lower().endswith(SQLITE_EXTENSIONS):
+        return SQLiteBackend(fileName)
+    if os.path.isdir(fileName) or fileName.lower().endswith(SHARDED_EXTENSION):
+        return ShardedBackend(fileName)
+    return TextBackend(fileName)
+
+
+def migrate(source, target):
+    """
+    Copies every visit from one backend to another, such as from the patient text file into a SQLite database, or back.
+    The visits are copied MIGRATION_BATCH_SIZE at a time, in order, and added to any visits the target already holds.
+    Every visit the source could read is copied, including dates which would be rejected for a new visit.
+
+    source: The backend to copy from.
+    target: The backend to copy to.
+    Returns the number of visits copied. Raises OSError, or sqlite3.Error, if the visits could not be saved to the
+    target.
+    """
+    copied = 0
+    visits = source.iterVisits()
+    while True:
+        batch = [(patientId, *visit) for patientId, visit in islice(visits, MIGRATION_BATCH_SIZE)]
+        if not batch:
+            return copied
+        report = target.addVisits(batch, fromFile=True)
+        copied += report['added']
+
+
+if __name__ == '__main__':
+    # 'python storage.py migrate [source file] [target file]' copies the patients from one file into another, choosing
+    # the backend of each from its name (see openBackend).
+    if sys.argv[1:2] == ['migrate'] and len(sys.argv) == 4:
+        source = openBackend(sys.argv[2])
+        target = openBackend(sys.argv[3])
+        try:
+            print('Copied %d visits from %s to %s.' % (migrate(source, target), sys.argv[2], sys.argv[3]))
+        except (OSError, sqlite3.Error):
+            print('The visits could not be copied to %s.' % sys.argv[3])
+        source.close()
+        target.close()
+    else:
+        print('Usage: python storage.py migrate [source file] [target file]')
@@ -0,0 +1,300 @@
+import math
+from datetime import date
+
+from instrumentation import metrics
+from visitstore import VITAL_TYPECODES, VITALS, VisitStore
+
+# NumPy is used to compute the trends of every patient in a few batched array operations when it is installed. Without
+# it, the trends are computed one patient at a time with plain Python.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Number of visits averaged by each rolling mean unless another window is requested.
+DEFAULT_TREND_WINDOW = 3
+
+
+def computeTrends(patients, patientIds=None, window=DEFAULT_TREND_WINDOW):
+    """
+    Computes the trend of every vital sign across the visits of each patient, in date order: the rolling mean of each
+    visit and the visits just before it, the change since the previous visit, and the slope of the least squares line
+    through all of the patient's visits. A value which is not a number (NaN) is left out of the rolling means and
+    slopes.
+
+    patients: A VisitStore, or a dictionary of patient IDs where each patient has a list of visits.
+    patientIds: An iterable of the patient IDs to compute the trends of, or None for every patient. IDs that are not
+    found are skipped.
+    window: The number of visits averaged by each rolling mean. The first visits of a patient are averaged with however
+    many visits there are before them.
+    Returns a dictionary mapping each patient ID to a dictionary with the following structure:
+    {
+        'dates': the date of each visit (tuple of str),
+        'window': the window of the rolling means (int),
+        'vitals': {
+            vital name (str): {'rollingMean': the rolling mean at each visit (tuple of float),
+                               'delta': the change since the previous visit, NaN for the first visit (tuple of float),
+                               'slope': the change per day along the least squares line, or NaN if there are not
+                                        two visits on different dates to draw it through (float)},
+            ...
+        }
+    }
+    """
+    if window < 1:
+        raise ValueError('The window of the rolling means must be at least 1 visit.')
+    patientIds = list(patients) if patientIds is None else [patientId for patientId in dict.fromkeys(patientIds)
+                                                             if patientId in patients]
+    if isinstance(patients, VisitStore):
+        store = patients
+        rows = store.selectRows(patientIds)
+        dates = store.dateStrings(rows)
+        lengths = [len(store.rowsOf(patientId)) for patientId in patientIds]
+    else:
+        # A dictionary is read with plain Python, looking only at the patients asked for. Copying it into a VisitStore
+        # would read every patient, and the typed columns of a store cannot hold every value a dictionary can. Each
+        # patient's visits are put in date order, as a store keeps them.
+        store = None
+        visits = [visit for patientId in patientIds for visit in sorted(patients[patientId], key=_visitDate)]
+        rows = range(len(visits))
+        dates = [visit[0] for visit in visits]
+        lengths = [len(patients[patientId]) for patientId in patientIds]
+    metrics.count('visits_scanned', len(rows), operation='computeTrends')
+
+    # Numbers the day of each visit, so that the slopes are in units per day. Each date is only numbered once.
+    days = {}
+    for dateString in dates:
+        if dateString not in days:
+            days[dateString] = _dayNumber(dateString)
+    dayNumbers = [days[dateString] for dateString in dates]
+
+    # Computes the trends of every patient at once with NumPy, or one patient at a time without it or for a dictionary.
+    if store is not None and numpy is not None and len(rows) > 0:
+        vitalTrends = _trendsWithNumpy(store, rows, lengths, dayNumbers, window)
+    elif store is not None:
+        vitalTrends = _trendsWithPython([[float(column[row]) for row in rows]
+                                         for column in map(store.column, VITALS)], lengths, dayNumbers, window)
+    else:
+        vitalTrends = _trendsWithPython([[float(visit[index]) for visit in visits]
+                                         for index in range(1, len(VITALS) + 1)], lengths, dayNumbers, window)
+
+    # Splits the results up by patient. Tuples are used rather than lists, since the garbage collector soon stops
+    # tracking a tuple of numbers, which matters when there are hundreds of thousands of them.
+    dates = tuple(dates)
+    vitalTrends = [(tuple(rollingMeans), tuple(deltas), slopes) for rollingMeans, deltas, slopes in vitalTrends]
+    trends = {}
+    start = 0
+    for index, (patientId, length) in enumerate(zip(patientIds, lengths)):
+        end = start + length
+        trends[patientId] = {
+            'dates': dates[start:end],
+            'window': window,
+            'vitals': {vital: {'rollingMean': rollingMeans[start:end], 'delta': deltas[start:end],
+                               'slope': slopes[index]}
+                       for vital, (rollingMeans, deltas, slopes) in zip(VITALS, vitalTrends)},
+        }
+        start = end
+    return trends
+
+
+def _visitDate(visit):
+    # Returns the date of a visit list. Dates in the 'yyyy-mm-dd' form sort in the same order as the dates themselves.
+    return visit[0]
+
+
+def _dayNumber(dateString):
+    # Numbers a 'yyyy-mm-dd' date by days, as date.toordinal does. A day past the end of its month counts on into the
+    # next month. Gives NaN for a date which cannot be numbered, which is then left out of the slopes.
+    try:
+        return date(int(dateString[0:4]), int(dateString[5:7]), 1).toordinal() + int(dateString[8:10]) - 1
+    except (ValueError, TypeError):
+        return math.nan
+
+
+def _trendsWithNumpy(store, rows, lengths, dayNumbers, window):
+    # Gathers the selected rows, which are listed patient by patient, and numbers each visit within its patient.
+    if isinstance(rows, range):
+        selection = slice(rows.start, rows.stop)
+    else:
+        selection = numpy.frombuffer(rows, dtype=numpy.int64)
+    lengths = numpy.array(lengths, dtype=numpy.int64)
+    starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    positions = numpy.arange(len(rows)) - numpy.repeat(starts, lengths)
+    # Patients with no visits are left out of the per patient sums, which cannot add up an empty run of visits.
+    hasVisits = lengths > 0
+    sumStarts = starts[hasVisits]
+    sumLengths = lengths[hasVisits]
+
+    # The day number of each visit. The slopes measure the days from the mean day of each patient, which keeps them
+    # accurate even though the day numbers are large.
+    days = numpy.array(dayNumbers, dtype=numpy.float64)
+
+    vitalTrends = []
+    for index, vital in enumerate(VITALS):
+        values = numpy.frombuffer(store.column(vital), dtype=VITAL_TYPECODES[index])[selection].astype(numpy.float64)
+        valid = ~numpy.isnan(values)
+        known = numpy.where(valid, values, 0.0)
+
+        # Each rolling mean is the difference between two running sums, divided by the number of values in the window,
+        # which is smaller for a patient's first visits.
+        runningSums = numpy.concatenate(([0.0], numpy.cumsum(known)))
+        runningCounts = numpy.concatenate(([0], numpy.cumsum(valid)))
+        ends = numpy.arange(1, len(rows) + 1)
+        firsts = ends - numpy.minimum(positions + 1, window)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            rollingMeans = ((runningSums[ends] - runningSums[firsts])
+                            / (runningCounts[ends] - runningCounts[firsts]))
+
+        # The change since the previous visit, which the first visit of each patient does not have.
+        deltas = numpy.empty(len(rows))
+        deltas[1:] = values[1:] - values[:-1]
+        deltas[positions == 0] = numpy.nan
+
+        # The least squares slope of each patient: the sum of the products of the distances of each day and value from
+        # their means, divided by the sum of the squared distances of each day from its mean. Only visits with both a
+        # value and a day are used.
+        slopes = numpy.full(len(lengths), numpy.nan)
+        used = valid & ~numpy.isnan(days)
+        counts = numpy.add.reduceat(used.astype(numpy.float64), sumStarts)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            dayMeans = numpy.add.reduceat(numpy.where(used, days, 0.0), sumStarts) / counts
+            valueMeans = numpy.add.reduceat(numpy.where(used, values, 0.0), sumStarts) / counts
+            dayDistances = numpy.where(used, days - numpy.repeat(dayMeans, sumLengths), 0.0)
+            valueDistances = numpy.where(used, values - numpy.repeat(valueMeans, sumLengths), 0.0)
+            spread = numpy.add.reduceat(dayDistances * dayDistances, sumStarts)
+            patientSlopes = numpy.add.reduceat(dayDistances * valueDistances, sumStarts) / spread
+        slopes[hasVisits] = numpy.where(spread > 0, patientSlopes, numpy.nan)
+
+        vitalTrends.append((rollingMeans.tolist(), deltas.tolist(), slopes.tolist()))
+    return vitalTrends
+
+
+def _trendsWithPython(columns, lengths, dayNumbers, window):
+    # Computes the same trends as _trendsWithNumpy, one patient at a time, from the values of each vital sign, listed
+    # patient by patient.
+    vitalTrends = []
+    for column in columns:
+        rollingMeans = []
+        deltas = []
+        slopes = []
+        start = 0
+        for length in lengths:
+            values = column[start:start + length]
+            days = dayNumbers[start:start + length]
+            for position, value in enumerate(values):
+                known = [other for other in values[max(position + 1 - window, 0):position + 1] if not math.isnan(other)]
+                rollingMeans.append(math.fsum(known) / len(known) if known else math.nan)
+                deltas.append(value - values[position - 1] if position > 0 else math.nan)
+            slopes.append(_slope(days, values))
+            start += length
+        vitalTrends.append((rollingMeans, deltas, slopes))
+    return vitalTrends
+
+
+def _slope(days, values):
+    # Finds the least squares slope of the values against the days, leaving out any which are not numbers.
+    points = [(day, value) for day, value in zip(days, values) if not math.isnan(day) and not math.isnan(value)]
+    if not points:
+        return math.nan
+    dayMean = math.fsum(day for day, value in points) / len(points)
+    valueMean = math.fsum(value for day, value in points) / len(points)
+    spread = math.fsum((day - dayMean) ** 2 for day, value in points)
+    if spread == 0:
+        return math.nan
+    return math.fsum((day - dayMean) * (value - valueMean) for day, value in points) / spread
+
+
+class TrendAnalyzer:
+    """
+    Keeps the trends of each patient (see computeTrends) once they have been computed, until a visit is added to that
+    patient or the patient is removed. Only the changed patient's trends are computed again, so looking up the trends
+    of the other patients stays instant. The trends of every patient can be computed together with computeAll, which
+    is much faster than computing them one patient at a time.
+
+    Results are shared between callers, so they must not be changed.
+    """
+
+    def __init__(self, window=DEFAULT_TREND_WINDOW):
+        # The number of visits averaged by each rolling mean.
+        self.window = window
+        # Dictionary mapping each patient ID to their trends.
+        self._trends = {}
+        # The store being watched.
+        self._store = None
+
+    def attach(self, store):
+        """
+        Starts watching a store for changes. Any trends kept are dropped, since they may belong to another store.
+
+        store: The VisitStore to compute trends for.
+        """
+        if self._store is not None:
+            self.detach()
+        self._trends.clear()
+        self._store = store
+        store.subscribe(self._onChange)
+
+    def detach(self):
+        """
+        Stops watching the store, and drops every trend kept.
+        """
+        self._store.unsubscribe(self._onChange)
+        self._store = None
+        self._trends.clear()
+
+    def trends(self, patientId):
+        """
+        Returns the trends of a patient, computing them first if they are not kept. Raises KeyError if the patient is
+        not in the store.
+
+        patientId: The ID of the patient.
+        """
+        if patientId not in self._trends:
+            if patientId not in self._store:
+                raise KeyError(patientId)
+            self._trends.update(computeTrends(self._store, [patientId], self.window))
+        return self._trends[patientId]
+
+    def computeAll(self):
+        """
+        Computes the trends of every patient whose trends are not kept, all at once.
+        """
+        missing = [patientId for patientId in self._store if patientId not in self._trends]
+        if missing:
+            self._trends.update(computeTrends(self._store, missing, self.window))
+
+    def _onChange(self, event, patientId, row):
+        # Drops the trends of a patient who has a new visit or was removed, or every trend if many visits were loaded.
+        if event == 'load':
+            self._trends.clear()
+        else:
+            self._trends.pop(patientId, None)
+
+
+def formatTrends(trends, visitCount=5):
+    """
+    Formats the trends of a patient as a printable report, with the slope of each vital sign and the rolling mean and
+    change at each of the most recent visits.
+
+    trends: The trends of a patient, as returned by TrendAnalyzer.trends or computeTrends.
+    visitCount: The number of most recent visits to show.
+    Returns the report as a string.
+    """
+    dates = trends['dates']
+    if not dates:
+        return 'No visits.'
+    lines = ['Rolling means over %d visits, for the last %d of %d visits:'
+             % (trends['window'], min(visitCount, len(dates)), len(dates))]
+    for vital in VITALS:
+        vitalTrends = trends['vitals'][vital]
+        lines.append(' %s: slope=%s per day' % (vital.capitalize(), _formatNumber('%+.4f', vitalTrends['slope'])))
+        for position in range(max(len(dates) - visitCount, 0), len(dates)):
+            lines.append('  %s  mean=%s  change=%s'
+                         % (dates[position], _formatNumber('%.2f', vitalTrends['rollingMean'][position]),
+                            _formatNumber('%+.2f', vitalTrends['delta'][position])))
+    return '\n'.join(lines)
+
+
+def _formatNumber(numberFormat, value):
+    # Formats a number, or 'n/a' for a value which is not a number, such as the change at a patient's first visit.
+    return 'n/a' if math.isnan(value) else numberFormat % value
@@ -0,0 +1,267 @@
+from visitstore import VITALS, encodeDate
+
+# NumPy is used by failedChecks to range check many visits in a few array operations when it is installed. Without it,
+# the visits are checked one at a time with plain Python.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Largest and smallest patient IDs which fit in the patient ID column of a VisitStore.
+MAX_PATIENT_ID = 2 ** 63 - 1
+MIN_PATIENT_ID = -2 ** 63
+
+# The range accepted for each vital sign, in the order of VITALS. Each rule is a tuple (vital sign, lowest value,
+# highest value, message for a line of a file, message for the user). This is the one place the ranges are written
+# down: readPatientsFromFile, addPatientData and bulkAddPatientData all check visits against them.
+VITAL_RULES = (
+    ('temperature', 35.0, 42.0, "Invalid temperature value (%.2f) in line: %s",
+     "Invalid temperature. Please enter a temperature between 35.0 and 42.0 Celsius."),
+    ('heart rate', 30, 180, "Invalid heart rate value (%d) in line: %s",
+     "Invalid heart rate. Please enter a heart rate between 30 and 180 bpm."),
+    ('respiratory rate', 5, 40, "Invalid respiratory rate value (%d) in line: %s",
+     "Invalid respiratory rate. Please enter a respiratory rate between 5 and 40 bpm."),
+    ('systolic blood pressure', 70, 200, "Invalid systolic blood pressure value (%d) in line: %s",
+     "Invalid systolic blood pressure. Please enter a systolic blood pressure between 70 and 200 mmHg."),
+    ('diastolic blood pressure', 40, 120, "Invalid diastolic blood pressure value (%d) in line: %s",
+     "Invalid diastolic blood pressure. Please enter a diastolic blood pressure between 40 and 120 mmHg."),
+    ('oxygen saturation', 70, 100, "Invalid oxygen saturation value (%d) in line: %s",
+     "Invalid oxygen saturation. Please enter an oxygen saturation between 70 and 100%."),
+)
+
+# Dictionary mapping each reason a visit can be rejected for to a tuple (message for a line of a file, message for the
+# user). The reasons are 'fields' (not 8 values), 'type' (a value of the wrong type), 'date format' (a date not in the
+# 'yyyy-mm-dd' form), 'date' (a date which breaks the rules in rangeProblem), and the name of each vital sign, for a
+# value outside its range.
+_MESSAGES = {
+    'fields': ("Invalid number of fields (%d) in line: %s", "Invalid number of values."),
+    'type': ("Invalid data type in line: %s", "Invalid data type."),
+    'date format': ("Invalid date format in line: %s",
+                    "Invalid date format. Please enter date in the format ‘yyyy-mm-dd’."),
+    'date': ("Invalid date in line: %s", "Invalid date. Please enter a valid date."),
+}
+_MESSAGES.update((vital, (lineMessage, userMessage)) for vital, lowest, highest, lineMessage, userMessage in VITAL_RULES)
+
+# The lowest and highest value of each vital sign, in the order of VITALS, taken from VITAL_RULES so that rangeProblem
+# can check every vital sign without going through the rules one at a time.
+_LOWEST = tuple(lowest for vital, lowest, highest, lineMessage, userMessage in VITAL_RULES)
+_HIGHEST = tuple(highest for vital, lowest, highest, lineMessage, userMessage in VITAL_RULES)
+
+
+def parseLine(rawLine):
+    """
+    Checks one line of a patient file and converts it into a visit. This is the check used by readPatientsFromFile
+    for every line of the file, so its date is held to the looser rules for visits already in a file (see
+    rangeProblem).
+
+    rawLine: The line to check, exactly as read from the file, as bytes.
+    Returns a tuple (patient ID, encoded date, vital signs, reason, message). If the line is valid, vital signs is a
+    list of the values in the order of VITALS and reason and message are None. If the line is invalid, vital signs is
+    None, reason says why (see rejectMessage) and message is the message for the line. The patient ID is given when it
+    could be read, even from an invalid line, and is None otherwise.
+    """
+    # Fast path for a well formed line, such as those written by addPatientData: 8 values, with the date exactly in the
+    # 'yyyy-mm-dd' form. The values are converted straight from the bytes, without decoding the line or checking the
+    # date format again. Anything unusual about the line sends it down the slow path below, which gives the same result
+    # for every line the fast path accepts.
+    fields = rawLine.split(b',')
+    if len(fields) == 8:
+        date = fields[1]
+        if (len(date) == 10 and date[4:5] == date[7:8] == b'-' and date[:4].isdigit() and date[5:7].isdigit()
+                and date[8:].isdigit()):
+            try:
+                patientId = int(fields[0])
+                values = [float(fields[2]), int(fields[3]), int(fields[4]), int(fields[5]), int(fields[6]),
+                          int(fields[7])]
+            except ValueError:
+                patientId = None
+            if patientId is not None and MIN_PATIENT_ID <= patientId <= MAX_PATIENT_ID:
+                encodedDate = int(date[:4]) * 10000 + int(date[5:7]) * 100 + int(date[8:])
+                reason = rangeProblem(encodedDate, values, fromFile=True)
+                if reason is None:
+                    return patientId, encodedDate, values, None, None
+                return (patientId, encodedDate, None, reason,
+                        _lineReject(reason, rawLine.decode(errors='replace').strip(), values))
+
+    # Slow path, where the line is decoded and split into its values, which are converted and checked one at a time.
+    # Bytes which are not valid UTF-8 are replaced, so the line is rejected rather than stopping the file from being
+    # read.
+    line = rawLine.decode(errors='replace').strip()
+    fields = line.split(',')
+    patientId, date, encodedDate, values, reason = convertFields(fields)
+    if reason is None:
+        reason = rangeProblem(encodedDate, values, fromFile=True)
+        if reason is None:
+            return patientId, encodedDate, values, None, None
+    if reason == 'fields':
+        return None, None, None, reason, rejectMessage(reason, line, len(fields))
+    return patientId, encodedDate, None, reason, _lineReject(reason, line, values)
+
+
+def convertFields(fields):
+    """
+    Converts the values of a visit into their types, without range checking them.
+
+    fields: A sequence of 8 values (patient ID, date, temperature, heart rate, respiratory rate, systolic blood
+    pressure, diastolic blood pressure, oxygen saturation), which may be strings.
+    Returns a tuple (patient ID, date string, encoded date, vital signs, reason), where vital signs is a list in the
+    order of VITALS. If the values cannot be converted, reason is 'fields', 'type' or 'date format' (see rejectMessage)
+    and the values which could not be found are None. Otherwise reason is None.
+    """
+    if len(fields) != 8:
+        return None, None, None, None, 'fields'
+    try:
+        patientId = int(fields[0])
+        date = str(fields[1]).strip()
+        values = [float(fields[2])] + [int(value) for value in fields[3:]]
+    except (ValueError, TypeError):
+        return None, None, None, None, 'type'
+    # The patient ID must fit in the patient ID column of a VisitStore.
+    if patientId > MAX_PATIENT_ID or patientId < MIN_PATIENT_ID:
+        return None, None, None, None, 'type'
+    encodedDate = _encodeDate(date)
+    if encodedDate is None:
+        return patientId, date, None, values, 'date format'
+    return patientId, date, encodedDate, values, None
+
+
+def visitRecords(visits):
+    """
+    Goes through visits given either as values or as lines of text, such as those given to bulkAddPatientData.
+
+    visits: An iterable of visits, each a sequence of 8 values (see convertFields), or an open text file with one visit
+    per line in the same format as the patient file.
+    Yields a tuple (position, values, line) for each visit, where position counts from 0 and line is the visit as a
+    line of the patient file. Blank lines in a file are skipped, but still counted in the positions. An item which is
+    not a sequence, such as a number or None, is given as a single value, so it is rejected as 'fields' like any other
+    visit without 8 values.
+    """
+    # Lines of a file are split into their values, in the same way readPatientsFromFile does.
+    if hasattr(visits, 'read'):
+        for position, line in enumerate(visits):
+            line = line.strip()
+            if line:
+                yield position, line.split(','), line
+    else:
+        for position, visit in enumerate(visits):
+            try:
+                visit = list(visit)
+            except TypeError:
+                visit = [visit]
+            yield position, visit, ','.join(str(value) for value in visit)
+
+
+def rangeProblem(encodedDate, values, fromFile=False):
+    """
+    Range checks the date and vital signs of a visit.
+
+    encodedDate: The encoded date of the visit (see encodeDate).
+    values: The vital signs of the visit, in the order of VITALS.
+    fromFile: Whether the visit was read from a patient file. A new visit must have a year from 1900, a month from 1 to
+    12 and a day from 1 to 31, but a visit already in a file only needs a month up to 12 and a day up to 31, which is
+    all readPatientsFromFile has ever checked. Otherwise files written before the stricter rules would lose visits the
+    next time they are rewritten.
+    Returns None if every value is in range. Otherwise returns 'date' if the date breaks these rules, or else the name
+    of the first vital sign out of its range.
+    """
+    month = encodedDate // 100 % 100
+    day = encodedDate % 100
+    if fromFile:
+        if month > 12 or day > 31:
+            return 'date'
+    elif encodedDate < 19000000 or not 1 <= month <= 12 or not 1 <= day <= 31:
+        return 'date'
+    # Checks every vital sign at once, since almost every visit is in range. A value which is not a number (NaN) is not
+    # below or above any range, so it is accepted.
+    temperature, hr, rr, sbp, dbp, spo2 = values
+    lowest = _LOWEST
+    highest = _HIGHEST
+    if not (temperature < lowest[0] or temperature > highest[0] or hr < lowest[1] or hr > highest[1]
+            or rr < lowest[2] or rr > highest[2] or sbp < lowest[3] or sbp > highest[3]
+            or dbp < lowest[4] or dbp > highest[4] or spo2 < lowest[5] or spo2 > highest[5]):
+        return None
+    # Otherwise finds the first vital sign out of its range.
+    for (vital, lowest, highest, lineMessage, userMessage), value in zip(VITAL_RULES, values):
+        if value < lowest or value > highest:
+            return vital
+    return None
+
+
+def checkVisit(date, values):
+    """
+    Checks a visit entered by the user. This is the check used by addPatientData.
+
+    date: The date of the visit, which should be in the format 'yyyy-mm-dd'.
+    values: The vital signs of the visit, in the order of VITALS, already converted into numbers.
+    Returns None if the visit is valid, or the message to show the user otherwise.
+    """
+    encodedDate = _encodeDate(date)
+    reason = 'date format' if encodedDate is None else rangeProblem(encodedDate, values)
+    if reason is None:
+        return None
+    return _MESSAGES[reason][1]
+
+
+def _encodeDate(date):
+    # Encodes a date with encodeDate, giving None for anything which is not a date string in the 'yyyy-mm-dd' form.
+    # Some characters, such as '²', count as digits but cannot be converted into a number.
+    try:
+        return encodeDate(date)
+    except (ValueError, TypeError):
+        return None
+
+
+def rejectMessage(reason, line, value=None):
+    """
+    Gives the message for a line of a file, or a visit written as one, which was rejected.
+
+    reason: Why the line was rejected: 'fields', 'type', 'date format', 'date' or the name of a vital sign.
+    line: The line.
+    value: The number of values in the line for 'fields', or the value out of range for a vital sign. Otherwise None.
+    Returns the message.
+    """
+    message = _MESSAGES[reason][0]
+    if value is None:
+        return message % line
+    return message % (value, line)
+
+
+def _lineReject(reason, line, values):
+    # Gives the message for a line which was rejected for any reason but 'fields', with the value out of range for a
+    # vital sign.
+    if reason in VITALS:
+        return rejectMessage(reason, line, values[VITALS.index(reason)])
+    return rejectMessage(reason, line)
+
+
+def failedChecks(dates, vitals, fromFile=False):
+    """
+    Range checks the dates and vital signs of many visits, in the same way as rangeProblem. Check 0 is the date, and
+    check n (from 1) is that the nth vital sign is in its range in VITAL_RULES.
+
+    dates: A list of the encoded date of each visit (see encodeDate).
+    vitals: A list of one list per vital sign, in the order of VITALS, holding the value of each visit.
+    fromFile: Whether the visits were read from a patient file, so their dates only need to follow the looser rules
+    (see rangeProblem).
+    Returns a list with the first check each visit fails, or -1 if the visit passes every check.
+    """
+    # Without NumPy, each visit is checked on its own.
+    if numpy is None:
+        checks = {None: -1, 'date': 0}
+        checks.update((vital, check) for check, vital in enumerate(VITALS, 1))
+        return [checks[rangeProblem(date, values, fromFile)] for date, values in zip(dates, zip(*vitals))]
+
+    # With NumPy, each check is made on every visit at once, giving one mask of failed visits per check.
+    dateColumn = numpy.array(dates, dtype=numpy.int64)
+    failures = numpy.empty((1 + len(VITALS), len(dates)), dtype=bool)
+    months = dateColumn // 100 % 100
+    days = dateColumn % 100
+    if fromFile:
+        failures[0] = (months > 12) | (days > 31)
+    else:
+        failures[0] = (dateColumn < 19000000) | (months < 1) | (months > 12) | (days < 1) | (days > 31)
+    for check, (column, (vital, lowest, highest, lineMessage, userMessage)) in enumerate(zip(vitals, VITAL_RULES), 1):
+        values = numpy.array(column)
+        failures[check] = (values < lowest) | (values > highest)
+    return numpy.where(failures.any(axis=0), failures.argmax(axis=0), -1).tolist()
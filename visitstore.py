@@ -0,0 +1,902 @@
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from operator import mul
+
+
+# Names of the vital signs stored for each visit, in the same order they appear in a visit list after the date.
+VITALS = ('temperature', 'heart rate', 'respiratory rate', 'systolic blood pressure', 'diastolic blood pressure',
+          'oxygen saturation')
+
+# Typecodes of the array used to store each vital sign. The temperature is kept as a double so that it is written back
+# to the text file exactly as it was read, and the other vital signs all fit in a 2-byte signed integer.
+VITAL_TYPECODES = ('d', 'h', 'h', 'h', 'h', 'h')
+
+# Value stored in the date column for a date that is not in the 'yyyy-mm-dd' form. The original string is kept aside.
+_ODD_DATE = -1
+
+# Layout of the header at the start of a snapshot file written by VisitStore.writeSnapshot: an identifying string, the
+# format version, and then the number of rows, patients, months and indexed rows, the length of the odd dates section,
+# and the source stamp (see writeSnapshot). Version 2 snapshots keep the visits of each patient in date order.
+_SNAPSHOT_MAGIC = b'PTSNAP\x00\x00'
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_HEADER = struct.Struct('<8sII5q6q')
+
+# Length of the array of running totals kept for each patient: the number of visits, then the sum of each vital sign,
+# then the sum of the squares of each vital sign.
+_TOTALS_LENGTH = 1 + 2 * len(VITALS)
+
+
+def encodeDate(date):
+    """
+    Encodes a date string in the format 'yyyy-mm-dd' as the integer yyyymmdd. Encoded dates sort in the same order as
+    the dates themselves, and every date accepted by readPatientsFromFile can be decoded back into the same string.
+
+    date: The date string to encode.
+    Returns the encoded date, or None if the date is not in the 'yyyy-mm-dd' form.
+    """
+    # Checks that the date has 4 digits for the year, 2 for the month and 2 for the day, separated by '-'.
+    if len(date) != 10 or date[4] != '-' or date[7] != '-':
+        return None
+    year, month, day = date[0:4], date[5:7], date[8:10]
+    if not (year.isdigit() and month.isdigit() and day.isdigit()):
+        return None
+    return int(year) * 10000 + int(month) * 100 + int(day)
+
+
+def decodeDate(encodedDate):
+    """
+    Decodes an integer date created by encodeDate back into a string in the format 'yyyy-mm-dd'.
+
+    encodedDate: The encoded date.
+    Returns the date string.
+    """
+    return '%04d-%02d-%02d' % (encodedDate // 10000, encodedDate // 100 % 100, encodedDate % 100)
+
+
+def _copyToArray(values, typecode):
+    """
+    Copies a memoryview (or any other buffer) of values into a new array, which unlike a memoryview can grow.
+
+    values: The values to copy.
+    typecode: The typecode of the values.
+    """
+    copy = array(typecode)
+    copy.frombytes(memoryview(values).cast('B'))
+    return copy
+
+
+def _writeAligned(writeFile, data):
+    """
+    Writes data to a file, followed by enough zero bytes to make the position in the file a multiple of 8.
+
+    writeFile: The binary file to write to.
+    data: The bytes to write.
+    """
+    writeFile.write(data)
+    writeFile.write(bytes(-writeFile.tell() % 8))
+
+
+class PatientVisits:
+    """
+    A list-like view of the visits of one patient in a VisitStore. Indexing or iterating over the view creates a visit
+    list [date, temperature, heart rate, respiratory rate, systolic blood pressure, diastolic blood pressure, oxygen
+    saturation], the same as the lists stored in the patients dictionary. Changing one of those lists does not change
+    the store, but append() adds a new visit to it. The visits are always in date order, so the visits in a range of
+    dates and the most recent visits are found by binary search.
+    """
+
+    def __init__(self, store, patientId):
+        """
+        store: The VisitStore the visits are stored in.
+        patientId: The ID of the patient whose visits are viewed.
+        """
+        self._store = store
+        self._patientId = patientId
+
+    def __len__(self):
+        return len(self._store._rows.get(self._patientId, ()))
+
+    def __getitem__(self, index):
+        # Looks up the row (or rows, for a slice) of the visit and builds the visit list from it.
+        rows = self._store._rows.get(self._patientId, ())
+        if isinstance(index, slice):
+            return [self._store._visit(row) for row in rows[index]]
+        return self._store._visit(rows[index])
+
+    def __iter__(self):
+        for row in self._store._rows.get(self._patientId, ()):
+            yield self._store._visit(row)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, PatientVisits)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, visit):
+        """
+        Adds a visit to the patient's visits, in date order (see VisitStore.addVisit).
+
+        visit: The visit list to add.
+        """
+        self._store.addVisit(self._patientId, visit)
+
+    def between(self, startDate=None, endDate=None):
+        """
+        Returns the visits from one date to another, inclusive, as a list of visit lists in date order.
+
+        startDate: The first date, in the format 'yyyy-mm-dd', or None to start from the first visit.
+        endDate: The last date, in the format 'yyyy-mm-dd', or None to go up to the most recent visit.
+        """
+        rows = self._store.patientRowsBetween(self._patientId, None if startDate is None else encodeDate(startDate),
+                                              None if endDate is None else encodeDate(endDate))
+        return [self._store._visit(row) for row in rows]
+
+    def latest(self, count=1):
+        """
+        Returns the most recent visits, as a list of up to count visit lists in date order.
+
+        count: The number of visits to return.
+        """
+        return [self._store._visit(row) for row in self._store.latestRows(self._patientId, count)]
+
+    def mostRecent(self):
+        """
+        Returns the most recent visit, or None if the patient has no visits.
+        """
+        return self._store.latestVisit(self._patientId)
+
+
+class VisitStore:
+    """
+    Stores the visits of every patient in columns instead of as a list of lists per patient. Each vital sign is kept in
+    its own typed array, and each date is kept as a 4-byte integer (see encodeDate), so a visit takes up about 30 bytes
+    instead of the several hundred bytes needed by a list of Python objects. Every column is indexed by a row number,
+    and each patient has a sequence of the rows that hold their visits, in date order. Visits on the same date stay in
+    the order they were added. Once a file has been read, the rows of each patient are contiguous, so the sequence is
+    just a range of row numbers.
+
+    The store can be used in the same way as the patients dictionary returned by readPatientsFromFile before: looking up
+    a patient ID gives a list-like view of their visits (see PatientVisits), and patients can be iterated over, checked
+    with 'in', added to and popped.
+    """
+
+    def __init__(self):
+        # Column storing the patient ID of each row.
+        self._patientIds = array('q')
+        # Column storing the encoded date of each row.
+        self._dates = array('i')
+        # One column for each vital sign, in the order of VITALS.
+        self._vitals = [array(typecode) for typecode in VITAL_TYPECODES]
+        # Stores a 1 for each row still in use and a 0 for each row whose patient has been deleted.
+        self._alive = bytearray()
+        # Number of rows whose patient has been deleted.
+        self._deadRows = 0
+        # Dictionary mapping each patient ID to the rows of their visits in date order (a range, or an array of row
+        # numbers). Visits whose date cannot be encoded come first.
+        self._rows = {}
+        # Dictionary mapping a row to its date string, for the rare dates which cannot be encoded.
+        self._oddDates = {}
+        # Dictionary mapping each patient ID to the running totals of their visits (see _TOTALS_LENGTH). The totals of
+        # every patient combined are stored under the key None.
+        self._totals = {None: array('d', bytes(8 * _TOTALS_LENGTH))}
+        # Date index: a dictionary mapping each month, as the integer yyyymm, to the rows of the visits in that month, and
+        # a sorted list of the months, so the visits in any range of dates can be found without reading every visit.
+        self._monthRows = {}
+        self._months = []
+        # Dictionary mapping each patient ID to its position in the order patients were added, used to list the visits
+        # found through the date index in patient order.
+        self._ranks = {}
+        self._nextRank = 0
+        # The memory-mapped snapshot file the columns are read from, if the store was opened with openSnapshot.
+        self._mapping = None
+        # Functions to call whenever visits are added or patients are removed (see subscribe).
+        self._listeners = []
+
+    @classmethod
+    def fromPatients(cls, patients):
+        """
+        Creates a store holding the same visits as a patients dictionary.
+
+        patients: A dictionary of patient IDs, where each patient has a list of visits.
+        Returns the new VisitStore.
+        """
+        # A store is returned unchanged.
+        if isinstance(patients, VisitStore):
+            return patients
+        store = cls()
+        for patient in patients:
+            for visit in patients[patient]:
+                store.addVisit(patient, visit)
+        store.regroup()
+        return store
+
+    def addVisit(self, patientId, visit):
+        """
+        Adds a visit to a patient's visits, after every visit on or before its date, so the visits stay in date order.
+        The patient is added to the store if they are not already in it.
+
+        patientId: The ID of the patient the visit belongs to.
+        visit: The visit list [date, temperature, heart rate, respiratory rate, systolic blood pressure, diastolic blood
+        pressure, oxygen saturation].
+        Returns the row the visit was stored in.
+        """
+        # Converts the vital signs to the types of their columns first, so that a visit with a value of the wrong type
+        # raises an error before any column has been changed.
+        values = [array(typecode, [value]) for typecode, value in zip(VITAL_TYPECODES, visit[1:7])]
+
+        # The visit is stored in a new row at the end of every column.
+        self._makeWritable()
+        row = len(self._dates)
+        encodedDate = encodeDate(visit[0])
+        if encodedDate is None:
+            encodedDate = _ODD_DATE
+            self._oddDates[row] = visit[0]
+        self._patientIds.append(patientId)
+        self._dates.append(encodedDate)
+        for column, value in zip(self._vitals, values):
+            column.extend(value)
+        self._alive.append(1)
+
+        # Adds the patient to the store if this is their first visit.
+        if patientId not in self._rows:
+            self._addPatient(patientId)
+
+        # Adds the visit to the running totals of the patient and of every patient combined.
+        for totals in (self._totals[patientId], self._totals[None]):
+            totals[0] += 1
+            for index, value in enumerate(values, 1):
+                totals[index] += value[0]
+                totals[index + len(VITALS)] += value[0] * value[0]
+
+        # Adds the row to the date index, under the month of the visit.
+        if encodedDate != _ODD_DATE:
+            self._indexRow(row, encodedDate)
+
+        # Adds the row to the patient's rows. A range of rows is turned into an array first, since the new row does not
+        # follow on from it. Visits almost always arrive in date order, so the row usually goes at the end; otherwise,
+        # its place is found by binary search on the dates.
+        rows = self._rows[patientId]
+        if isinstance(rows, range):
+            rows = self._rows[patientId] = array('q', rows)
+        if rows and encodedDate < self._dates[rows[-1]]:
+            rows.insert(bisect_right(rows, encodedDate, key=self._dates.__getitem__), row)
+        else:
+            rows.append(row)
+        self._notify('add', patientId, row)
+        return row
+
+    def _addPatient(self, patientId):
+        # Adds a patient with no visits, numbering them after every patient already in the store.
+        self._rows[patientId] = array('q')
+        self._totals[patientId] = array('d', bytes(8 * _TOTALS_LENGTH))
+        self._ranks[patientId] = self._nextRank
+        self._nextRank += 1
+
+    def removePatient(self, patientId):
+        """
+        Removes a patient and all of their visits from the store. The rows of the visits are left unused until the store
+        is regrouped, which happens automatically once more than half of the rows are unused.
+
+        patientId: The ID of the patient to remove.
+        Returns the removed visits as a list of visit lists. Raises KeyError if the patient is not in the store.
+        """
+        rows = self._rows[patientId]
+        visits = [self._visit(row) for row in rows]
+        del self._rows[patientId]
+        del self._ranks[patientId]
+
+        # Takes the patient's running totals out of the totals of every patient combined. Once no visits are left, the
+        # totals are set back to exactly 0 so rounding errors do not build up.
+        patientTotals = self._totals.pop(patientId, None)
+        if patientTotals is not None:
+            totals = self._totals[None]
+            for index in range(_TOTALS_LENGTH):
+                totals[index] -= patientTotals[index]
+            if totals[0] == 0:
+                self._totals[None] = array('d', bytes(8 * _TOTALS_LENGTH))
+        # Marks each of the patient's rows as unused.
+        for row in rows:
+            self._alive[row] = 0
+        self._deadRows += len(rows)
+        # Reclaims the unused rows once they make up most of the store.
+        if self._deadRows * 2 > len(self._dates):
+            self.regroup()
+        self._notify('remove', patientId, None)
+        return visits
+
+    def appendColumns(self, patientIds, dates, vitals, oddDates):
+        """
+        Adds many visits at once from columns built elsewhere, such as by the parallel file reader, and then regroups
+        the store. This is much faster than adding the visits one at a time with addVisit.
+
+        patientIds: An array('q') of the patient ID of each visit.
+        dates: An array('i') of the encoded date of each visit (see encodeDate).
+        vitals: A list of one array per vital sign, in the order of VITALS, with the same typecodes as the store's columns.
+        oddDates: A dictionary mapping the position of each visit whose date could not be encoded to its date string.
+        """
+        # Adds the new rows to the end of every column.
+        self._makeWritable()
+        firstRow = len(self._dates)
+        self._patientIds.extend(patientIds)
+        self._dates.extend(dates)
+        for column, values in zip(self._vitals, vitals):
+            column.extend(values)
+        self._alive.extend(b'\x01' * len(dates))
+        for position, date in oddDates.items():
+            self._oddDates[firstRow + position] = date
+
+        # Adds each new row to the rows of its patient.
+        rows = self._rows
+        for row, patientId in enumerate(patientIds, firstRow):
+            if patientId not in rows:
+                self._addPatient(patientId)
+            elif isinstance(rows[patientId], range):
+                rows[patientId] = array('q', rows[patientId])
+            rows[patientId].append(row)
+
+        # Regroups the store, which also rebuilds the date index, and then recomputes the running totals.
+        self.regroup()
+        self._recomputeTotals()
+        self._notify('load', None, None)
+
+    def subscribe(self, listener):
+        """
+        Registers a function to be called whenever the visits in the store change. The function is called as
+        listener(event, patientId, row), where event is one of:
+        'add': A visit was added to the patient in the given row by addVisit.
+        'remove': The patient was removed along with all of their visits. The row is None.
+        'load': Many visits were added at once by appendColumns. The patient ID and row are None.
+        Rows can be renumbered when the store is regrouped, so listeners should not keep row numbers.
+
+        listener: The function to call.
+        """
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        """
+        Stops calling a function registered with subscribe.
+
+        listener: The function to stop calling.
+        """
+        self._listeners.remove(listener)
+
+    def _notify(self, event, patientId, row):
+        # Calls every registered listener about a change to the store.
+        for listener in self._listeners:
+            listener(event, patientId, row)
+
+    def _recomputeTotals(self):
+        # Recomputes the running totals of every patient from their visits. The rows of each patient must be a range,
+        # so that each column can be summed one slice at a time.
+        combined = array('d', bytes(8 * _TOTALS_LENGTH))
+        for patientId, rows in self._rows.items():
+            totals = array('d', bytes(8 * _TOTALS_LENGTH))
+            totals[0] = len(rows)
+            for index, column in enumerate(self._vitals, 1):
+                values = column[rows.start:rows.stop]
+                totals[index] = math.fsum(values)
+                totals[index + len(VITALS)] = math.fsum(map(mul, values, values))
+            self._totals[patientId] = totals
+            for index in range(_TOTALS_LENGTH):
+                combined[index] += totals[index]
+        self._totals[None] = combined
+
+    def regroup(self):
+        """
+        Rebuilds the columns so that the visits of each patient are stored in contiguous rows, in patient order and
+        then date order, and leaves out the rows of deleted patients. Afterwards, the rows of each patient are a range.
+        """
+        # Lists the rows to keep, patient by patient, sorting the rows of each patient by date. The sort is stable, so
+        # visits on the same date keep the order they were added in, and it takes a single pass over rows which are
+        # already in date order.
+        order = array('q')
+        dateOf = self._dates.__getitem__
+        for rows in self._rows.values():
+            if len(rows) > 1:
+                rows = sorted(rows, key=dateOf)
+            order.extend(rows)
+
+        # Copies each column in the new order.
+        self._patientIds = array('q', [self._patientIds[row] for row in order])
+        self._dates = array('i', [self._dates[row] for row in order])
+        self._vitals = [array(typecode, [column[row] for row in order])
+                        for typecode, column in zip(VITAL_TYPECODES, self._vitals)]
+        self._alive = bytearray(b'\x01') * len(order)
+        self._deadRows = 0
+
+        # Moves any date strings that could not be encoded to their new rows.
+        if self._oddDates:
+            newRows = {oldRow: newRow for newRow, oldRow in enumerate(order) if oldRow in self._oddDates}
+            self._oddDates = {newRows[oldRow]: date for oldRow, date in self._oddDates.items() if oldRow in newRows}
+
+        # Gives each patient the range of their new rows, and numbers the patients in order.
+        start = 0
+        for rank, patientId in enumerate(self._rows):
+            count = len(self._rows[patientId])
+            self._rows[patientId] = range(start, start + count)
+            self._ranks[patientId] = rank
+            start += count
+        self._nextRank = len(self._rows)
+
+        # Rebuilds the date index for the new rows.
+        self._monthRows = {}
+        self._months = []
+        for row, encodedDate in enumerate(self._dates):
+            if encodedDate != _ODD_DATE:
+                self._indexRow(row, encodedDate)
+
+    def _indexRow(self, row, encodedDate):
+        # Adds a row to the date index, creating the entry for its month if it is the first visit in that month.
+        month = encodedDate // 100
+        monthRows = self._monthRows.get(month)
+        if monthRows is None:
+            monthRows = self._monthRows[month] = array('q')
+            insort(self._months, month)
+        elif not isinstance(monthRows, array):
+            monthRows = self._monthRows[month] = _copyToArray(monthRows, 'q')
+        monthRows.append(row)
+
+    def _makeWritable(self):
+        # Copies any columns which are still read from a snapshot file into arrays, so rows can be added to them.
+        if not isinstance(self._dates, array):
+            self._patientIds = _copyToArray(self._patientIds, 'q')
+            self._dates = _copyToArray(self._dates, 'i')
+            self._vitals = [_copyToArray(column, typecode) for typecode, column in zip(VITAL_TYPECODES, self._vitals)]
+
+    def writeSnapshot(self, fileName, sourceStamp=(0, 0, 0, 0, 0, 0)):
+        """
+        Writes the store to a binary snapshot file which openSnapshot can open almost instantly. The snapshot holds a
+        header, a table of the rows of each patient, the running totals, the date index and then each column as fixed
+        width values, so that it can be memory mapped and used without being parsed. The store is regrouped first if
+        needed. The snapshot is written to a temporary file which then replaces fileName, so a snapshot which is in use
+        is never changed.
+
+        fileName: The name of the snapshot file to write.
+        sourceStamp: A tuple of 6 integers stored in the header, used by the caller to tell whether the snapshot is
+        still up to date with the file it was made from.
+        """
+        # The rows of each patient need to be contiguous, and there must be no unused rows.
+        if self._deadRows > 0 or any(not isinstance(rows, range) for rows in self._rows.values()):
+            self.regroup()
+
+        # Builds the table of the rows of each patient, and the running totals, with the combined totals first.
+        patientTable = array('q')
+        totals = array('d', self._totals[None])
+        for patientId, rows in self._rows.items():
+            patientTable.extend((patientId, rows.start, len(rows)))
+            totals.extend(self._totals[patientId])
+        # Builds the table of months in the date index, and the rows of each month one after another.
+        monthTable = array('q')
+        monthRows = array('q')
+        for month in self._months:
+            monthTable.extend((month, len(monthRows), len(self._monthRows[month])))
+            monthRows.extend(self._monthRows[month])
+        oddDates = json.dumps({str(row): date for row, date in self._oddDates.items()}).encode()
+
+        # Writes every section, each starting on a multiple of 8 bytes.
+        tempName = fileName + '.tmp'
+        with open(tempName, 'wb') as snapshotFile:
+            snapshotFile.write(_SNAPSHOT_HEADER.pack(
+                _SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, sys.byteorder == 'little', len(self._dates), len(self._rows),
+                len(self._months), len(monthRows), len(oddDates), *sourceStamp))
+            sections = [patientTable, totals, monthTable, monthRows, self._patientIds, self._dates] + self._vitals
+            for section in sections:
+                _writeAligned(snapshotFile, memoryview(section).cast('B'))
+            snapshotFile.write(oddDates)
+            snapshotFile.flush()
+            os.fsync(snapshotFile.fileno())
+        os.replace(tempName, fileName)
+
+    @classmethod
+    def openSnapshot(cls, fileName):
+        """
+        Opens a snapshot file written by writeSnapshot. The file is memory mapped, and the columns of the store read
+        straight from the mapping, so only the parts of the file that are used are ever loaded into memory. Only the
+        table of patients is read when the snapshot is opened. Changes to the store are never written back to the file:
+        columns are copied into memory the first time a visit is added.
+
+        fileName: The name of the snapshot file to open.
+        Returns a tuple (VisitStore, source stamp), or None if the file does not exist, is not a snapshot, or was written
+        by a different version or on a machine with a different byte order.
+        """
+        try:
+            with open(fileName, 'rb') as snapshotFile:
+                mapping = mmap.mmap(snapshotFile.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return None
+        if len(mapping) < _SNAPSHOT_HEADER.size:
+            return None
+        header = _SNAPSHOT_HEADER.unpack_from(mapping)
+        magic, version, littleEndian, rowCount, patientCount, monthCount, indexedRows, oddDatesLength = header[:8]
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION or littleEndian != (sys.byteorder == 'little'):
+            return None
+
+        # Works out where each section starts, in the order they were written.
+        view = memoryview(mapping)
+        position = _SNAPSHOT_HEADER.size + (-_SNAPSHOT_HEADER.size % 8)
+        sections = []
+        for typecode, count in [('q', 3 * patientCount), ('d', _TOTALS_LENGTH * (patientCount + 1)),
+                                ('q', 3 * monthCount), ('q', indexedRows), ('q', rowCount), ('i', rowCount)] + \
+                               [(typecode, rowCount) for typecode in VITAL_TYPECODES]:
+            end = position + count * array(typecode).itemsize
+            if end > len(mapping):
+                return None
+            sections.append(view[position:end].cast(typecode))
+            position = end + (-end % 8)
+        patientTable, totals, monthTable, monthRows, patientIds, dates = sections[:6]
+
+        # Builds the store around the mapped columns.
+        store = cls()
+        store._mapping = mapping
+        store._patientIds = patientIds
+        store._dates = dates
+        store._vitals = sections[6:]
+        store._alive = bytearray(b'\x01') * rowCount
+        store._oddDates = {int(row): date for row, date in
+                           json.loads(bytes(view[position:position + oddDatesLength]) or b'{}').items()}
+        store._totals[None] = totals[0:_TOTALS_LENGTH]
+        for rank in range(patientCount):
+            patientId, start, count = patientTable[3 * rank:3 * rank + 3]
+            store._rows[patientId] = range(start, start + count)
+            store._ranks[patientId] = rank
+            store._totals[patientId] = totals[_TOTALS_LENGTH * (rank + 1):_TOTALS_LENGTH * (rank + 2)]
+        store._nextRank = patientCount
+        for index in range(monthCount):
+            month, start, count = monthTable[3 * index:3 * index + 3]
+            store._months.append(month)
+            store._monthRows[month] = monthRows[start:start + count]
+        return store, tuple(header[8:])
+
+    def rowsBetween(self, startDate, endDate, chronological=False):
+        """
+        Finds the visits whose date is within a range of dates, using the date index. Only the months in the range are
+        looked at, so this takes time in proportion to the number of visits found rather than the number of visits in
+        the store. Visits whose date is not in the 'yyyy-mm-dd' form are never found.
+
+        startDate: The first date in the range, encoded by encodeDate.
+        endDate: The last date in the range, encoded by encodeDate.
+        chronological: If False, the rows are listed patient by patient, in the same order as iterating over the store
+        and its patients' visits (by date within each patient). If True, the rows are listed by date, with visits on
+        the same date in patient order.
+        Returns a list of the rows found.
+        """
+        # Finds the months in the range in the sorted list of months.
+        firstMonth = bisect_left(self._months, startDate // 100)
+        lastMonth = bisect_right(self._months, endDate // 100)
+        dates = self._dates
+        alive = self._alive
+        found = []
+        for month in self._months[firstMonth:lastMonth]:
+            # Every visit in a month inside the range is found. In the first and last month, the day is checked too.
+            if startDate <= month * 100 and month * 100 + 99 <= endDate:
+                found.extend(row for row in self._monthRows[month] if alive[row])
+            else:
+                found.extend(row for row in self._monthRows[month]
+                             if alive[row] and startDate <= dates[row] <= endDate)
+
+        # Puts the rows in the order requested.
+        ranks = self._ranks
+        patientIds = self._patientIds
+        if chronological:
+            found.sort(key=lambda row: (dates[row], ranks[patientIds[row]], row))
+        else:
+            found.sort(key=lambda row: (ranks[patientIds[row]], dates[row], row))
+        return found
+
+    def patientOf(self, row):
+        """
+        Returns the ID of the patient whose visit is stored in a row.
+
+        row: The row of the visit.
+        """
+        return self._patientIds[row]
+
+    def visitAt(self, row):
+        """
+        Returns the visit stored in a row as a visit list [date, temperature, heart rate, respiratory rate, systolic blood
+        pressure, diastolic blood pressure, oxygen saturation].
+
+        row: The row of the visit.
+        """
+        return self._visit(row)
+
+    def rowsOf(self, patientId):
+        """
+        Returns the sequence of rows holding the visits of a patient, in date order.
+
+        patientId: The ID of the patient.
+        """
+        return self._rows[patientId]
+
+    def positionOf(self, patientId, row):
+        """
+        Returns the position of a visit in the patient's list of visits, found by binary search.
+
+        patientId: The ID of the patient.
+        row: The row of the visit, which must be one of the patient's rows.
+        """
+        rows = self._rows[patientId]
+        if isinstance(rows, range):
+            return row - rows.start
+        # The rows are sorted by date, and rows on the same date by row number.
+        dates = self._dates
+        return bisect_left(rows, (dates[row], row), key=lambda other: (dates[other], other))
+
+    def patientRowsBetween(self, patientId, startDate=None, endDate=None):
+        """
+        Finds the visits of a patient whose date is within a range of dates, by binary search on the patient's rows.
+
+        patientId: The ID of the patient.
+        startDate: The first date in the range, encoded by encodeDate, or None to start from the first visit.
+        endDate: The last date in the range, encoded by encodeDate, or None to go up to the most recent visit.
+        Returns a sequence of the rows found, in date order. Raises KeyError if the patient is not in the store.
+        """
+        rows = self._rows[patientId]
+        dateOf = self._dates.__getitem__
+        first = 0 if startDate is None else bisect_left(rows, startDate, key=dateOf)
+        last = len(rows) if endDate is None else bisect_right(rows, endDate, key=dateOf)
+        return rows[first:last]
+
+    def latestRows(self, patientId, count=1):
+        """
+        Returns a sequence of the rows of a patient's most recent visits, up to count of them, in date order. Raises
+        KeyError if the patient is not in the store.
+
+        patientId: The ID of the patient.
+        count: The number of visits.
+        """
+        rows = self._rows[patientId]
+        return rows[max(len(rows) - count, 0):]
+
+    def latestVisit(self, patientId):
+        """
+        Returns the most recent visit of a patient as a visit list, or None if the patient has no visits. Raises
+        KeyError if the patient is not in the store.
+
+        patientId: The ID of the patient.
+        """
+        rows = self._rows[patientId]
+        return self._visit(rows[-1]) if rows else None
+
+    def selectRows(self, patientIds=None):
+        """
+        Returns the rows holding the visits of a set of patients, patient by patient. Patient IDs which are not in the
+        store are skipped.
+
+        patientIds: An iterable of patient IDs, or None for every patient.
+        Returns a range (when every row is selected and none are unused) or an array of row numbers.
+        """
+        # When every patient is selected and no rows are unused, every row is selected.
+        if patientIds is None and self._deadRows == 0:
+            return range(len(self._dates))
+        if patientIds is None:
+            patientIds = self._rows
+        selected = array('q')
+        for patientId in patientIds:
+            if patientId in self._rows:
+                selected.extend(self._rows[patientId])
+        return selected
+
+    def runningTotals(self, patientId=None):
+        """
+        Returns the running totals of the visits of a patient, or of every patient combined. The totals are kept up to
+        date as visits are added and patients are removed, so no visits are read.
+
+        patientId: The ID of the patient, or None for every patient combined.
+        Returns a tuple (number of visits, sum of each vital sign, sum of the squares of each vital sign), where the sums
+        are tuples in the order of VITALS. Raises KeyError if the patient is not in the store.
+        """
+        totals = self._totals[patientId]
+        return int(totals[0]), tuple(totals[1:1 + len(VITALS)]), tuple(totals[1 + len(VITALS):])
+
+    def verifyRunningTotals(self, tolerance=1e-6):
+        """
+        Checks the running totals against totals recomputed from every visit in the store.
+
+        tolerance: The largest relative difference allowed between a running total and the recomputed total, to allow
+        for rounding errors.
+        Returns a list of (patient ID or None, name of the total, running total, recomputed total) tuples, one for each
+        total which does not match. The list is empty if every total matches.
+        """
+        # Names of the totals, in the order they are stored.
+        names = (['visits'] + ['sum of ' + vital for vital in VITALS] +
+                 ['sum of squares of ' + vital for vital in VITALS])
+        mismatches = []
+
+        # Recomputes the totals of each patient, adding them up for every patient combined as well.
+        combined = [0.0] * _TOTALS_LENGTH
+        expectedTotals = {}
+        for patientId, rows in self._rows.items():
+            expected = [float(len(rows))]
+            expected.extend(math.fsum(column[row] for row in rows) for column in self._vitals)
+            expected.extend(math.fsum(column[row] * column[row] for row in rows) for column in self._vitals)
+            expectedTotals[patientId] = expected
+            for index in range(_TOTALS_LENGTH):
+                combined[index] += expected[index]
+        expectedTotals[None] = combined
+
+        # Compares each recomputed total with the running total.
+        for patientId, expected in expectedTotals.items():
+            actual = self._totals.get(patientId, [0.0] * _TOTALS_LENGTH)
+            for name, actualValue, expectedValue in zip(names, actual, expected):
+                if abs(actualValue - expectedValue) > tolerance * max(1.0, abs(expectedValue)):
+                    mismatches.append((patientId, name, actualValue, expectedValue))
+        # Any patient who still has running totals but is no longer in the store is a mismatch too.
+        for patientId in self._totals:
+            if patientId is not None and patientId not in self._rows:
+                mismatches.append((patientId, 'visits', self._totals[patientId][0], 0.0))
+        return mismatches
+
+    def column(self, vital):
+        """
+        Returns the array storing a vital sign, indexed by row. Rows of deleted patients are still in the array; use
+        rowsOf or isAlive to skip them.
+
+        vital: The name of the vital sign, one of VITALS.
+        """
+        return self._vitals[VITALS.index(vital)]
+
+    def patientIdColumn(self):
+        """
+        Returns the array storing the patient ID of each row. Rows of deleted patients are still in the array; use
+        rowsOf or isAlive to skip them.
+        """
+        return self._patientIds
+
+    def dateColumn(self):
+        """
+        Returns the array storing the encoded date (see encodeDate) of each row. Dates which cannot be encoded are
+        stored as -1. Rows of deleted patients are still in the array; use rowsOf or isAlive to skip them.
+        """
+        return self._dates
+
+    def monthRowCount(self, startDate, endDate):
+        """
+        Returns the number of rows the date index holds for the months which overlap a range of dates. This is at least
+        the number of visits rowsBetween finds for the range, and is worked out without reading any rows, so it can be
+        used to estimate how long rowsBetween will take.
+
+        startDate: The first date in the range, encoded by encodeDate.
+        endDate: The last date in the range, encoded by encodeDate.
+        """
+        firstMonth = bisect_left(self._months, startDate // 100)
+        lastMonth = bisect_right(self._months, endDate // 100)
+        return sum(len(self._monthRows[month]) for month in self._months[firstMonth:lastMonth])
+
+    def isAlive(self, row):
+        """
+        Returns True if the row holds a visit of a patient who has not been deleted.
+
+        row: The row to check.
+        """
+        return self._alive[row] == 1
+
+    def visitCount(self):
+        """
+        Returns the total number of visits stored for every patient.
+        """
+        return len(self._dates) - self._deadRows
+
+    def dateStrings(self, rows):
+        """
+        Returns a list of the date string of each of a sequence of rows. Each date string is only built once, however
+        many rows have that date.
+
+        rows: The rows.
+        """
+        dateStrings = {}
+        dates = self._dates
+        found = []
+        for row in rows:
+            encodedDate = dates[row]
+            date = dateStrings.get(encodedDate)
+            if date is None:
+                date = self._dateString(row)
+                if encodedDate != _ODD_DATE:
+                    dateStrings[encodedDate] = date
+            found.append(date)
+        return found
+
+    def formatLines(self, lineFormat, batchSize):
+        """
+        Formats the visits of every patient as lines of text, patient by patient and then in date order, reading the
+        columns directly instead of building a visit list for each visit. Each date string is only built once.
+
+        lineFormat: The format of a line, filled in with the tuple (patient ID, date string, temperature, heart rate,
+        respiratory rate, systolic blood pressure, diastolic blood pressure, oxygen saturation).
+        batchSize: The number of lines joined into each block.
+        Yields the lines as strings of up to batchSize lines each.
+        """
+        dateStrings = {}
+        lines = []
+        for patientId, rows in self._rows.items():
+            # Reads the values of the patient's rows from each column, as slices when the rows are contiguous.
+            if isinstance(rows, range):
+                columns = [column[rows.start:rows.stop] for column in [self._dates] + self._vitals]
+            else:
+                columns = [[column[row] for row in rows] for column in [self._dates] + self._vitals]
+            for row, encodedDate, temperature, hr, rr, sbp, dbp, spo2 in zip(rows, *columns):
+                date = dateStrings.get(encodedDate)
+                if date is None:
+                    date = self._dateString(row)
+                    if encodedDate != _ODD_DATE:
+                        dateStrings[encodedDate] = date
+                lines.append(lineFormat % (patientId, date, temperature, hr, rr, sbp, dbp, spo2))
+            if len(lines) >= batchSize:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+    def toDict(self):
+        """
+        Returns the visits as a patients dictionary of lists, in the format readPatientsFromFile used to return.
+        """
+        return {patient: list(self[patient]) for patient in self}
+
+    def _dateString(self, row):
+        # Returns the date of a row as a string.
+        encodedDate = self._dates[row]
+        if encodedDate == _ODD_DATE:
+            return self._oddDates[row]
+        return decodeDate(encodedDate)
+
+    def _visit(self, row):
+        # Builds the visit list stored in a row.
+        vitals = self._vitals
+        return [self._dateString(row), vitals[0][row], vitals[1][row], vitals[2][row], vitals[3][row],
+                vitals[4][row], vitals[5][row]]
+
+    # The methods below let the store be used in the same way as a patients dictionary.
+
+    def __getitem__(self, patientId):
+        if patientId not in self._rows:
+            raise KeyError(patientId)
+        return PatientVisits(self, patientId)
+
+    def __setitem__(self, patientId, visits):
+        # Replaces all of a patient's visits.
+        visits = list(visits)
+        if patientId in self._rows:
+            self.removePatient(patientId)
+        if len(visits) == 0:
+            self._addPatient(patientId)
+        for visit in visits:
+            self.addVisit(patientId, visit)
+
+    def __contains__(self, patientId):
+        return patientId in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def keys(self):
+        return self._rows.keys()
+
+    def values(self):
+        return [PatientVisits(self, patientId) for patientId in self._rows]
+
+    def items(self):
+        return [(patientId, PatientVisits(self, patientId)) for patientId in self._rows]
+
+    def get(self, patientId, default=None):
+        if patientId in self._rows:
+            return PatientVisits(self, patientId)
+        return default
+
+    def pop(self, patientId, *default):
+        if patientId not in self._rows and default:
+            return default[0]
+        return self.removePatient(patientId)
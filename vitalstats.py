@@ -0,0 +1,207 @@
+import math
+
+from visitstore import VITAL_TYPECODES, VITALS, VisitStore
+
+# NumPy is used to compute the statistics in a few batched array operations when it is installed. Without it, the same
+# statistics are computed with plain Python.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Percentiles reported for each vital sign unless others are requested.
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def computeVitalStats(patients, patientIds=None, percentiles=DEFAULT_PERCENTILES):
+    """
+    Computes the mean, minimum, maximum, standard deviation and percentiles of every vital sign over the visits of all
+    patients or of a set of patients. The standard deviation is the population standard deviation, and percentiles are
+    linearly interpolated between the two nearest visits.
+
+    patients: A VisitStore, or a dictionary of patient IDs where each patient has a list of visits.
+    patientIds: An iterable of the patient IDs to include, or None to include every patient. IDs that are not found
+    are skipped.
+    percentiles: The percentiles (from 0 to 100) to report for each vital sign.
+    Returns a dictionary with the following structure:
+    {
+        'visits': number of visits included (int),
+        'patients': number of patients included (int),
+        'vitals': {
+            vital name (str): {'mean': float, 'min': float, 'max': float, 'stddev': float,
+                               'percentiles': {percentile: float, ...}},
+            ...
+        }
+    }
+    If no visits are included, 'vitals' maps every vital name to None.
+    """
+    # A dictionary is read with plain Python, looking only at the patients asked for. Copying it into a VisitStore would
+    # read every patient, and the typed columns of a store cannot hold every value a dictionary can.
+    if not isinstance(patients, VisitStore):
+        return _computeFromVisits(patients, patientIds, percentiles)
+    store = patients
+    if patientIds is not None:
+        patientIds = [patientId for patientId in dict.fromkeys(patientIds) if patientId in store]
+    rows = store.selectRows(patientIds)
+
+    # Builds the result, leaving the statistics empty if there are no visits.
+    result = {
+        'visits': len(rows),
+        'patients': len(store) if patientIds is None else len(patientIds),
+        'vitals': dict.fromkeys(VITALS),
+    }
+    if len(rows) == 0:
+        return result
+
+    # Computes the statistics of every vital sign at once with NumPy, or one vital sign at a time without it.
+    if numpy is not None:
+        _computeWithNumpy(store, rows, percentiles, result['vitals'])
+    else:
+        for vital in VITALS:
+            column = store.column(vital)
+            result['vitals'][vital] = _summarize(sorted(column[row] for row in rows), percentiles)
+    return result
+
+
+def runningVitalStats(store, patientId=None):
+    """
+    Computes the mean and standard deviation of every vital sign from the running totals kept by a VisitStore, without
+    reading any visits. This is much faster than computeVitalStats, but does not give the minimum, maximum or
+    percentiles.
+
+    store: The VisitStore to read the running totals from.
+    patientId: The ID of the patient, or None for every patient combined.
+    Returns a dictionary with the same structure as the one returned by computeVitalStats, except that each vital sign
+    only has 'mean' and 'stddev'. Raises KeyError if the patient is not in the store.
+    """
+    count, sums, sumsOfSquares = store.runningTotals(patientId)
+    return statsFromTotals(count, sums, sumsOfSquares, len(store) if patientId is None else 1)
+
+
+def statsFromTotals(count, sums, sumsOfSquares, patientCount):
+    """
+    Computes the mean and standard deviation of every vital sign from running totals, such as those kept by a
+    VisitStore. Totals of separate groups of visits can be added together first, to find the statistics of every group
+    combined.
+
+    count: The number of visits.
+    sums: The sum of each vital sign, in the order of VITALS.
+    sumsOfSquares: The sum of the squares of each vital sign, in the order of VITALS.
+    patientCount: The number of patients the visits belong to.
+    Returns a dictionary in the same form as runningVitalStats.
+    """
+    result = {
+        'visits': count,
+        'patients': patientCount,
+        'vitals': dict.fromkeys(VITALS),
+    }
+    if count == 0:
+        return result
+    for vital, total, totalOfSquares in zip(VITALS, sums, sumsOfSquares):
+        mean = total / count
+        # The variance can come out very slightly below 0 because of rounding, so it is kept at 0 or above.
+        variance = max(totalOfSquares / count - mean * mean, 0.0)
+        result['vitals'][vital] = {'mean': mean, 'stddev': math.sqrt(variance)}
+    return result
+
+
+def _computeFromVisits(patients, patientIds, percentiles):
+    # Computes the same statistics as computeVitalStats from the visit lists of a dictionary of patients.
+    if patientIds is None:
+        patientIds = list(patients)
+    else:
+        patientIds = [patientId for patientId in dict.fromkeys(patientIds) if patientId in patients]
+    columns = [[] for _ in VITALS]
+    for patientId in patientIds:
+        for visit in patients[patientId]:
+            for column, value in zip(columns, visit[1:]):
+                column.append(value)
+    result = {
+        'visits': len(columns[0]),
+        'patients': len(patientIds),
+        'vitals': dict.fromkeys(VITALS),
+    }
+    if columns[0]:
+        for vital, column in zip(VITALS, columns):
+            result['vitals'][vital] = _summarize(sorted(column), percentiles)
+    return result
+
+
+def _computeWithNumpy(store, rows, percentiles, vitalStats):
+    # Gathers the selected rows of every vital sign into one 2-dimensional array, with one vital sign per row, so that
+    # each statistic is computed for every vital sign in a single call.
+    if isinstance(rows, range):
+        selection = slice(rows.start, rows.stop)
+    else:
+        selection = numpy.frombuffer(rows, dtype=numpy.int64)
+    matrix = numpy.empty((len(VITALS), len(rows)), dtype=numpy.float64)
+    for index, vital in enumerate(VITALS):
+        matrix[index] = numpy.frombuffer(store.column(vital), dtype=VITAL_TYPECODES[index])[selection]
+
+    means = matrix.mean(axis=1)
+    minimums = matrix.min(axis=1)
+    maximums = matrix.max(axis=1)
+    deviations = matrix.std(axis=1)
+    percentileValues = numpy.percentile(matrix, list(percentiles), axis=1) if percentiles else None
+
+    # Copies the results into plain Python floats.
+    for index, vital in enumerate(VITALS):
+        vitalStats[vital] = {
+            'mean': float(means[index]),
+            'min': float(minimums[index]),
+            'max': float(maximums[index]),
+            'stddev': float(deviations[index]),
+            'percentiles': {percentile: float(percentileValues[position][index])
+                            for position, percentile in enumerate(percentiles)},
+        }
+
+
+def _summarize(values, percentiles):
+    # Computes the statistics of a sorted list of values.
+    count = len(values)
+    mean = math.fsum(values) / count
+    variance = math.fsum((value - mean) ** 2 for value in values) / count
+    return {
+        'mean': mean,
+        'min': float(values[0]),
+        'max': float(values[-1]),
+        'stddev': math.sqrt(variance),
+        'percentiles': {point: percentile(values, point) for point in percentiles},
+    }
+
+
+def percentile(values, percentile):
+    """
+    Finds a percentile of a sorted list of values by interpolating between the two nearest values, which is the same
+    method NumPy uses by default.
+
+    values: The sorted list of values. Must not be empty.
+    percentile: The percentile to find, from 0 to 100.
+    Returns the percentile as a float.
+    """
+    position = (len(values) - 1) * percentile / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return float(values[lower] + (values[upper] - values[lower]) * (position - lower))
+
+
+def formatVitalStats(stats):
+    """
+    Formats the result of computeVitalStats as a printable report with one line per vital sign.
+
+    stats: The dictionary returned by computeVitalStats.
+    Returns the report as a string.
+    """
+    lines = ['Visits: %d  Patients: %d' % (stats['visits'], stats['patients'])]
+    for vital in VITALS:
+        vitalStats = stats['vitals'][vital]
+        if vitalStats is None:
+            lines.append(' %s: no data' % vital.capitalize())
+            continue
+        percentileText = '  '.join('p%g=%.2f' % (percentile, value)
+                                   for percentile, value in vitalStats['percentiles'].items())
+        lines.append(' %s: mean=%.2f  min=%.2f  max=%.2f  stddev=%.2f  %s'
+                     % (vital.capitalize(), vitalStats['mean'], vitalStats['min'], vitalStats['max'],
+                        vitalStats['stddev'], percentileText))
+    return '\n'.join(lines)